@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 import os.path
 from pathlib import Path
-from decouple import config
+from decouple import config, Csv
 from django.urls import reverse_lazy
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -48,7 +48,10 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'core.staticfiles.PrecompressedStaticMiddleware',
+    'core.metrics.MetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'core.routers.ReplicaRoutingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -61,7 +64,8 @@ ROOT_URLCONF = 'OnlinePharmacy.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates timing the template rendering for the request metrics
+        'BACKEND': 'core.metrics.TimedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates']
         ,
         'APP_DIRS': True,
@@ -84,8 +88,52 @@ WSGI_APPLICATION = 'OnlinePharmacy.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # SQLite configured for concurrent requests (pragmas, BEGIN IMMEDIATE for write paths)
+        'ENGINE': 'core.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # seconds a connection waits for the write lock held by another connection
+            'timeout': 20,
+            # overrides of core.backends.sqlite3.base.DEFAULT_PRAGMAS
+            'pragmas': {
+                'busy_timeout': 20000,
+            },
+        },
+    }
+}
+
+# Switch the database to the write-ahead log, so that readers do not wait for the writers - set in production.
+# The mode is stored in the database file (and leaves db.sqlite3-wal/-shm next to it), so it is off by default.
+SQLITE_WAL = config('SQLITE_WAL', default=False, cast=bool)
+if SQLITE_WAL:
+    DATABASES['default']['OPTIONS']['pragmas']['journal_mode'] = 'WAL'
+
+# Read replicas of 'default' for the catalog (see core.routers) - comma-separated paths of SQLite files
+# kept in sync with the primary by replication outside of Django (e.g. Litestream or LiteFS)
+DATABASE_REPLICAS = []
+for i, replica_name in enumerate(config('DATABASE_REPLICA_NAMES', default='', cast=Csv())):
+    DATABASES[f'replica{i + 1}'] = {
+        **DATABASES['default'],
+        'NAME': replica_name,
+        # tests read and write the test database of the primary
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica{i + 1}')
+
+DATABASE_ROUTERS = ['core.routers.PrimaryReplicaRouter']
+
+# seconds a session reads from the primary after writing, so that it sees its own writes despite the replication lag
+DATABASE_REPLICA_STICKY_SECONDS = config('DATABASE_REPLICA_STICKY_SECONDS', default=10, cast=int)
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# LocMemCache is per-process - with several worker processes use a shared backend (e.g. memcached or
+# FileBasedCache) so that signal-driven invalidation reaches every worker
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'online-pharmacy',
     }
 }
 
@@ -124,12 +172,14 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.2/howto/static-files/
 
 STATIC_URL = '/static/'
-if DEBUG:
-    STATICFILES_DIRS = (
-        os.path.join(BASE_DIR, 'static'),
-    )
-else:
-    STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+STATICFILES_DIRS = (
+    os.path.join(BASE_DIR, 'static'),
+)
+# output of 'collectstatic' - served by core.staticfiles.PrecompressedStaticMiddleware when not DEBUG
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+if not DEBUG:
+    # content-hashed file names (cached by browsers for a year) with precompressed .gz/.br siblings
+    STATICFILES_STORAGE = 'core.staticfiles.CompressedManifestStaticFilesStorage'
 
 
 MEDIA_URL = '/media/'
@@ -154,6 +204,80 @@ SITE_ID = 1
 
 LOGIN_REDIRECT_URL = reverse_lazy('core:index')
 
+# Top-level categories shown in the navbar (in display order)
+NAVBAR_CATEGORIES = ['Zdrowie', 'Higiena', 'Pielęgnacja']
+# The navbar category tree is invalidated by signals, so it can be cached without expiry (None)
+CATEGORY_TREE_CACHE_TIMEOUT = None
+# Rendered catalog fragments (product grids, item details) are keyed by a catalog version stamp bumped on every change
+# of the catalog (see core.catalog_cache) - the timeout only bounds how long fragments of old versions take up space
+CATALOG_CACHE_TIMEOUT = 60 * 60
+
+# Resized variants of uploaded item images are generated in a pool of worker processes (see core.images);
+# with IMAGE_VARIANTS_ASYNC = False they are generated right away in the saving process
+IMAGE_VARIANTS_ASYNC = True
+# None - one worker process per CPU
+IMAGE_VARIANT_WORKERS = None
+
+# Serve the catalog (index, item detail, category listing, search) with the async views of core.async_views -
+# enabled by OnlinePharmacy/asgi.py, under WSGI the sync views are faster
+ASYNC_CATALOG_VIEWS = config('ASYNC_CATALOG_VIEWS', default=False, cast=bool)
+
+# Per-view request metrics in the Prometheus format at /metrics (see core.metrics)
+METRICS_ENABLED = True
+# With several worker processes every process writes its metrics to a file in this directory,
+# so that /metrics reports the sums of all processes - e.g. os.path.join(BASE_DIR, 'metrics')
+METRICS_DIR = config('METRICS_DIR', default=None)
+METRICS_FLUSH_INTERVAL = 5
+# /metrics is available to staff users and to these addresses (e.g. of the Prometheus server)
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# add the number of SQL queries of the request as the X-DB-Queries response header (for benchmarks)
+METRICS_QUERY_COUNT_HEADER = config('METRICS_QUERY_COUNT_HEADER', default=False, cast=bool)
+
+# Product feeds for price comparison sites exported by 'python manage.py export_feeds' (see core.feeds)
+FEED_ROOT = config('FEED_ROOT', default=os.path.join(BASE_DIR, 'feeds'))
+# the shop's address - feeds list absolute URLs of the items and their images
+FEED_BASE_URL = config('FEED_BASE_URL', default='http://localhost:8000')
+# items with this many consecutive primary keys are rendered again together when any of them changes
+FEED_CHUNK_SIZE = 1000
+
+# Read-only JSON catalog API (see core.api): default and maximum page size, maximum number of ids of a bulk fetch
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 100
+API_MAX_IDS = 100
+
+# Background jobs (core.jobs) run by 'python manage.py run_workers'
+JOB_WORKER_PROCESSES = config('JOB_WORKER_PROCESSES', default=1, cast=int)
+JOB_WORKER_THREADS = config('JOB_WORKER_THREADS', default=4, cast=int)
+# seconds an idle worker waits before looking for new jobs again
+JOB_POLL_INTERVAL = 1
+JOB_MAX_ATTEMPTS = 5
+# failed jobs are retried after JOB_RETRY_BASE_DELAY * 2^(attempt - 1) seconds (with jitter), at most JOB_RETRY_MAX_DELAY
+JOB_RETRY_BASE_DELAY = 10
+JOB_RETRY_MAX_DELAY = 60 * 60
+# a job not finished in this many seconds is considered abandoned by its (killed) worker and run again
+JOB_LOCK_TIMEOUT = 15 * 60
+
+# E-mails (sent by the background jobs) - printed to the console unless an SMTP backend is configured
+EMAIL_BACKEND = config('EMAIL_BACKEND', default='django.core.mail.backends.console.EmailBackend')
+EMAIL_HOST = config('EMAIL_HOST', default='localhost')
+EMAIL_PORT = config('EMAIL_PORT', default=25, cast=int)
+EMAIL_HOST_USER = config('EMAIL_HOST_USER', default='')
+EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD', default='')
+EMAIL_USE_TLS = config('EMAIL_USE_TLS', default=False, cast=bool)
+DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL', default='apteka@localhost')
+# staff notified about items running out of stock
+MANAGERS = [(email, email) for email in config('MANAGER_EMAILS', default='', cast=Csv())]
+STOCK_ALERT_THRESHOLD = 5
+
+# anonymous carts not changed for CART_MAX_AGE_DAYS days are deleted by 'prune_carts' (with the expired sessions)
+CART_MAX_AGE_DAYS = config('CART_MAX_AGE_DAYS', default=30, cast=int)
+CART_PRUNE_BATCH_SIZE = 1000
+# seconds between the runs of the prune_carts background job (see 'prune_carts --schedule')
+CART_PRUNE_INTERVAL = config('CART_PRUNE_INTERVAL', default=24 * 60 * 60, cast=int)
+
+# allauth e-mails (e.g. password reset) are sent by a background job
+ACCOUNT_ADAPTER = 'core.adapters.AccountAdapter'
+
 # Logging configuration
 LOGGING = {
     'version': 1,
@@ -0,0 +1,13 @@
+from allauth.account.adapter import DefaultAccountAdapter
+
+from .notifications import enqueue_email
+
+
+class AccountAdapter(DefaultAccountAdapter):
+    """
+    E-mails of the account flows (confirmation, password reset) are rendered in the request and sent by a background
+    job, so the request does not wait for the mail server.
+    """
+
+    def send_mail(self, template_prefix, email, context):
+        enqueue_email(self.render_mail(template_prefix, email, context))
@@ -1,14 +1,110 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.utils import timezone
 from .models import *
 
 
+class ItemSubCategoryInline(admin.TabularInline):
+    model = ItemSubCategory
+    fields = ['subcategory']
+    extra = 1
+
+
+class StockMovementInline(admin.TabularInline):
+    """
+    Changes of the stock - only new movements can be added, the ledger is listed in the stock movements admin.
+    """
+    model = StockMovement
+    fields = ['quantity', 'reason', 'note']
+    extra = 1
+    can_delete = False
+    verbose_name_plural = "Add stock movements"
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).none()
+
+
+class ItemAdmin(admin.ModelAdmin):
+    # subcategories use an explicit through model, so they are edited inline
+    inlines = [ItemSubCategoryInline, StockMovementInline]
+
+    def get_readonly_fields(self, request, obj=None):
+        # the stock of an existing item changes only with stock movements
+        return ['in_stock'] if obj is not None else []
+
+    def save_formset(self, request, form, formset, change):
+        if formset.model is not StockMovement:
+            return super().save_formset(request, form, formset, change)
+        for movement in formset.save(commit=False):
+            if Item.objects.move_stock(form.instance.pk, movement.quantity, movement.reason,
+                                       note=movement.note) is None:
+                messages.error(request, f"Niewystarczająca liczba sztuk {form.instance.name} na stanie "
+                                        f"- ruch {movement.quantity:+} nie został zapisany!")
+
+
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ['created_at', 'item', 'quantity', 'reason', 'order', 'note']
+    list_filter = ['reason']
+    list_select_related = ['item', 'order']
+    search_fields = ['item__name', 'item__sku']
+
+    # the ledger is append-only - movements are added with the items
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.action(description="Anuluj zamówienia i zwróć sztuki na stan")
+def cancel_orders(modeladmin, request, queryset):
+    skipped = [order for order in queryset if not order.cancel()]
+    modeladmin.message_user(request, f"Anulowano zamówień: {len(queryset) - len(skipped)}")
+    if skipped:
+        modeladmin.message_user(request, "Pominięto zamówienia anulowane, wysłane lub zrealizowane: "
+                                         f"{', '.join(f'#{pk}' for pk in sorted(order.pk for order in skipped))}", messages.WARNING)
+
+
+class OrderAdmin(admin.ModelAdmin):
+    # orders are cancelled with the action only, so that the pieces are returned with ledger movements
+    readonly_fields = ['status']
+    actions = [cancel_orders]
+
+    def delete_model(self, request, obj):
+        # the pieces of a deleted order go back to the stock, unless they have already been shipped
+        obj.cancel()
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        for order in queryset:
+            order.cancel()
+        super().delete_queryset(request, queryset)
+
+
+@admin.action(description="Ponów wybrane zadania")
+def requeue_jobs(modeladmin, request, queryset):
+    n_requeued = queryset.filter(status=Job.DEAD).update(status=Job.QUEUED, attempts=0, run_at=timezone.now())
+    modeladmin.message_user(request, f"Ponowiono zadań: {n_requeued}")
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'status', 'attempts', 'run_at', 'locked_by', 'created_at']
+    list_filter = ['status', 'name']
+    readonly_fields = ['attempts', 'locked_by', 'locked_at', 'last_error', 'created_at']
+    actions = [requeue_jobs]
+
+
 admin.site.register(Category)
 admin.site.register(SubCategory)
 admin.site.register(Manufacturer)
-admin.site.register(Item)
+admin.site.register(Item, ItemAdmin)
 admin.site.register(Cart)
 admin.site.register(CartItem)
 admin.site.register(Customer)
-admin.site.register(Order)
+admin.site.register(Order, OrderAdmin)
 admin.site.register(OrderItem)
 admin.site.register(Address)
+admin.site.register(StockMovement, StockMovementAdmin)
+admin.site.register(Job, JobAdmin)
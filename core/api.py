@@ -0,0 +1,293 @@
+"""
+Read-only JSON API of the catalog (items, subcategories, manufacturers) for the mobile app and partner integrations.
+
+Every resource is served as a list with cursor pagination (GET /api/items/?cursor=...&limit=...), as a bulk fetch
+by ids (GET /api/items/?ids=1,2,3) or as a single object (GET /api/items/1/); ?fields=id,name,price selects
+the fields returned (and the columns read).
+
+Responses carry an ETag and Last-Modified computed before anything is serialized: the ETag of items from the primary
+keys and Item.updated_at of the returned rows (a single narrow query), of the other resources from the catalog version
+stamp (see core.catalog_cache). Last-Modified of a single item is its updated_at; lists use the catalog version stamp,
+since the removal of an item from a list does not show in the updated_at of the remaining ones. A request with
+a matching If-None-Match / If-Modified-Since gets 304 right away.
+"""
+import hashlib
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date, quote_etag
+from django.views import View
+
+from .catalog_cache import get_catalog_version
+from .models import Item, ItemSubCategory, Manufacturer, SubCategory
+from .pagination import KeysetPaginator
+from .routers import read_from_replicas
+
+
+class ApiError(Exception):
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def api_error(message, status=400):
+    return JsonResponse({"error": message}, status=status)
+
+
+def parse_ids(value, name, limit=None):
+    """
+    :return: list of the primary keys in the comma-separated 'value'
+    :raise ApiError: the value is not a list of integers or it is longer than 'limit'
+    """
+    try:
+        ids = [int(part) for part in value.split(",") if part.strip()]
+    except ValueError:
+        raise ApiError(f"Parametr '{name}' musi być listą liczb oddzielonych przecinkami.")
+    if limit is not None and len(ids) > limit:
+        raise ApiError(f"Parametr '{name}' może zawierać co najwyżej {limit} identyfikatorów.")
+    return ids
+
+
+def parse_int(value, name, default, maximum):
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ApiError(f"Parametr '{name}' musi być liczbą.")
+    if not 1 <= value <= maximum:
+        raise ApiError(f"Parametr '{name}' musi być liczbą od 1 do {maximum}.")
+    return value
+
+
+class Resource:
+    """
+    A model exposed by the API.
+    'fields' maps the API field names to the model fields read for them (None for the fields computed otherwise).
+    """
+    model = None
+    fields = {}
+
+    def parse_fields(self, value):
+        """
+        :return: list of the requested field names (all fields if 'value' is empty)
+        :raise ApiError: unknown field
+        """
+        if not value:
+            return list(self.fields)
+        fields = [name.strip() for name in value.split(",") if name.strip()]
+        unknown = [name for name in fields if name not in self.fields]
+        if unknown:
+            raise ApiError(f"Nieznane pola: {', '.join(unknown)}. Dostępne pola: {', '.join(self.fields)}.")
+        return fields
+
+    def filter(self, queryset, params):
+        return queryset
+
+    def stamps(self, objects):
+        """
+        :param objects: the (primary keys only) objects of the response
+        :return: tuple(ETag material, last modification timestamp or None if unknown) of the objects
+        """
+        return get_catalog_version(), None
+
+    def stamp_queryset(self):
+        """
+        :return: queryset of the objects with the fields needed by stamps() only
+        """
+        return self.model.objects.only('pk')
+
+    def fetch(self, pks, fields):
+        """
+        :return: objects with the given primary keys (in primary key order) reading only the columns of 'fields'
+        """
+        columns = {column for name in fields for column in self.model_fields(name)}
+        queryset = self.model.objects.filter(pk__in=pks)
+        # columns of related objects (e.g. 'category__name') are read with a join
+        relations = {column.split("__")[0] for column in columns if "__" in column}
+        if relations:
+            queryset = queryset.select_related(*relations)
+        return list(queryset.only('pk', *columns, *relations).order_by('pk'))
+
+    def model_fields(self, name):
+        model_field = self.fields[name]
+        return [] if model_field is None else [model_field]
+
+    def serialize(self, objects, fields, request):
+        return [{name: self.value(obj, name, request) for name in fields} for obj in objects]
+
+    def value(self, obj, name, request):
+        # foreign keys are returned as the primary keys of the related objects (their 'attname')
+        return getattr(obj, self.model._meta.get_field(self.fields[name]).attname)
+
+
+class ItemResource(Resource):
+    model = Item
+    fields = {
+        "id": "id",
+        "sku": "sku",
+        "name": "name",
+        "form": "form",
+        "price": "price",
+        "price_sale": "price_sale",
+        "effective_price": "effective_price",
+        "in_stock": "in_stock",
+        "net_weight": "net_weight",
+        "composition": "composition",
+        "description": "description",
+        "manufacturer": "manufacturer",
+        "subcategories": None,
+        "image_url": "image",
+        "updated_at": "updated_at",
+    }
+
+    def filter(self, queryset, params):
+        if params.get("subcategory"):
+            # a subquery rather than a join - an item in several of the subcategories is listed once
+            links = ItemSubCategory.objects.filter(subcategory__in=parse_ids(params["subcategory"], "subcategory"))
+            queryset = queryset.filter(pk__in=links.values('item'))
+        if params.get("manufacturer"):
+            queryset = queryset.filter(manufacturer__in=parse_ids(params["manufacturer"], "manufacturer"))
+        return queryset
+
+    def stamp_queryset(self):
+        return Item.objects.only('pk', 'updated_at')
+
+    def stamps(self, objects):
+        # every change of an item (its stock, subcategories and manufacturer included) bumps its updated_at
+        return ([(item.pk, item.updated_at.isoformat()) for item in objects],
+                max(item.updated_at for item in objects).timestamp())
+
+    def fetch(self, pks, fields):
+        items = super().fetch(pks, fields)
+        if "subcategories" in fields:
+            # one query for the links of all items (prefetch_related() would read the subcategory rows as well)
+            subcategories = {item.pk: [] for item in items}
+            for item_pk, subcategory_pk in (ItemSubCategory.objects.filter(item__in=pks)
+                                            .order_by('item', 'subcategory').values_list('item', 'subcategory')):
+                subcategories[item_pk].append(subcategory_pk)
+            for item in items:
+                item.subcategory_pks = subcategories[item.pk]
+        return items
+
+    def value(self, item, name, request):
+        if name == "subcategories":
+            return item.subcategory_pks
+        if name == "image_url":
+            return request.build_absolute_uri(item.image.url) if item.image else None
+        return super().value(item, name, request)
+
+
+class SubCategoryResource(Resource):
+    model = SubCategory
+    fields = {
+        "id": "id",
+        "name": "name",
+        "category": "category",
+        "category_name": None,
+    }
+
+    def filter(self, queryset, params):
+        if params.get("category"):
+            queryset = queryset.filter(category__in=parse_ids(params["category"], "category"))
+        return queryset
+
+    def model_fields(self, name):
+        return ["category__name"] if name == "category_name" else super().model_fields(name)
+
+    def value(self, subcategory, name, request):
+        if name == "category_name":
+            return subcategory.category.name
+        return super().value(subcategory, name, request)
+
+
+class ManufacturerResource(Resource):
+    model = Manufacturer
+    fields = {
+        "id": "id",
+        "name": "name",
+    }
+
+
+@method_decorator(read_from_replicas, name='dispatch')
+class ApiView(View):
+    """
+    GET of a resource list (paginated or fetched by ids) or of a single object, with conditional GET.
+    """
+    resource = None
+
+    def get(self, request, pk=None):
+        try:
+            fields = self.resource.parse_fields(request.GET.get("fields"))
+            if pk is not None:
+                objects = list(self.resource.stamp_queryset().filter(pk=pk))
+                if not objects:
+                    return api_error("Nie znaleziono.", status=404)
+                page = None
+            elif request.GET.get("ids"):
+                ids = parse_ids(request.GET["ids"], "ids", limit=settings.API_MAX_IDS)
+                objects = list(self.resource.stamp_queryset().filter(pk__in=ids).order_by('pk'))
+                page = None
+            else:
+                limit = parse_int(request.GET.get("limit"), "limit", settings.API_PAGE_SIZE, settings.API_MAX_PAGE_SIZE)
+                queryset = self.resource.filter(self.resource.stamp_queryset(), request.GET)
+                page = KeysetPaginator(queryset, 'pk', limit, name=self.resource.model._meta.model_name).page(
+                    request.GET.get("cursor"))
+                objects = page.object_list
+        except ApiError as error:
+            return api_error(str(error), status=error.status)
+
+        etag, last_modified = self.conditional_headers(request, objects, page, single=pk is not None)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            results = self.resource.serialize(self.resource.fetch([obj.pk for obj in objects], fields), fields,
+                                              request)
+            if pk is not None:
+                data = results[0]
+            elif page is None:
+                data = {"results": results}
+            else:
+                data = {"results": results, "next": self.page_url(request, page.next_cursor),
+                        "previous": self.page_url(request, page.previous_cursor)}
+            response = JsonResponse(data)
+        response.headers["ETag"] = etag
+        response.headers["Last-Modified"] = http_date(last_modified)
+        return response
+
+    def conditional_headers(self, request, objects, page=None, single=False):
+        """
+        :return: tuple(ETag, Last-Modified timestamp) of the response
+        """
+        # e.g. an empty list changes when objects are added
+        material, last_modified = self.resource.stamps(objects) if objects else (get_catalog_version(), None)
+        if not single or last_modified is None:
+            last_modified = get_catalog_version() / 1e9
+        # the representation depends on the query (fields, ids, cursor) and the links to the other pages
+        if page is not None:
+            material = [material, page.next_cursor, page.previous_cursor]
+        digest = hashlib.md5(f"{request.get_full_path()}|{material}".encode(), usedforsecurity=False).hexdigest()
+        # HTTP dates have a resolution of seconds
+        return quote_etag(digest), int(last_modified)
+
+    @staticmethod
+    def page_url(request, cursor):
+        if cursor is None:
+            return None
+        params = request.GET.copy()
+        params["cursor"] = cursor
+        return request.build_absolute_uri(f"{request.path}?{params.urlencode()}")
+
+
+class ItemApiView(ApiView):
+    resource = ItemResource()
+
+
+class SubCategoryApiView(ApiView):
+    resource = SubCategoryResource()
+
+
+class ManufacturerApiView(ApiView):
+    resource = ManufacturerResource()
@@ -0,0 +1,39 @@
+"""
+Async variants of the catalog read views for serving the shop with an ASGI server (see OnlinePharmacy/asgi.py).
+
+Django 3.2 has no async ORM, so an async view cannot query the database on the event loop. Under ASGI Django runs
+every sync view in one shared thread ('thread sensitive' mode), so a slow query or render of one request holds up
+all the others. The async variants run the whole sync view - its queries and the template rendering - in a single
+hop to the thread pool of asyncio instead, so catalog requests are handled in parallel, while waiting for slow
+clients costs the event loop nothing.
+"""
+import functools
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+
+def async_catalog_view(view):
+    """
+    :param view: sync view function, e.g. SomeView.as_view()
+    :return: async view function running 'view' in one thread pool hop
+    """
+
+    def run(request, *args, **kwargs):
+        # connections belong to the pool thread - they are not closed by the request_finished signal
+        # sent in another thread, so they are recycled here
+        close_old_connections()
+        try:
+            response = view(request, *args, **kwargs)
+            # lazy template responses would be rendered by the handler in the shared sync thread
+            if hasattr(response, "render") and callable(response.render):
+                response = response.render()
+            return response
+        finally:
+            close_old_connections()
+
+    @functools.wraps(view)
+    async def async_view(request, *args, **kwargs):
+        return await sync_to_async(run, thread_sensitive=False)(request, *args, **kwargs)
+
+    return async_view
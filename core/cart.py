@@ -0,0 +1,208 @@
+import logging
+import time
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .jobs import enqueue, job
+from .models import Cart, CartItem, Job
+from .transactions import immediate_atomic
+
+# the resolved cart id is cached in the session, so carts are fetched by primary key
+CART_SESSION_KEY = "cart_id"
+
+# session engines keeping the sessions in the django_session table
+DATABASE_SESSION_ENGINES = ["django.contrib.sessions.backends.db", "django.contrib.sessions.backends.cached_db"]
+
+
+def get_cart(request):
+    """
+    Helper function for retrieving the cart of the current visitor without writing anything.
+    Read-only requests (e.g. viewing an empty cart) never create a session nor a Cart instance.
+    The result is memoized on the request.
+    :return: Cart instance or None if the visitor has no cart yet
+    """
+    if not hasattr(request, "_cart"):
+        request._cart = _resolve_cart(request)
+    return request._cart
+
+
+def get_or_create_cart(request):
+    """
+    Helper function for retrieving an existing Cart instance or creating a new one (for requests that modify the cart).
+    Rows are only written when the cart is created - the anonymous cart is merged into the user's cart once,
+    on login (see merge_session_cart()).
+    :return: tuple(cart: Cart instance, created: boolean flag - True if new cart was created else False)
+    """
+    cart = get_cart(request)
+    if cart is not None:
+        return cart, False
+
+    user = request.user
+    if request.session.session_key is None:
+        # if session_key is None then session is not in database -> create new session and retrieve new session_key
+        request.session.create()
+    session_key = request.session.session_key
+
+    if user.is_authenticated:
+        try:
+            with transaction.atomic():
+                cart = Cart.objects.create(user=user, session=session_key)
+        except IntegrityError:
+            # created meanwhile by a concurrent request of the user (Cart.user is one-to-one)
+            cart = Cart.objects.get(user=user)
+            request.session[CART_SESSION_KEY] = cart.pk
+            request._cart = cart
+            return cart, False
+    else:
+        cart = Cart.objects.create(session=session_key)
+    request.session[CART_SESSION_KEY] = cart.pk
+    request._cart = cart
+
+    if settings.DEBUG:
+        logging.debug("Cart created - session_id: " + session_key)
+
+    return cart, True
+
+
+def merge_session_cart(request, user):
+    """
+    Merge the anonymous cart of the session into the cart of the user who has just logged in (called once,
+    on the user_logged_in signal): lines are added up with a single upsert capped by the stock and the anonymous
+    cart is deleted. A user without a cart simply takes over the anonymous cart.
+    The id of the resulting cart is cached in the session, so the cart reads of the user write nothing.
+    """
+    session = request.session
+    cart_id = session.get(CART_SESSION_KEY)
+    session_cart = Cart.objects.filter(pk=cart_id, user__isnull=True).first() if cart_id is not None else None
+
+    with immediate_atomic():
+        user_cart = Cart.objects.filter(user=user).first()
+        if session_cart is not None:
+            if user_cart is None:
+                # conditional - the cart may have been merged meanwhile by a concurrent login of the same session
+                if Cart.objects.filter(pk=session_cart.pk, user__isnull=True).update(user=user,
+                                                                                      updated_at=timezone.now()):
+                    session_cart.user = user
+                    user_cart = session_cart
+            else:
+                CartItem.objects.merge_carts(session_cart.pk, user_cart.pk)
+                Cart.objects.filter(pk=user_cart.pk).update(updated_at=timezone.now())
+                session_cart.delete()
+
+    if user_cart is not None:
+        session[CART_SESSION_KEY] = user_cart.pk
+    else:
+        session.pop(CART_SESSION_KEY, None)
+    # the cart memoized on the request (if any) was resolved for the anonymous visitor
+    request.__dict__.pop("_cart", None)
+
+    if settings.DEBUG and session_cart is not None:
+        logging.debug(f"Cart merged on login - cart_id: {session_cart.pk}")
+
+
+def _resolve_cart(request):
+    user = request.user
+    session = request.session
+
+    cart_id = session.get(CART_SESSION_KEY)
+    if cart_id is not None:
+        cart = Cart.objects.filter(pk=cart_id).first()
+        # anonymous carts are merged into the user's cart on login - the cart of a user is never rebound here
+        if cart is not None and cart.user_id == (user.pk if user.is_authenticated else None):
+            return cart
+
+    if user.is_authenticated:
+        cart = Cart.objects.filter(user=user).first()
+    elif session.session_key is not None:
+        # carts created before their id was cached in the session are looked up by the session key
+        cart = Cart.objects.filter(session=session.session_key, user__isnull=True).first()
+    else:
+        cart = None
+
+    if cart is not None and session.session_key is not None:
+        # cache the cart id - a session row already exists, so this is never a session creation
+        session[CART_SESSION_KEY] = cart.pk
+
+    if settings.DEBUG and cart is not None:
+        logging.debug(f"Cart fetched - cart_id: {cart.pk}")
+
+    return cart
+
+
+def delete_in_batches(queryset, batch_size, pause=0):
+    """
+    Delete the rows of the queryset in batches of at most 'batch_size' primary keys, each batch in a short
+    transaction of its own, so that the write lock is never held for long on a live database.
+    :param pause: seconds to sleep between the batches (lets the requests waiting for the lock in)
+    :return: iterator of the numbers of rows deleted by the batches
+    """
+    while True:
+        with immediate_atomic():
+            pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return
+            # rows of the related tables (e.g. cart lines) are deleted with the batch
+            queryset.model.objects.filter(pk__in=pks).delete()
+        yield len(pks)
+        if pause:
+            time.sleep(pause)
+
+
+def prune_expired_sessions(batch_size, pause=0):
+    """
+    Delete the expired sessions (in batches if they are kept in the database).
+    :return: iterator of the numbers of sessions deleted by the batches
+    """
+    if settings.SESSION_ENGINE not in DATABASE_SESSION_ENGINES:
+        # e.g. cache or cookie sessions expire by themselves
+        import_module(settings.SESSION_ENGINE).SessionStore.clear_expired()
+        return
+    yield from delete_in_batches(Session.objects.filter(expire_date__lt=timezone.now()), batch_size, pause)
+
+
+def abandoned_carts(max_age):
+    """
+    :param max_age: timedelta - anonymous carts not changed for longer are abandoned
+    :return: queryset of the anonymous carts not changed for longer than 'max_age' or without a session
+    (no visitor can reach those any more)
+    """
+    abandoned = Q(updated_at__lt=timezone.now() - max_age)
+    if settings.SESSION_ENGINE in DATABASE_SESSION_ENGINES:
+        abandoned |= ~Exists(Session.objects.filter(session_key=OuterRef('session')))
+    return Cart.objects.filter(abandoned, user__isnull=True)
+
+
+def prune_abandoned_carts(max_age, batch_size, pause=0):
+    """
+    Delete the abandoned anonymous carts (see abandoned_carts()) with their lines.
+    :return: iterator of the numbers of carts deleted by the batches
+    """
+    yield from delete_in_batches(abandoned_carts(max_age), batch_size, pause)
+
+
+@job
+def prune_carts():
+    """
+    Background counterpart of the 'prune_carts' command, running every CART_PRUNE_INTERVAL seconds once scheduled
+    (see schedule_cart_pruning()).
+    """
+    n_sessions = sum(prune_expired_sessions(settings.CART_PRUNE_BATCH_SIZE))
+    n_carts = sum(prune_abandoned_carts(timedelta(days=settings.CART_MAX_AGE_DAYS), settings.CART_PRUNE_BATCH_SIZE))
+    logging.info(f"Pruned {n_sessions} expired sessions and {n_carts} abandoned carts")
+    schedule_cart_pruning(delay=settings.CART_PRUNE_INTERVAL)
+
+
+def schedule_cart_pruning(delay=0):
+    """
+    Queue a run of the prune_carts job unless one is already queued.
+    :return: created Job or None
+    """
+    if Job.objects.filter(name=prune_carts.job_name, status=Job.QUEUED).exists():
+        return None
+    return enqueue(prune_carts, delay=delay)
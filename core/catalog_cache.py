@@ -0,0 +1,73 @@
+"""
+Rendered catalog fragments (product grids, item details) cached under a catalog version stamp.
+
+Every change of the catalog - items (including their stock and image variants), subcategories, categories and
+manufacturers - bumps the stamp once the change is committed, so all fragments rendered before it are never used
+again (and simply expire). Fragments hold no user-specific content: the navbar, messages and CSRF tokens stay outside
+of them (see the {% catalog_cache %} tag in core.templatetags.catalog_fragments).
+
+Like the navbar category tree the stamp lives in the default cache, so with several worker processes the cache
+backend must be shared by all of them.
+"""
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db import transaction
+
+from .routers import reading_from_replica
+
+CATALOG_VERSION_CACHE_KEY = "core:catalog_version"
+
+
+def get_catalog_version():
+    """
+    :return: the stamp - time (in nanoseconds) of the last change of the catalog (or of the first read of the stamp)
+    """
+    version = cache.get(CATALOG_VERSION_CACHE_KEY)
+    if version is None:
+        # a time rather than a counter, so that a stamp evicted from the cache never comes back with a value
+        # fragments were already cached under
+        cache.add(CATALOG_VERSION_CACHE_KEY, time.time_ns(), None)
+        version = cache.get(CATALOG_VERSION_CACHE_KEY)
+    return version
+
+
+def bump_catalog_version():
+    cache.set(CATALOG_VERSION_CACHE_KEY, time.time_ns(), None)
+
+
+def catalog_changed(using=None):
+    """
+    Invalidate the cached fragments once the current transaction commits (right away outside of transactions) -
+    a fragment rendered from the uncommitted data would be cached under the old stamp.
+    """
+    transaction.on_commit(bump_catalog_version, using=using)
+
+
+def get_or_render_fragment(fragment_name, vary_on, render):
+    """
+    :param render: function returning the fragment's HTML, called on a cache miss
+    :return: HTML of the fragment
+    """
+    version = get_catalog_version()
+    key = make_template_fragment_key(fragment_name, [version, *vary_on])
+    content = cache.get(key)
+    if content is None:
+        content = render()
+        cache.set(key, content, fragment_timeout(version))
+    return content
+
+
+def fragment_timeout(version):
+    """
+    A replica may not have caught up with the last change yet - fragments it renders shortly after the change
+    are kept only until it surely has (for DATABASE_REPLICA_STICKY_SECONDS since the change).
+    """
+    if reading_from_replica():
+        changed_ago = time.time() - version / 1e9
+        if changed_ago < settings.DATABASE_REPLICA_STICKY_SECONDS:
+            return max(math.ceil(settings.DATABASE_REPLICA_STICKY_SECONDS - changed_ago), 1)
+    return settings.CATALOG_CACHE_TIMEOUT
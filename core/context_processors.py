@@ -1,8 +1,53 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch
+
 from .models import *
+from .routers import primary_reads
+
+CATEGORY_TREE_CACHE_KEY = "core:category_tree"
+
+
+def build_category_tree():
+    """
+    Build the navbar category tree with a single prefetch query per level.
+    :return: list of dicts {"pk", "name", "subcategories": [{"pk", "name"}, ...]}
+             ordered as in settings.NAVBAR_CATEGORIES
+    """
+    category_names = list(settings.NAVBAR_CATEGORIES)
+    categories = Category.objects.filter(name__in=category_names).prefetch_related(
+        Prefetch("subcategory_set", queryset=SubCategory.objects.order_by("pk"))
+    )
+
+    tree_by_name = {
+        category.name: {
+            "pk": category.pk,
+            "name": category.name,
+            "subcategories": [{"pk": subcategory.pk, "name": subcategory.name}
+                              for subcategory in category.subcategory_set.all()]
+        }
+        for category in categories
+    }
+    # categories missing from the database are skipped instead of breaking every page render
+    return [tree_by_name[name] for name in category_names if name in tree_by_name]
+
+
+def get_category_tree():
+    """
+    Retrieve the navbar category tree from the cache, building it on a cache miss.
+    """
+    tree = cache.get(CATEGORY_TREE_CACHE_KEY)
+    if tree is None:
+        # never from a replica - a tree built from one that has not caught up would stay cached
+        with primary_reads():
+            tree = build_category_tree()
+        cache.set(CATEGORY_TREE_CACHE_KEY, tree, settings.CATEGORY_TREE_CACHE_TIMEOUT)
+    return tree
+
+
+def invalidate_category_tree():
+    cache.delete(CATEGORY_TREE_CACHE_KEY)
 
 
 def categories_context(request):
-    categories = [Category.objects.get(name="Zdrowie"),
-                  Category.objects.get(name="Higiena"),
-                  Category.objects.get(name="Pielęgnacja")]
-    return {"categories": categories}
+    return {"categories": get_category_tree()}
@@ -0,0 +1,207 @@
+"""
+Product feeds (CSV, XML) of the catalog for price comparison sites.
+
+The 'export_feeds' command (run periodically, e.g. from cron) writes the feeds to files in settings.FEED_ROOT,
+which ProductFeedView serves with conditional GET. Items are rendered in chunks of FEED_CHUNK_SIZE consecutive
+primary keys, each kept in a file of its own. An export renders again only the chunks whose number of items or
+latest Item.updated_at has changed since the previous export and concatenates the chunk files into the feed.
+Items, their subcategories and manufacturers bump 'updated_at' when they change; renaming a category or
+a subcategory does not - export the feeds with --full then.
+"""
+import csv
+import io
+import json
+import os
+from urllib.parse import urljoin
+from xml.sax.saxutils import escape, quoteattr
+
+from django.conf import settings
+from django.db.models import Count, ExpressionWrapper, F, IntegerField, Max
+from django.urls import reverse
+
+from .models import Item, ItemSubCategory, SubCategory
+
+FEED_FILE_NAME = "products.{}"
+MANIFEST_FILE_NAME = "manifest.json"
+
+COLUMNS = ["id", "sku", "name", "manufacturer", "category", "price", "regular_price", "availability", "stock",
+           "url", "image_url"]
+
+
+class CsvFeed:
+    name = "csv"
+    content_type = "text/csv; charset=utf-8"
+
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def write_row(self, row):
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.writer.writerow(row)
+        return self.buffer.getvalue()
+
+    def header(self):
+        return self.write_row(COLUMNS)
+
+    def footer(self):
+        return ""
+
+    def render(self, entry):
+        return self.write_row(entry[column] for column in COLUMNS)
+
+
+class XmlFeed:
+    name = "xml"
+    content_type = "application/xml; charset=utf-8"
+
+    def header(self):
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<offers>\n'
+
+    def footer(self):
+        return "</offers>\n"
+
+    def render(self, entry):
+        elements = "".join(f"<{column}>{escape(str(entry[column]))}</{column}>" for column in COLUMNS[1:])
+        return f"<offer id={quoteattr(str(entry['id']))}>{elements}</offer>\n"
+
+
+FEED_FORMATS = {feed.name: feed for feed in (CsvFeed, XmlFeed)}
+
+
+def get_feed(name):
+    """
+    :return: a new feed renderer of the given format or None if there is no such format
+    """
+    feed_class = FEED_FORMATS.get(name)
+    return feed_class() if feed_class is not None else None
+
+
+def item_entry(item, category):
+    return {
+        "id": item.pk,
+        "sku": item.sku or "",
+        "name": item.name,
+        "manufacturer": item.manufacturer.name,
+        "category": category,
+        "price": item.effective_price,
+        "regular_price": item.price,
+        "availability": "in stock" if item.in_stock > 0 else "out of stock",
+        "stock": item.in_stock,
+        "url": urljoin(settings.FEED_BASE_URL, reverse("core:detail", kwargs={"pk": item.pk})),
+        "image_url": urljoin(settings.FEED_BASE_URL, item.image.url) if item.image else "",
+    }
+
+
+def chunk_signatures():
+    """
+    :return: dict mapping indexes of the chunks holding any items to their [number of items, latest change]
+    """
+    chunks = (Item.objects
+              .annotate(chunk=ExpressionWrapper(F('pk') / settings.FEED_CHUNK_SIZE, output_field=IntegerField()))
+              .values('chunk').order_by('chunk')
+              .annotate(n_items=Count('pk'), updated_at=Max('updated_at')))
+    return {str(chunk['chunk']): [chunk['n_items'], chunk['updated_at'].isoformat()] for chunk in chunks}
+
+
+def render_chunk(feed, chunk, category_names):
+    """
+    :param category_names: dict mapping subcategory primary keys to their full names
+    :return: iterator of the rendered items of the chunk
+    """
+    first_pk = int(chunk) * settings.FEED_CHUNK_SIZE
+    last_pk = first_pk + settings.FEED_CHUNK_SIZE - 1
+    # the first subcategory of every item - prefetch_related() does not work with iterator()
+    categories = {}
+    links = (ItemSubCategory.objects.filter(item__gte=first_pk, item__lte=last_pk)
+             .order_by('item', 'subcategory').values_list('item', 'subcategory'))
+    for item_pk, subcategory_pk in links:
+        categories.setdefault(item_pk, category_names[subcategory_pk])
+
+    items = (Item.objects.filter(pk__gte=first_pk, pk__lte=last_pk).select_related('manufacturer').order_by('pk')
+             .iterator(chunk_size=settings.FEED_CHUNK_SIZE))
+    for item in items:
+        yield feed.render(item_entry(item, categories.get(item.pk, "")))
+
+
+def get_category_names():
+    return {subcategory.pk: str(subcategory) for subcategory in SubCategory.objects.select_related('category')}
+
+
+def stream_feed(feed):
+    """
+    Render the whole feed straight from the database (without the exported files).
+    :return: iterator of the parts of the feed
+    """
+    yield feed.header()
+    category_names = get_category_names()
+    for chunk in chunk_signatures():
+        yield from render_chunk(feed, chunk, category_names)
+    yield feed.footer()
+
+
+def feed_path(feed):
+    return os.path.join(settings.FEED_ROOT, FEED_FILE_NAME.format(feed.name))
+
+
+def export_feed(feed, full=False):
+    """
+    Bring the exported feed file up to date, rendering only the changed chunks (all of them if 'full').
+    :return: (number of rendered chunks, number of chunks)
+    """
+    directory = os.path.join(settings.FEED_ROOT, feed.name)
+    manifest_path = os.path.join(directory, MANIFEST_FILE_NAME)
+    os.makedirs(directory, exist_ok=True)
+    manifest = {}
+    if not full and os.path.exists(manifest_path) and os.path.exists(feed_path(feed)):
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+
+    signatures = chunk_signatures()
+    changed = [chunk for chunk, signature in signatures.items() if manifest.get(chunk) != signature]
+    if not changed and manifest.keys() == signatures.keys():
+        # the file stays untouched, so do its ETag and Last-Modified
+        return 0, len(signatures)
+
+    category_names = get_category_names()
+    for chunk in changed:
+        write_file(chunk_path(directory, chunk), render_chunk(feed, chunk, category_names))
+    for file_name in os.listdir(directory):
+        chunk, extension = os.path.splitext(file_name)
+        if extension == ".part" and chunk not in signatures:
+            os.remove(os.path.join(directory, file_name))
+
+    def feed_parts():
+        yield feed.header()
+        for chunk in sorted(signatures, key=int):
+            with open(chunk_path(directory, chunk), encoding="utf-8") as chunk_file:
+                yield from iter(lambda: chunk_file.read(64 * 1024), "")
+        yield feed.footer()
+
+    write_file(feed_path(feed), feed_parts())
+    write_file(manifest_path, [json.dumps(signatures)])
+    return len(changed), len(signatures)
+
+
+def chunk_path(directory, chunk):
+    return os.path.join(directory, f"{chunk}.part")
+
+
+def feed_etag(path):
+    """
+    :return: ETag of the exported feed file (changes whenever the file is replaced)
+    """
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def write_file(path, parts):
+    """
+    Write the file atomically - the feed being served is replaced only once the new one is complete.
+    """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8", newline="") as file:
+        for part in parts:
+            file.write(part)
+    os.replace(temporary_path, path)
@@ -7,6 +7,11 @@ class AddItemToCartForm(forms.Form):
     n_pieces = forms.IntegerField(min_value=1, max_value=99, initial=1)
 
 
+class CartItemQuantityForm(forms.Form):
+    # 0 removes the item from the cart
+    n_pieces = forms.IntegerField(min_value=0, max_value=99)
+
+
 class AddressForm(forms.ModelForm):
     class Meta:
         model = Address
@@ -80,4 +85,16 @@ class OrderMethodsForm(NoLabelsModelForm):
         labels = {
             "delivery_method": "Sposób dostawy",
             "payment_method": "Metoda płatności"
-        }
\ No newline at end of file
+        }
+
+
+class SalesReportForm(forms.Form):
+    # the report covers the days from 'start' to 'end' (inclusive)
+    start = forms.DateField(label="Od", widget=forms.DateInput(attrs={'type': 'date'}))
+    end = forms.DateField(label="Do", widget=forms.DateInput(attrs={'type': 'date'}))
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('start') and cleaned_data.get('end') and cleaned_data['start'] > cleaned_data['end']:
+            raise forms.ValidationError("Data początkowa nie może być późniejsza niż końcowa.")
+        return cleaned_data
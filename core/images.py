@@ -0,0 +1,142 @@
+"""
+Resized variants of uploaded item images.
+
+Every image gets WebP and JPEG copies at the widths in VARIANT_WIDTHS (never upscaled), stored next to the original
+in a 'variants' directory: 'core/images/items/apap.png' -> 'core/images/items/variants/apap_png-250.webp' etc.
+Variant names are derived from the original name (its extension included) and width, so nothing but the original's dimensions
+(Item.image_width/image_height - filled in once the variants are written) has to be stored in the database.
+
+Resizing is CPU bound, so it runs in a pool of worker processes. The worker function only deals with file system
+paths and never touches Django, which keeps it cheap to send to the workers.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# tile: 250px wide grid tiles (plus 500px for 2x screens), detail: ~400px wide product picture (plus 800px for 2x)
+VARIANT_WIDTHS = (250, 400, 500, 800)
+VARIANT_FORMATS = {"webp": ("WEBP", {"quality": 80, "method": 4}),
+                   "jpg": ("JPEG", {"quality": 82, "optimize": True, "progressive": True})}
+VARIANTS_DIR = "variants"
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif")
+
+_executor = None
+
+
+def variant_widths(image_width):
+    """
+    Widths of the variants generated for an image 'image_width' pixels wide (images are never upscaled).
+    """
+    return sorted({min(width, image_width) for width in VARIANT_WIDTHS})
+
+
+def variant_name(name, width, extension):
+    """
+    Storage name (or file system path) of the variant of the image 'name'.
+    """
+    directory, filename = os.path.split(name)
+    stem, source_extension = os.path.splitext(filename)
+    # the extension of the original is kept - variants of 'apap.png' and 'apap.jpg' must not overwrite each other
+    return os.path.join(directory, VARIANTS_DIR, f"{stem}_{source_extension[1:]}-{width}.{extension}")
+
+
+def variants_up_to_date(source_path, image_width):
+    source_mtime = os.path.getmtime(source_path)
+    for width in variant_widths(image_width):
+        for extension in VARIANT_FORMATS:
+            path = variant_name(source_path, width, extension)
+            if not os.path.exists(path) or os.path.getmtime(path) < source_mtime:
+                return False
+    return True
+
+
+def render_variants(source_path, force=False):
+    """
+    Write the variants of the image at 'source_path' (runs in the worker processes).
+    Variants newer than the original are kept unless 'force' is set.
+    :return: tuple(width, height) of the original image
+    """
+    with Image.open(source_path) as image:
+        size = image.size
+        if not force and variants_up_to_date(source_path, size[0]):
+            return size
+
+        os.makedirs(os.path.join(os.path.dirname(source_path), VARIANTS_DIR), exist_ok=True)
+        # let the JPEG decoder downscale while decoding - much cheaper for large photos
+        image.draft("RGB", (max(VARIANT_WIDTHS), size[1] * max(VARIANT_WIDTHS) // size[0]))
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        if has_alpha:
+            # JPEG has no transparency - transparent backgrounds of product pictures become white
+            flattened = Image.new("RGB", image.size, (255, 255, 255))
+            flattened.paste(image, mask=image.getchannel("A"))
+        else:
+            flattened = image
+
+        for width in variant_widths(size[0]):
+            height = max(round(size[1] * width / size[0]), 1)
+            for extension, (image_format, options) in VARIANT_FORMATS.items():
+                source = image if image_format == "WEBP" else flattened
+                resized = source.resize((width, height), Image.LANCZOS) if source.size != (width, height) else source
+                path = variant_name(source_path, width, extension)
+                # write to a temporary file and swap it in, so a half-written variant is never served
+                temporary_path = f"{path}.{os.getpid()}.tmp"
+                resized.save(temporary_path, image_format, **options)
+                os.replace(temporary_path, path)
+    return size
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=settings.IMAGE_VARIANT_WORKERS)
+    return _executor
+
+
+def store_dimensions(item_model, name, size):
+    """
+    Mark the variants of the image 'name' as ready by saving the image's dimensions on the items using it.
+    """
+    width, height = size
+    item_model.objects.filter(image=name).update(image_width=width, image_height=height)
+
+
+def generate_variants(item_model, name):
+    """
+    Generate the variants of the uploaded image 'name' - in the worker processes or, if IMAGE_VARIANTS_ASYNC
+    is disabled (e.g. in tests), right away.
+    """
+    source_path = default_storage.path(name)
+    if not settings.IMAGE_VARIANTS_ASYNC:
+        store_dimensions(item_model, name, render_variants(source_path, force=True))
+        return
+
+    submitting_thread = threading.get_ident()
+
+    def done(future):
+        try:
+            store_dimensions(item_model, name, future.result())
+        except Exception:
+            logger.exception("Generating variants of %s failed", name)
+        finally:
+            # the callback normally runs in a thread of the pool, which has opened its own database connection
+            if threading.get_ident() != submitting_thread:
+                connections.close_all()
+
+    get_executor().submit(render_variants, source_path, True).add_done_callback(done)
+
+
+def schedule_variants(item_model, name):
+    """
+    Generate the variants of 'name' once the current transaction commits, so that the dimensions
+    are stored on a committed item.
+    """
+    transaction.on_commit(lambda: generate_variants(item_model, name))
@@ -0,0 +1,178 @@
+"""
+Background jobs kept in the database (the Job table) - no message broker is needed.
+
+Job functions are registered with the @job decorator; enqueue() inserts a job into the current transaction, so the job
+of e.g. a checkout exists only if the checkout commits, and no worker can see it before. The 'run_workers' command
+runs the jobs in a pool of worker processes and threads.
+
+A worker claims a job with a conditional UPDATE in a transaction taking the SQLite write lock right away (see
+core.transactions), so every job is run by a single worker; a job whose worker was killed is claimed again after
+JOB_LOCK_TIMEOUT. A failing job is retried with exponential backoff up to Job.max_attempts times, then it stays
+in the table as a dead job (dead letter) to be inspected and requeued in the admin. Since a job may run more than
+once (e.g. when its worker dies right after finishing it), job functions should be idempotent.
+"""
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, connection
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+from .transactions import immediate_atomic, is_lock_error, retry_on_lock
+
+logger = logging.getLogger(__name__)
+
+# job name -> job function
+_registry = {}
+
+
+def job(func):
+    """
+    Register the function as a job (under its module and name), e.g.:
+        @job
+        def send_order_confirmation(order_pk): ...
+        enqueue(send_order_confirmation, order_pk=order.pk)
+    """
+    func.job_name = f"{func.__module__}.{func.__qualname__}"
+    _registry[func.job_name] = func
+    return func
+
+
+def enqueue(func, delay=0, max_attempts=None, **kwargs):
+    """
+    Queue a run of the job function with the given (JSON serializable) keyword arguments.
+    :param delay: seconds to wait before running the job
+    :return: created Job
+    """
+    if getattr(func, "job_name", None) not in _registry:
+        raise ValueError(f"{func} is not a registered job - decorate it with @job")
+    return Job.objects.create(name=func.job_name, payload=kwargs, run_at=timezone.now() + timedelta(seconds=delay),
+                              max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS)
+
+
+def retry_delay(attempts):
+    """
+    :return: seconds to wait before the next attempt of a job that has failed 'attempts' times
+    """
+    delay = min(settings.JOB_RETRY_BASE_DELAY * 2 ** (attempts - 1), settings.JOB_RETRY_MAX_DELAY)
+    # jitter - jobs failing together (e.g. when the mail server is down) are not all retried at once
+    return delay * random.uniform(0.5, 1.5)
+
+
+@retry_on_lock
+def claim_job(worker_id):
+    """
+    :return: the earliest runnable job, locked by the worker, or None if there are none
+    """
+    now = timezone.now()
+    with immediate_atomic():
+        job = Job.objects.runnable(now).order_by('run_at').first()
+        if job is None:
+            return None
+        # conditional - without BEGIN IMMEDIATE (e.g. on other databases) another worker may have claimed it
+        claimed = Job.objects.filter(pk=job.pk, attempts=job.attempts).update(
+            status=Job.RUNNING, locked_by=worker_id, locked_at=now, attempts=F('attempts') + 1)
+        if not claimed:
+            return None
+    job.status, job.locked_by, job.locked_at, job.attempts = Job.RUNNING, worker_id, now, job.attempts + 1
+    return job
+
+
+def run_job(job):
+    """
+    Run the claimed job, then delete it, or schedule its retry, or mark it as dead if it has failed too many times.
+    :return: True if the job succeeded
+    """
+    # the number of attempts identifies the claim - the job may have been claimed again if this run took too long
+    claim = Job.objects.filter(pk=job.pk, attempts=job.attempts)
+    try:
+        func = _registry.get(job.name)
+        if func is None:
+            raise LookupError(f"Unknown job {job.name}")
+        func(**job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            logger.error(f"Job {job} failed for the last time:\n{error}")
+            update_claim(claim, status=Job.DEAD, locked_at=None, last_error=error)
+        else:
+            delay = retry_delay(job.attempts)
+            logger.warning(f"Job {job} failed, retrying in {delay:.0f}s:\n{error}")
+            update_claim(claim, status=Job.QUEUED, locked_at=None, last_error=error,
+                         run_at=timezone.now() + timedelta(seconds=delay))
+        return False
+    delete_claim(claim)
+    return True
+
+
+@retry_on_lock
+def update_claim(claim, **changes):
+    claim.update(**changes)
+
+
+@retry_on_lock
+def delete_claim(claim):
+    claim.delete()
+
+
+def work(worker_id, stop, poll_interval, burst=False):
+    """
+    Worker loop - run jobs until 'stop' (threading.Event) is set or, with 'burst', until there are no runnable jobs.
+    :return: number of jobs run
+    """
+    n_run = 0
+    while not stop.is_set():
+        try:
+            job = claim_job(worker_id)
+        except OperationalError as error:
+            # busy_timeout passed (repeatedly) while a long transaction was writing - look again later
+            if not is_lock_error(error):
+                raise
+            stop.wait(poll_interval)
+            continue
+        if job is None:
+            if burst:
+                break
+            stop.wait(poll_interval)
+            continue
+        run_job(job)
+        n_run += 1
+        close_old_connections()
+    return n_run
+
+
+def make_worker_id(thread_index):
+    return f"{socket.gethostname()}:{os.getpid()}:{thread_index}"
+
+
+def run_worker_threads(n_threads, stop, poll_interval, burst=False):
+    """
+    Run 'n_threads' workers (the only one in the calling thread).
+    :return: number of jobs run
+    """
+    if n_threads == 1:
+        return work(make_worker_id(0), stop, poll_interval, burst)
+    results = [0] * n_threads
+
+    def run(index):
+        try:
+            results[index] = work(make_worker_id(index), stop, poll_interval, burst)
+        finally:
+            # every thread has a database connection of its own
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(index,), daemon=True) for index in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        # joined with a timeout, so that the main thread keeps handling signals
+        while thread.is_alive():
+            thread.join(0.5)
+    return sum(results)
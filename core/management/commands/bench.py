@@ -0,0 +1,227 @@
+import json
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from http.cookiejar import CookieJar
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core.metrics import QUERY_COUNT_HEADER
+from core.models import Item, SubCategory, Order
+
+SCENARIOS = ["index", "item_detail", "category_filter", "search", "add_to_cart", "add_to_cart_json", "checkout"]
+
+# words of the names generated by 'seed_shop'
+SEARCH_TERMS = ["apap", "vita", "magne", "derma", "forte", "plus", "junior", "complex"]
+
+CHECKOUT_FORM_DATA = dict(first_name="Jan", last_name="Nowak", phone_number="111222333", country="Poland",
+                          city="Warszawa", postal_code="12-345", street="Piastowa", street_number="5",
+                          delivery_method=Order.DHL, payment_method=Order.BLIK)
+
+
+class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """
+    Redirects are reported as responses - their targets are separate requests of the scenarios.
+    """
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class ShopClient:
+    """
+    HTTP client of one simulated visitor (own cookies, so own session and cart) recording every request.
+    """
+
+    def __init__(self, base_url, samples, rng, item_pks, subcategory_pks):
+        self.base_url = base_url.rstrip("/")
+        self.samples = samples
+        self.rng = rng
+        self.item_pks = item_pks
+        self.subcategory_pks = subcategory_pks
+        self.cookies = CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies),
+                                                  NoRedirectHandler())
+
+    def request(self, label, path, data=None):
+        """
+        :return: tuple(status code, body)
+        """
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body)
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                status, headers, content = response.status, response.headers, response.read()
+        except urllib.error.HTTPError as error:
+            status, headers, content = error.code, error.headers, error.read()
+        except OSError:
+            status, headers, content = 0, {}, b""
+        latency = time.perf_counter() - start
+        queries = headers.get(QUERY_COUNT_HEADER)
+        self.samples.append((label, start, latency, status, int(queries) if queries is not None else None))
+        return status, content
+
+    def csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == "csrftoken":
+                return cookie.value
+        return ""
+
+    def index(self):
+        self.request("index", "/")
+
+    def item_detail(self):
+        self.request("item_detail", f"/{self.rng.choice(self.item_pks)}/detail/")
+
+    def category_filter(self):
+        min_price = self.rng.randint(0, 60)
+        self.request("category_filter", f"/category/{self.rng.choice(self.subcategory_pks)}/"
+                                        f"?min-price={min_price}&max-price={min_price + 40}&order=price")
+
+    def search(self):
+        self.request("search", f"/search/?q={self.rng.choice(SEARCH_TERMS)}&page={self.rng.randint(1, 3)}")
+
+    def add_to_cart(self):
+        item_pk = self.rng.choice(self.item_pks)
+        # the detail page sets the CSRF cookie
+        self.request("item_detail", f"/{item_pk}/detail/")
+        self.request("add_to_cart", f"/{item_pk}/detail/",
+                     {"n_pieces": 1, "csrfmiddlewaretoken": self.csrf_token()})
+
+    def add_to_cart_json(self):
+        item_pk = self.rng.choice(self.item_pks)
+        self.request("item_detail", f"/{item_pk}/detail/")
+        self.request("add_to_cart_json", f"/cart/api/add/{item_pk}/",
+                     {"n_pieces": 1, "csrfmiddlewaretoken": self.csrf_token()})
+
+    def checkout(self):
+        self.add_to_cart()
+        self.request("checkout_page", "/checkout/")
+        self.request("checkout", "/checkout/", {**CHECKOUT_FORM_DATA, "csrfmiddlewaretoken": self.csrf_token()})
+
+
+def run_workers(config, process_index=0):
+    """
+    Run 'threads' visitors until the deadline (runs in the worker processes, so it does not use the database).
+    :return: list of samples - tuple(label, start time, latency, status, number of queries or None)
+    """
+    samples = []
+    deadline = time.perf_counter() + config["warmup"] + config["duration"]
+
+    def worker(thread_index):
+        rng = random.Random(f"{config['seed']}-{process_index}-{thread_index}")
+        client = ShopClient(config["url"], samples, rng, config["item_pks"], config["subcategory_pks"])
+        while time.perf_counter() < deadline:
+            getattr(client, rng.choice(config["scenarios"]))()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(config["threads"])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # time.perf_counter() is not comparable between processes - make the start times relative to the deadline
+    return [(label, start - deadline, latency, status, queries) for label, start, latency, status, queries in samples]
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of the sorted values.
+    """
+    return sorted_values[max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+def summarize(samples, duration):
+    latencies = sorted(sample[2] for sample in samples)
+    queries = [sample[4] for sample in samples if sample[4] is not None]
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for sample in samples if not 200 <= sample[3] < 400),
+        "throughput": round(len(samples) / duration, 2),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "queries_per_request": round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+class Command(BaseCommand):
+    help = ("Load-test a running shop (e.g. 'manage.py runserver' or gunicorn on the same database) with concurrent "
+            "visitors browsing, filtering, adding to the cart and checking out. Reports latency percentiles, "
+            "throughput and - if the server sets METRICS_QUERY_COUNT_HEADER - SQL queries per request, "
+            "and saves the results as JSON for comparing runs.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default="http://127.0.0.1:8000")
+        parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS,
+                            help="Scenarios picked at random by every visitor")
+        parser.add_argument('--threads', type=int, default=8, help="Concurrent visitors per process")
+        parser.add_argument('--processes', type=int, default=1,
+                            help="Client processes (more than one if a single process cannot saturate the server)")
+        parser.add_argument('--duration', type=float, default=20, help="Measured seconds")
+        parser.add_argument('--warmup', type=float, default=2, help="Seconds of not measured requests")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Path of the JSON results file")
+        parser.add_argument('--compare', help="JSON results file of a previous run to compare with")
+
+    def handle(self, *args, **options):
+        item_pks = list(Item.objects.filter(in_stock__gte=100).values_list('pk', flat=True))
+        subcategory_pks = list(SubCategory.objects.values_list('pk', flat=True))
+        if not item_pks or not subcategory_pks:
+            raise CommandError("No items to benchmark with - run 'manage.py seed_shop' first")
+
+        config = {key: options[key] for key in ("url", "scenarios", "threads", "processes", "duration", "warmup",
+                                                "seed")}
+        started_at = timezone.now()
+        worker_config = {**config, "item_pks": item_pks, "subcategory_pks": subcategory_pks}
+        if options['processes'] == 1:
+            samples = run_workers(worker_config)
+        else:
+            with ProcessPoolExecutor(max_workers=options['processes']) as executor:
+                futures = [executor.submit(run_workers, worker_config, i) for i in range(options['processes'])]
+                samples = [sample for future in futures for sample in future.result()]
+
+        # requests started during the warm-up are left out
+        measured = [sample for sample in samples if sample[1] >= -options['duration']]
+        if not measured:
+            raise CommandError("No requests were made - is the server running?")
+        labels = sorted({sample[0] for sample in measured})
+        results = {
+            "started_at": started_at.isoformat(),
+            "config": config,
+            "total": summarize(measured, options['duration']),
+            "requests": {label: summarize([sample for sample in measured if sample[0] == label], options['duration'])
+                         for label in labels},
+        }
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)
+        self.print_results(results, baseline)
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(results, output_file, indent=2)
+            self.stdout.write(f"Results saved to {options['output']}")
+
+    def print_results(self, results, baseline=None):
+        columns = ("requests", "errors", "throughput", "p50_ms", "p95_ms", "p99_ms", "queries_per_request")
+        self.stdout.write(f"{'':<16}" + "".join(f"{column:>21}" for column in columns))
+        rows = [("total", results["total"])] + list(results["requests"].items())
+        baseline_rows = dict([("total", baseline["total"])] + list(baseline["requests"].items())) if baseline else {}
+        for label, row in rows:
+            cells = []
+            for column in columns:
+                cell = "-" if row[column] is None else str(row[column])
+                previous = baseline_rows.get(label, {}).get(column)
+                if previous and row[column] is not None:
+                    cell += f" ({(row[column] - previous) / previous * 100:+.0f}%)"
+                cells.append(f"{cell:>21}")
+            self.stdout.write(f"{label:<16}" + "".join(cells))
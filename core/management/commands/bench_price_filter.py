@@ -0,0 +1,88 @@
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max, Q
+
+from core.models import *
+
+
+class RollbackBenchmark(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ("Compare the legacy OR-over-prices category filter with the indexed effective_price filter "
+            "on a synthetic catalog. All generated rows are rolled back when the benchmark finishes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=100000, help="Number of generated items")
+        parser.add_argument('--subcategories', type=int, default=20, help="Number of generated subcategories")
+        parser.add_argument('--repeat', type=int, default=50, help="Number of timed queries per variant")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        try:
+            with transaction.atomic():
+                subcategories = self.generate_catalog(rng, options['items'], options['subcategories'])
+                with connection.cursor() as cursor:
+                    cursor.execute("ANALYZE")
+                ranges = [(subcategory.pk, *sorted(rng.sample(range(0, 101), 2))) for subcategory in
+                          rng.choices(subcategories, k=options['repeat'])]
+
+                legacy = self.run("OR over price_sale/price", ranges, legacy_filter)
+                indexed = self.run("effective_price range", ranges, effective_price_filter)
+                self.stdout.write(f"speedup: {legacy / indexed:.1f}x")
+                raise RollbackBenchmark()
+        except RollbackBenchmark:
+            pass
+
+    def generate_catalog(self, rng, n_items, n_subcategories):
+        category = Category.objects.create(name="Benchmark")
+        manufacturer = Manufacturer.objects.create(name="Benchmark")
+        subcategories = [SubCategory.objects.create(category=category, name=f"Benchmark {i}")
+                         for i in range(n_subcategories)]
+
+        # SQLite does not return primary keys from bulk inserts - assign them upfront
+        first_pk = (Item.objects.aggregate(max_pk=Max('pk'))['max_pk'] or 0) + 1
+        items = []
+        for i in range(n_items):
+            price = Decimal(rng.randint(100, 15000)) / 100
+            price_sale = (price * Decimal("0.8")).quantize(Decimal("0.01")) if rng.random() < 0.3 else None
+            items.append(Item(pk=first_pk + i, name=f"Benchmark item {i}", form=Item.TABLETS, net_weight=10, price=price,
+                              price_sale=price_sale, manufacturer=manufacturer, in_stock=rng.randint(0, 100)))
+        items = Item.objects.bulk_create(items, batch_size=5000)
+
+        ItemSubCategory.objects.bulk_create([ItemSubCategory(item_id=item.pk, subcategory=rng.choice(subcategories),
+                                                             effective_price=item.effective_price)
+                                             for item in items], batch_size=5000)
+        self.stdout.write(f"generated {n_items} items in {n_subcategories} subcategories")
+        return subcategories
+
+    def run(self, label, ranges, build_queryset):
+        self.stdout.write(f"\n{label}:")
+        self.stdout.write(build_queryset(*ranges[0]).explain())
+        start = time.perf_counter()
+        for subcategory_pk, min_price, max_price in ranges:
+            list(build_queryset(subcategory_pk, min_price, max_price).values_list('pk', flat=True))
+        elapsed = (time.perf_counter() - start) / len(ranges)
+        self.stdout.write(f"{elapsed * 1000:.2f} ms per query")
+        return elapsed
+
+
+def legacy_filter(subcategory_pk, min_price, max_price):
+    return Item.objects.filter(
+        Q(subcategories=subcategory_pk) & (
+                Q(price_sale__isnull=False) & Q(price_sale__gte=min_price) & Q(price_sale__lte=max_price) |
+                Q(price_sale__isnull=True) & Q(price__gte=min_price) & Q(price__lte=max_price)
+        )
+    )
+
+
+def effective_price_filter(subcategory_pk, min_price, max_price):
+    return Item.objects.filter(itemsubcategory__subcategory=subcategory_pk,
+                               itemsubcategory__effective_price__gte=min_price,
+                               itemsubcategory__effective_price__lte=max_price)
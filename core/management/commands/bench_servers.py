@@ -0,0 +1,90 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from .bench import SCENARIOS
+
+# the catalog read paths served by core.async_views under ASGI
+CATALOG_SCENARIOS = ["index", "item_detail", "category_filter", "search"]
+
+SERVER_START_TIMEOUT = 30
+
+
+def server_command(kind, port, workers, threads):
+    """
+    :return: command line starting the WSGI (gunicorn) or ASGI (uvicorn) server of the shop
+    """
+    if kind == "wsgi":
+        return [sys.executable, "-m", "gunicorn", "OnlinePharmacy.wsgi", "--bind", f"127.0.0.1:{port}",
+                "--workers", str(workers), "--threads", str(threads), "--log-level", "warning"]
+    return [sys.executable, "-m", "uvicorn", "OnlinePharmacy.asgi:application", "--host", "127.0.0.1",
+            "--port", str(port), "--workers", str(workers), "--log-level", "warning", "--no-access-log"]
+
+
+def wait_for_port(port, process):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise CommandError(f"The server exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise CommandError(f"The server did not start listening on port {port} in {SERVER_START_TIMEOUT}s")
+
+
+class Command(BaseCommand):
+    help = ("Compare serving the shop with a WSGI server (gunicorn with threads, sync views) and an ASGI server "
+            "(uvicorn, async catalog views): start each server on the same database in turn, load-test it with "
+            "'bench' and report the ASGI results relative to the WSGI ones. Needs the optional 'gunicorn' and "
+            "'uvicorn' packages (pip install gunicorn uvicorn).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', nargs='+', choices=["wsgi", "asgi"], default=["wsgi", "asgi"])
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--workers', type=int, default=1, help="Server worker processes")
+        parser.add_argument('--server-threads', type=int, default=8, help="Threads of every WSGI worker")
+        parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=CATALOG_SCENARIOS)
+        parser.add_argument('--threads', type=int, default=32, help="Concurrent visitors per client process")
+        parser.add_argument('--processes', type=int, default=1, help="Client processes")
+        parser.add_argument('--duration', type=float, default=20, help="Measured seconds")
+        parser.add_argument('--warmup', type=float, default=3, help="Seconds of not measured requests")
+        parser.add_argument('--output-dir', help="Directory for the JSON results of the servers")
+
+    def handle(self, *args, **options):
+        for module, package in (("gunicorn", "wsgi"), ("uvicorn", "asgi")):
+            if package in options['servers'] and not self.is_installed(module):
+                raise CommandError(f"'{module}' is not installed - pip install {module}")
+
+        output_dir = options['output_dir'] or tempfile.mkdtemp(prefix="bench-servers-")
+        os.makedirs(output_dir, exist_ok=True)
+        previous_output = None
+        for kind in options['servers']:
+            output = os.path.join(output_dir, f"{kind}.json")
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{kind.upper()}"))
+            self.run_server_bench(kind, options, output, compare=previous_output)
+            previous_output = output
+
+    @staticmethod
+    def is_installed(module):
+        return subprocess.run([sys.executable, "-c", f"import {module}"], capture_output=True).returncode == 0
+
+    def run_server_bench(self, kind, options, output, compare=None):
+        env = dict(os.environ, METRICS_QUERY_COUNT_HEADER="True", ASYNC_CATALOG_VIEWS=str(kind == "asgi"))
+        process = subprocess.Popen(server_command(kind, options['port'], options['workers'],
+                                                  options['server_threads']), env=env)
+        try:
+            wait_for_port(options['port'], process)
+            call_command("bench", url=f"http://127.0.0.1:{options['port']}", scenarios=options['scenarios'],
+                         threads=options['threads'], processes=options['processes'], duration=options['duration'],
+                         warmup=options['warmup'], output=output, compare=compare, stdout=self.stdout)
+        finally:
+            process.terminate()
+            process.wait()
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import feeds
+
+
+class Command(BaseCommand):
+    help = ("Export the product feeds for price comparison sites (served at /feeds/products.<format>). Only items "
+            "changed since the previous export are rendered again - see core.feeds. Meant to be run periodically.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--formats', nargs='+', choices=list(feeds.FEED_FORMATS), default=list(feeds.FEED_FORMATS))
+        parser.add_argument('--full', action='store_true',
+                            help="Render all items again (e.g. after renaming categories)")
+
+    def handle(self, *args, **options):
+        for feed_format in options['formats']:
+            start = time.perf_counter()
+            feed = feeds.get_feed(feed_format)
+            n_rendered, n_chunks = feeds.export_feed(feed, full=options['full'])
+            self.stdout.write(self.style.SUCCESS(
+                f"{feeds.feed_path(feed)}: {n_rendered} of {n_chunks} chunks rendered "
+                f"in {time.perf_counter() - start:.1f}s"))
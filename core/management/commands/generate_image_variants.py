@@ -0,0 +1,56 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core import images
+from core.models import Item
+
+
+class Command(BaseCommand):
+    help = ("Generate the resized WebP/JPEG variants of all images in the media tree in parallel and store "
+            "the dimensions of item images. Variants newer than their originals are skipped unless --force is given.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.IMAGE_VARIANT_WORKERS,
+                            help="Number of worker processes (default: one per CPU)")
+        parser.add_argument('--force', action='store_true', help="Regenerate up-to-date variants as well")
+
+    def find_images(self):
+        """
+        :return: list of storage names (relative to MEDIA_ROOT) of the original images
+        """
+        names = []
+        for directory, subdirectories, filenames in os.walk(settings.MEDIA_ROOT):
+            # never make variants of variants
+            subdirectories[:] = [subdirectory for subdirectory in subdirectories if subdirectory != images.VARIANTS_DIR]
+            for filename in filenames:
+                if filename.lower().endswith(images.IMAGE_EXTENSIONS):
+                    path = os.path.join(directory, filename)
+                    names.append(os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/'))
+        return sorted(names)
+
+    def handle(self, *args, **options):
+        names = self.find_images()
+        sizes = {}
+        n_failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {executor.submit(images.render_variants, os.path.join(settings.MEDIA_ROOT, name),
+                                       options['force']): name for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    sizes[name] = future.result()
+                except Exception as error:
+                    n_failed += 1
+                    self.stderr.write(f"{name}: {error}")
+                if (len(sizes) + n_failed) % 100 == 0:
+                    self.stdout.write(f"processed {len(sizes) + n_failed}/{len(names)} images")
+
+        with transaction.atomic():
+            for name, size in sizes.items():
+                images.store_dimensions(Item, name, size)
+
+        self.stdout.write(self.style.SUCCESS(f"Variants generated for {len(sizes)} images ({n_failed} failed)"))
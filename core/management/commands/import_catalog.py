@@ -0,0 +1,267 @@
+import csv
+import json
+import os
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import reset_queries
+
+from core import search
+from core.context_processors import invalidate_category_tree
+from core.models import *
+from core.transactions import immediate_atomic
+
+# columns of the Item rows updated when an item with the same SKU already exists
+UPDATE_FIELDS = ['name', 'form', 'net_weight', 'price', 'manufacturer', 'in_stock']
+# updated only if the row has them - an existing item keeps the stored values of the columns missing in the file
+OPTIONAL_FIELDS = ['composition', 'description', 'price_sale']
+ITEM_COLUMNS = ['name', 'form', 'composition', 'description', 'net_weight', 'price', 'price_sale', 'in_stock']
+
+# separates the category from the subcategory ("Leki > Przeciwbólowe") and subcategories in CSV files
+SUBCATEGORY_SEPARATOR = ">"
+CSV_LIST_SEPARATOR = ";"
+
+# keeps the number of bound parameters of 'in' lookups below SQLite's limit
+LOOKUP_BATCH_SIZE = 500
+
+PROGRESS_INTERVAL = 2
+
+# note of the stock movements recorded by the import
+IMPORT_NOTE = "import_catalog"
+
+FORMS = {code.lower(): code for code, label in Item.FORM_CHOICES}
+FORMS.update({label.lower(): code for code, label in Item.FORM_CHOICES})
+
+
+def read_rows(path, file_format):
+    """
+    Stream the rows of a supplier file.
+    :return: iterator of (line number, row dict) pairs
+    """
+    with open(path, encoding="utf-8-sig", newline="") as file:
+        if file_format == "csv":
+            reader = csv.DictReader(file)
+            for row in reader:
+                # subcategories are a list in JSONL rows
+                if row.get("subcategories") is not None:
+                    row["subcategories"] = [name for name in row["subcategories"].split(CSV_LIST_SEPARATOR)
+                                            if name.strip()]
+                yield reader.line_num, row
+        else:
+            for line_number, line in enumerate(file, 1):
+                if line.strip():
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError as error:
+                        row = error
+                    yield line_number, row
+
+
+def batched(iterable, batch_size):
+    batch = []
+    for element in iterable:
+        batch.append(element)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def error_message(error):
+    if hasattr(error, "message_dict"):
+        return " ".join(f"{field}: {' '.join(messages)}" for field, messages in error.message_dict.items())
+    return " ".join(getattr(error, "messages", [str(error)]))
+
+
+class Command(BaseCommand):
+    help = ("Import items from a supplier's CSV or JSONL file, adding new items and updating the existing ones "
+            "with the same SKU. Columns: sku, name, form (code or name, e.g. TAB or Tabletki), net_weight, price, "
+            "in_stock, manufacturer and the optional composition, description, price_sale and subcategories "
+            f"(\"Category {SUBCATEGORY_SEPARATOR} Subcategory\" names, separated with '{CSV_LIST_SEPARATOR}' "
+            "in CSV files, a list in JSONL files) - given subcategories replace those of the item, optional "
+            "columns missing in the file keep the stored values of existing items. Missing "
+            "manufacturers, categories and subcategories are created. The file is read and written in batches, "
+            "each in its own transaction - an interrupted import can simply be run again. Invalid rows are "
+            "reported and skipped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=["csv", "jsonl"],
+                            help="Format of the file (by default guessed from its extension)")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.isfile(path):
+            raise CommandError(f"No such file: {path}")
+        file_format = options['format'] or ("csv" if path.lower().endswith(".csv") else "jsonl")
+
+        # everything but the items themselves is small enough to be kept in memory
+        self.manufacturers = {manufacturer.name: manufacturer for manufacturer in Manufacturer.objects.all()}
+        self.categories = {category.name: category for category in Category.objects.all()}
+        self.subcategories = {(subcategory.category.name, subcategory.name): subcategory
+                              for subcategory in SubCategory.objects.select_related('category')}
+        self.subcategories_created = False
+        self.n_read = self.n_created = self.n_updated = self.n_invalid = 0
+
+        start = last_progress = time.monotonic()
+        try:
+            for batch in batched(read_rows(path, file_format), options['batch_size']):
+                with immediate_atomic():
+                    self.import_batch(batch)
+                # with DEBUG on the connection keeps the (long) executed statements
+                reset_queries()
+                if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    self.stdout.write(f"{self.n_read} rows read ({self.n_read / (last_progress - start):.0f}/s)")
+        finally:
+            if self.subcategories_created:
+                invalidate_category_tree()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Catalog imported in {time.monotonic() - start:.1f}s: {self.n_created} items added, "
+            f"{self.n_updated} updated, {self.n_invalid} invalid rows skipped"))
+
+    def import_batch(self, rows):
+        self.n_read += len(rows)
+        # the last row of a SKU wins - a single upsert statement cannot update a row twice
+        items, item_subcategories, item_fields = {}, {}, {}
+        for line_number, row in rows:
+            try:
+                item, subcategories = self.build_item(row)
+            except ValidationError as error:
+                self.n_invalid += 1
+                self.stderr.write(f"Line {line_number}: {error_message(error)}")
+                continue
+            items[item.sku] = item
+            item_fields[item.sku] = tuple(field for field in OPTIONAL_FIELDS if field in row)
+            if subcategories is not None:
+                item_subcategories[item.sku] = subcategories
+            else:
+                item_subcategories.pop(item.sku, None)
+        if not items:
+            return
+
+        skus = list(items)
+        # the batch transaction holds the write lock - no sale can change the stock read here before the upsert
+        existing_stock = dict(self.lookup(skus, 'sku', 'in_stock'))
+        # one upsert per set of the optional columns given (a single one unless the rows of a JSONL file differ)
+        items_by_fields = {}
+        for sku, item in items.items():
+            items_by_fields.setdefault(item_fields[sku], []).append(item)
+        for fields, field_items in items_by_fields.items():
+            Item.objects.bulk_upsert(field_items, 'sku', UPDATE_FIELDS + list(fields))
+        pks = dict(self.lookup(skus, 'sku', 'pk'))
+        self.n_created += len(skus) - len(existing_stock)
+        self.n_updated += len(existing_stock)
+        for sku, item in items.items():
+            item.pk = pks[sku]
+            item._state.adding = False
+
+        # the upsert sets the stock directly - record the changes in the stock ledger
+        movements = []
+        for sku, item in items.items():
+            quantity = item.in_stock - existing_stock.get(sku, 0)
+            if quantity:
+                reason = StockMovement.ADJUSTMENT if sku in existing_stock else StockMovement.OPENING
+                movements.append(StockMovement(item_id=item.pk, quantity=quantity, reason=reason, note=IMPORT_NOTE))
+        StockMovement.objects.bulk_create(movements, batch_size=LOOKUP_BATCH_SIZE)
+
+        self.set_subcategories({pks[sku]: subcategories for sku, subcategories in item_subcategories.items()})
+        # the upsert bypasses Item.save(): copy the prices to the links kept and refresh the search index
+        # (from the stored rows - the built items lack the values kept from the database)
+        ItemSubCategory.objects.sync_items(pks.values())
+        item_pks = list(pks.values())
+        for i in range(0, len(item_pks), LOOKUP_BATCH_SIZE):
+            search.index_items(Item.objects.filter(pk__in=item_pks[i:i + LOOKUP_BATCH_SIZE]))
+
+    def build_item(self, row):
+        """
+        :return: unsaved Item built from the row and its subcategories (None if the row does not list them)
+        :raise ValidationError: the row is invalid
+        """
+        if not isinstance(row, dict):
+            raise ValidationError(f"Niepoprawny wiersz: {row}")
+        values = {column: value.strip() if isinstance(value, str) else value for column, value in row.items()}
+        sku = values.get('sku')
+        if not sku:
+            raise ValidationError({'sku': [Item._meta.get_field('sku').error_messages['blank']]})
+        if isinstance(values.get('form'), str):
+            values['form'] = FORMS.get(values['form'].lower(), values['form'])
+
+        item = Item(sku=str(sku), **{column: values[column] for column in ITEM_COLUMNS
+                                     # defaults of the optional columns
+                                     if values.get(column) not in (None, "")})
+        item.manufacturer = self.get_manufacturer(values.get('manufacturer'))
+        item.clean_fields(exclude=['manufacturer', 'effective_price', 'image'])
+        item.set_effective_price()
+
+        subcategories = values.get('subcategories')
+        if subcategories is not None:
+            if not isinstance(subcategories, list):
+                raise ValidationError({'subcategories': ["Oczekiwano listy podkategorii."]})
+            subcategories = {self.get_subcategory(name).pk for name in subcategories}
+        return item, subcategories
+
+    def get_manufacturer(self, name):
+        if not name:
+            raise ValidationError({'manufacturer': [Item._meta.get_field('manufacturer').error_messages['blank']]})
+        if name not in self.manufacturers:
+            manufacturer = Manufacturer(name=name)
+            manufacturer.full_clean()
+            manufacturer.save()
+            self.manufacturers[name] = manufacturer
+        return self.manufacturers[name]
+
+    def get_subcategory(self, full_name):
+        category_name, separator, name = (part.strip() for part in str(full_name).partition(SUBCATEGORY_SEPARATOR))
+        if not separator or not category_name or not name:
+            raise ValidationError(
+                {'subcategories': [f"Oczekiwano \"Kategoria {SUBCATEGORY_SEPARATOR} Podkategoria\", "
+                                   f"otrzymano \"{full_name}\"."]})
+        key = (category_name, name)
+        if key not in self.subcategories:
+            if category_name not in self.categories:
+                category = Category(name=category_name)
+                category.full_clean()
+                category.save()
+                self.categories[category_name] = category
+            subcategory = SubCategory(category=self.categories[category_name], name=name)
+            subcategory.full_clean()
+            subcategory.save()
+            self.subcategories[key] = subcategory
+            self.subcategories_created = True
+        return self.subcategories[key]
+
+    @staticmethod
+    def lookup(skus, *fields):
+        """
+        :return: iterator of the values of 'fields' of the existing items with the given SKUs
+        """
+        for i in range(0, len(skus), LOOKUP_BATCH_SIZE):
+            yield from Item.objects.filter(sku__in=skus[i:i + LOOKUP_BATCH_SIZE]).values_list(*fields)
+
+    @staticmethod
+    def set_subcategories(subcategories_by_item):
+        """
+        Replace the subcategory links of the items with bulk deletes and inserts of the through-table rows.
+        """
+        item_pks = list(subcategories_by_item)
+        existing, stale = set(), []
+        for i in range(0, len(item_pks), LOOKUP_BATCH_SIZE):
+            links = ItemSubCategory.objects.filter(item__in=item_pks[i:i + LOOKUP_BATCH_SIZE])
+            for pk, item_pk, subcategory_pk in links.values_list('pk', 'item_id', 'subcategory_id'):
+                if subcategory_pk in subcategories_by_item[item_pk]:
+                    existing.add((item_pk, subcategory_pk))
+                else:
+                    stale.append(pk)
+        for i in range(0, len(stale), LOOKUP_BATCH_SIZE):
+            ItemSubCategory.objects.filter(pk__in=stale[i:i + LOOKUP_BATCH_SIZE]).delete()
+        # the prices are copied by sync_items()
+        ItemSubCategory.objects.bulk_create(
+            [ItemSubCategory(item_id=item_pk, subcategory_id=subcategory_pk)
+             for item_pk, subcategory_pks in subcategories_by_item.items()
+             for subcategory_pk in subcategory_pks if (item_pk, subcategory_pk) not in existing],
+            batch_size=LOOKUP_BATCH_SIZE)
@@ -0,0 +1,50 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.cart import prune_abandoned_carts, prune_expired_sessions, schedule_cart_pruning
+
+PROGRESS_INTERVAL = 2
+
+
+class Command(BaseCommand):
+    help = ("Delete the expired sessions and the anonymous carts (with their lines) not changed for --days days "
+            "or left without a session. Rows are deleted in batches, each in a short transaction of its own, so "
+            "the command can be run against the live database. With --schedule the prune_carts background job "
+            "is queued instead - it then runs every CART_PRUNE_INTERVAL seconds in 'run_workers'.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CART_MAX_AGE_DAYS,
+                            help="Age of the abandoned anonymous carts")
+        parser.add_argument('--batch-size', type=int, default=settings.CART_PRUNE_BATCH_SIZE)
+        parser.add_argument('--pause', type=float, default=0, help="Seconds to sleep between the batches")
+        parser.add_argument('--schedule', action='store_true', help="Queue the prune_carts background job")
+
+    def handle(self, *args, **options):
+        if options['schedule']:
+            if schedule_cart_pruning() is None:
+                self.stdout.write("The prune_carts job is already queued")
+            else:
+                self.stdout.write(self.style.SUCCESS("The prune_carts job queued"))
+            return
+
+        n_sessions = self.report(prune_expired_sessions(options['batch_size'], options['pause']),
+                                 "expired sessions")
+        n_carts = self.report(prune_abandoned_carts(timedelta(days=options['days']), options['batch_size'],
+                                                    options['pause']), "abandoned carts")
+        self.stdout.write(self.style.SUCCESS(f"{n_sessions} expired sessions and {n_carts} abandoned carts deleted"))
+
+    def report(self, batches, name):
+        """
+        :return: total number of rows deleted by the batches, reported every PROGRESS_INTERVAL seconds
+        """
+        n_deleted = 0
+        last_progress = time.monotonic()
+        for n_batch in batches:
+            n_deleted += n_batch
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                self.stdout.write(f"{n_deleted} {name} deleted so far")
+        return n_deleted
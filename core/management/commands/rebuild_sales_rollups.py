@@ -0,0 +1,49 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import DailyItemSales, DailyOrderSales
+from core.reports import order_days, rebuild_day
+
+PROGRESS_INTERVAL = 2
+
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"Expected a date (YYYY-MM-DD), got '{value}'")
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the daily sales rollups (DailyItemSales, DailyOrderSales) from the orders - all days or the "
+            "days from --since on. Every day is rebuilt in a short transaction of its own, so the command can be "
+            "run against the live database (e.g. to backfill the rollups of the existing orders).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=parse_date, help="First rebuilt day (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        since = options['since']
+        days = order_days(since)
+
+        # rollups of the days left without orders (e.g. their orders were deleted in bulk)
+        n_stale = 0
+        for model in (DailyItemSales, DailyOrderSales):
+            stale = model.objects.exclude(date__in=days)
+            if since is not None:
+                stale = stale.filter(date__gte=since)
+            n_stale += stale.delete()[0]
+
+        start = last_progress = time.monotonic()
+        n_orders = 0
+        for i, day in enumerate(days, 1):
+            n_orders += rebuild_day(day)
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                self.stdout.write(f"{i}/{len(days)} days rebuilt ({day})")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rollups of {len(days)} days ({n_orders} orders) rebuilt in {time.monotonic() - start:.1f}s, "
+            f"{n_stale} stale rows deleted"))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from core import search
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the full-text search index of all items. Needed after bulk writes that bypass model signals "
+            "(e.g. QuerySet.update() of item texts or bulk_create()).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        n_indexed = search.rebuild_index(batch_size=options['batch_size'],
+                                         progress=lambda n: self.stdout.write(f"indexed {n} items"))
+        self.stdout.write(self.style.SUCCESS(f"Search index rebuilt: {n_indexed} items"))
@@ -0,0 +1,94 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from core.models import Item, StockMovement
+from core.transactions import immediate_atomic
+
+COMPACTED_NOTE = "compacted"
+
+# keeps the number of bound parameters of 'in' lookups below SQLite's limit
+DELETE_BATCH_SIZE = 500
+
+
+def item_pk_batches(batch_size):
+    """
+    :return: iterator of lists of consecutive item primary keys (no cursor is kept open between the batches)
+    """
+    last_pk = 0
+    while True:
+        pks = list(Item.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        yield pks
+        last_pk = pks[-1]
+
+
+class Command(BaseCommand):
+    help = ("Verify that the stock of every item (Item.in_stock) equals the sum of its stock movements and report "
+            "the differences. With --fix the stock of such items is set to the sum - the ledger is the record. "
+            "With --compact-before DAYS the movements older than DAYS days are first replaced with a single "
+            "opening movement per item. Meant to be run periodically.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help="Set the stock of mismatched items to the ledger sum")
+        parser.add_argument('--compact-before', type=int, metavar="DAYS",
+                            help="Replace the movements older than DAYS days with their sum")
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if options['compact_before'] is not None:
+            cutoff = timezone.now() - timedelta(days=options['compact_before'])
+            n_compacted = sum(self.compact(pks, cutoff) for pks in item_pk_batches(options['batch_size']))
+            self.stdout.write(f"{n_compacted} movements compacted")
+
+        n_checked = n_mismatched = n_fixed = 0
+        for pks in item_pk_batches(options['batch_size']):
+            # one transaction - the stock and the movements are read from the same snapshot
+            with transaction.atomic():
+                stock = dict(Item.objects.filter(pk__gte=pks[0], pk__lte=pks[-1]).values_list('pk', 'in_stock'))
+                totals = dict(StockMovement.objects.filter(item__gte=pks[0], item__lte=pks[-1])
+                              .values('item').order_by('item')
+                              .annotate(total=Sum('quantity')).values_list('item', 'total'))
+            n_checked += len(stock)
+            for pk, in_stock in stock.items():
+                total = totals.get(pk, 0)
+                if in_stock == total:
+                    continue
+                n_mismatched += 1
+                self.stdout.write(self.style.WARNING(f"Item {pk}: {in_stock} in stock, {total} in the ledger"))
+                # unless the stock has changed meanwhile (together with a movement)
+                if options['fix'] and total >= 0 and Item.objects.filter(pk=pk, in_stock=in_stock).update(
+                        in_stock=total):
+                    n_fixed += 1
+
+        message = f"{n_checked} items checked, {n_mismatched} mismatched"
+        if options['fix']:
+            message += f", {n_fixed} fixed"
+        self.stdout.write((self.style.WARNING if n_mismatched > n_fixed else self.style.SUCCESS)(message))
+
+    @staticmethod
+    def compact(item_pks, cutoff):
+        """
+        Replace the movements of the items made before 'cutoff' with one opening movement per item.
+        :return: number of replaced movements
+        """
+        with immediate_atomic():
+            old_movements = StockMovement.objects.filter(item__gte=item_pks[0], item__lte=item_pks[-1],
+                                                         created_at__lt=cutoff)
+            totals = list(old_movements.values('item').order_by('item')
+                          .annotate(total=Sum('quantity'), n_movements=Count('pk')).filter(n_movements__gt=1))
+            if not totals:
+                return 0
+            compacted_pks = [total['item'] for total in totals]
+            for i in range(0, len(compacted_pks), DELETE_BATCH_SIZE):
+                old_movements.filter(item__in=compacted_pks[i:i + DELETE_BATCH_SIZE]).delete()
+            StockMovement.objects.bulk_create([
+                StockMovement(item_id=total['item'], quantity=total['total'], reason=StockMovement.OPENING,
+                              note=COMPACTED_NOTE, created_at=cutoff)
+                for total in totals
+            ])
+        return sum(total['n_movements'] for total in totals)
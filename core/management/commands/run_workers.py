@@ -0,0 +1,85 @@
+import multiprocessing
+import queue
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from core import jobs
+
+STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+def run_worker_process(n_threads, poll_interval, burst, results=None):
+    """
+    Run the worker threads of one process until SIGINT/SIGTERM (the jobs being run are finished first).
+    :param results: optional multiprocessing queue receiving the number of jobs run
+    :return: number of jobs run
+    """
+    stop = threading.Event()
+    previous_handlers = {signum: signal.signal(signum, lambda signum, frame: stop.set()) for signum in STOP_SIGNALS}
+    n_run = 0
+    try:
+        n_run = jobs.run_worker_threads(n_threads, stop, poll_interval, burst)
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        if results is not None:
+            results.put(n_run)
+    return n_run
+
+
+class Command(BaseCommand):
+    help = ("Run the background jobs (see core.jobs) in worker processes, each with a pool of worker threads. "
+            "SIGINT/SIGTERM stops the workers once they finish the jobs they are running.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.JOB_WORKER_PROCESSES)
+        parser.add_argument('--threads', type=int, default=settings.JOB_WORKER_THREADS,
+                            help="Worker threads of every process (jobs mostly wait for I/O, e.g. SMTP)")
+        parser.add_argument('--poll-interval', type=float, default=settings.JOB_POLL_INTERVAL,
+                            help="Seconds an idle worker waits before looking for jobs again")
+        parser.add_argument('--burst', action='store_true', help="Exit once there are no jobs to run")
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1 or options['threads'] < 1:
+            raise CommandError("--processes and --threads must be positive")
+        worker_options = (options['threads'], options['poll_interval'], options['burst'])
+        if options['processes'] == 1:
+            n_run = run_worker_process(*worker_options)
+        else:
+            n_run = self.run_processes(options['processes'], worker_options)
+        self.stdout.write(self.style.SUCCESS(f"Workers stopped, {n_run} jobs run"))
+
+    @staticmethod
+    def run_processes(n_processes, worker_options):
+        # forked processes must not share the connections of the parent
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        processes = [context.Process(target=run_worker_process, args=(*worker_options, results))
+                     for i in range(n_processes)]
+        for process in processes:
+            process.start()
+
+        def stop_processes(signum, frame):
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        # ^C reaches all the processes of the terminal anyway, SIGTERM of a process manager may reach only this one
+        previous_handlers = {signum: signal.signal(signum, stop_processes) for signum in STOP_SIGNALS}
+        try:
+            for process in processes:
+                process.join()
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        n_run = 0
+        while True:
+            try:
+                n_run += results.get(timeout=0.1)
+            except queue.Empty:
+                return n_run
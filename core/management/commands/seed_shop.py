@@ -0,0 +1,165 @@
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from core import search
+from core.context_processors import invalidate_category_tree
+from core.models import *
+
+# password of all seeded users (used by 'bench' to log in)
+SEED_PASSWORD = "seed-password"
+
+NAME_PREFIXES = ["Apap", "Ibuprom", "Rutino", "Vita", "Magne", "Derma", "Hydro", "Calci", "Neo", "Flegam", "Pro", "Bio"]
+NAME_SUFFIXES = ["Forte", "Max", "Plus", "Junior", "Extra", "Duo", "Active", "Control", "Complex", "Med"]
+FIRST_NAMES = ["Anna", "Jan", "Maria", "Piotr", "Katarzyna", "Tomasz", "Agnieszka", "Paweł", "Ewa", "Michał"]
+LAST_NAMES = ["Nowak", "Kowalski", "Wiśniewski", "Wójcik", "Kowalczyk", "Kamiński", "Lewandowski", "Zieliński"]
+CITIES = ["Warszawa", "Kraków", "Wrocław", "Poznań", "Gdańsk", "Łódź", "Lublin", "Katowice"]
+STREETS = ["Piastowa", "Długa", "Krótka", "Polna", "Leśna", "Słoneczna", "Ogrodowa", "Lipowa"]
+
+ORDER_STATUS_WEIGHTS = {Order.AWAITING_PAYMENT: 1, Order.PROCESSING: 2, Order.SHIPPED: 2, Order.COMPLETED: 10,
+                        Order.CANCELLED: 1}
+
+
+def next_pk(model):
+    """
+    SQLite does not return primary keys from bulk inserts - rows get explicit primary keys starting from this one.
+    """
+    return (model.objects.aggregate(max_pk=Max('pk'))['max_pk'] or 0) + 1
+
+
+class Command(BaseCommand):
+    help = ("Generate a synthetic shop (categories, items, customers with user accounts, orders and carts) "
+            "with bulk inserts. The same --seed always generates the same data.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=3)
+        parser.add_argument('--subcategories', type=int, default=8, help="Number of subcategories per category")
+        parser.add_argument('--items', type=int, default=5000)
+        parser.add_argument('--customers', type=int, default=500)
+        parser.add_argument('--orders', type=int, default=2000)
+        parser.add_argument('--carts', type=int, default=200, help="Number of customers with a filled cart")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if options['carts'] > options['customers']:
+            raise CommandError("--carts cannot exceed --customers (every cart belongs to a customer)")
+        self.rng = random.Random(options['seed'])
+        self.seed = options['seed']
+        self.batch_size = options['batch_size']
+        if get_user_model().objects.filter(username__startswith=f"seed{self.seed}-").exists():
+            raise CommandError(f"The shop has already been seeded with --seed {self.seed}")
+
+        start = time.perf_counter()
+        with transaction.atomic():
+            subcategories = self.seed_categories(options['categories'], options['subcategories'])
+            items = self.seed_items(options['items'], subcategories)
+            customers = self.seed_customers(options['customers'])
+            self.seed_orders(options['orders'], customers, items)
+            self.seed_carts(customers[:options['carts']], items)
+            # bulk inserts bypass the signals keeping the search index and the navbar cache up to date
+            search.index_items(Item.objects.filter(pk__gte=items[0].pk))
+        invalidate_category_tree()
+        # ... and the daily sales rollups
+        call_command("rebuild_sales_rollups", stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f"Shop seeded in {time.perf_counter() - start:.1f}s "
+                                             f"(users' password: '{SEED_PASSWORD}')"))
+
+    def bulk_create(self, model, objects):
+        first_pk = next_pk(model)
+        for i, obj in enumerate(objects):
+            obj.pk = first_pk + i
+        created = model.objects.bulk_create(objects, batch_size=self.batch_size)
+        self.stdout.write(f"{model.__name__}: {len(created)}")
+        return created
+
+    def seed_categories(self, n_categories, n_subcategories):
+        categories = self.bulk_create(Category, [Category(name=f"Kategoria {self.seed}-{i}")
+                                                 for i in range(n_categories)])
+        return self.bulk_create(SubCategory, [SubCategory(category=category, name=f"{category.name}.{i}")
+                                              for category in categories for i in range(n_subcategories)])
+
+    def seed_items(self, n_items, subcategories):
+        rng = self.rng
+        manufacturers = self.bulk_create(Manufacturer, [Manufacturer(name=f"Producent {self.seed}-{i}")
+                                                        for i in range(max(n_items // 100, 1))])
+        items = []
+        for i in range(n_items):
+            price = Decimal(rng.randint(199, 14999)) / 100
+            price_sale = (price * Decimal("0.8")).quantize(Decimal("0.01")) if rng.random() < 0.3 else None
+            items.append(Item(name=f"{rng.choice(NAME_PREFIXES)} {rng.choice(NAME_SUFFIXES)} {i}",
+                              form=rng.choice(Item.FORM_CHOICES)[0], net_weight=rng.randint(5, 500),
+                              composition=f"substancja czynna {rng.randint(1, 300)} mg",
+                              description=f"Opis produktu {i}", price=price, price_sale=price_sale,
+                              manufacturer=rng.choice(manufacturers), in_stock=rng.randint(0, 10000)))
+        items = self.bulk_create(Item, items)
+
+        # every item is in one or two subcategories
+        self.bulk_create(ItemSubCategory, [
+            ItemSubCategory(item=item, subcategory=subcategory, effective_price=item.effective_price)
+            for item in items for subcategory in rng.sample(subcategories, min(rng.randint(1, 2), len(subcategories)))
+        ])
+        return items
+
+    def seed_customers(self, n_customers):
+        rng = self.rng
+        # hashing is deliberately slow - all seeded users share one hash
+        password = make_password(SEED_PASSWORD)
+        users = self.bulk_create(get_user_model(), [
+            get_user_model()(username=f"seed{self.seed}-{i}", email=f"seed{self.seed}-{i}@example.com",
+                             password=password)
+            for i in range(n_customers)
+        ])
+        addresses = self.bulk_create(Address, [
+            Address(city=rng.choice(CITIES), postal_code=f"{rng.randint(10, 99)}-{rng.randint(100, 999)}",
+                    street=rng.choice(STREETS), street_number=str(rng.randint(1, 200)))
+            for i in range(n_customers)
+        ])
+        return self.bulk_create(Customer, [
+            Customer(first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES),
+                     phone_number=str(rng.randint(500000000, 899999999)), user=user, address=address)
+            for user, address in zip(users, addresses)
+        ])
+
+    def seed_orders(self, n_orders, customers, items):
+        rng = self.rng
+        now = timezone.now()
+        orders, order_items = [], []
+        for i in range(n_orders):
+            customer = rng.choice(customers)
+            order = Order(customer=customer, address_id=customer.address_id,
+                          status=rng.choices(list(ORDER_STATUS_WEIGHTS), list(ORDER_STATUS_WEIGHTS.values()))[0],
+                          delivery_method=rng.choice(Order.DELIVERY_METHOD_CHOICES)[0],
+                          payment_method=rng.choice(Order.PAYMENT_METHOD_CHOICES)[0])
+            lines = [OrderItem(order=order, item=item, n_pieces=rng.randint(1, 3), unit_price=item.effective_price)
+                     for item in rng.sample(items, min(rng.randint(1, 5), len(items)))]
+            order.total_price = sum(line.unit_price * line.n_pieces for line in lines)
+            # spread over the last year
+            order.date = now - timedelta(minutes=rng.randint(0, 365 * 24 * 60))
+            orders.append(order)
+            order_items.extend(lines)
+
+        dates = [order.date for order in orders]
+        orders = self.bulk_create(Order, orders)
+        # 'date' is auto_now_add, so bulk_create() has overwritten it with the current time
+        for order, date in zip(orders, dates):
+            order.date = date
+        Order.objects.bulk_update(orders, ['date'], batch_size=self.batch_size)
+        for line in order_items:
+            line.order_id = line.order.pk
+        self.bulk_create(OrderItem, order_items)
+
+    def seed_carts(self, customers, items):
+        rng = self.rng
+        carts = self.bulk_create(Cart, [Cart(user_id=customer.user_id) for customer in customers])
+        self.bulk_create(CartItem, [CartItem(cart=cart, item=item, n_pieces=1)
+                                    for cart in carts for item in rng.sample(items, min(rng.randint(1, 4), len(items)))])
@@ -0,0 +1,349 @@
+"""
+Per-view request metrics exposed in the Prometheus text format.
+
+MetricsMiddleware records, per URL name (e.g. 'core:detail'), histograms of the total request latency,
+the number and total time of the SQL queries (through a database execute_wrapper) and the template render time
+(through the TimedDjangoTemplates template backend).
+
+Every process keeps its metrics in memory. With METRICS_DIR set (needed when the site runs in several worker
+processes) each process also writes its totals to its own 'metrics-<pid>.json' file there, at most every
+METRICS_FLUSH_INTERVAL seconds; the /metrics view sums the files of all processes. Counts of processes that exited
+stay in their files, so the sums never go backwards - remove the directory's files when deploying.
+"""
+import asyncio
+import copy
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template.backends.django import DjangoTemplates
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+QUERY_COUNT_HEADER = "X-DB-Queries"
+
+# label of requests not resolved to a view (e.g. 404s)
+UNRESOLVED = "<unresolved>"
+
+# metrics of the request being handled by the current thread
+_request_metrics = ContextVar("request_metrics", default=None)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        # label values (tuple) -> value
+        self.values = {}
+
+    def merge(self, values):
+        raise NotImplementedError
+
+    def samples(self):
+        """
+        :return: iterable of tuple(sample name suffix, dict of labels, value)
+        """
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def merge(self, values):
+        for label_values, value in values:
+            self.inc(tuple(label_values), value)
+
+    def samples(self):
+        for label_values, value in sorted(self.values.items()):
+            yield "", dict(zip(self.labels, label_values)), value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels, buckets):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, label_values, value):
+        # [count in each bucket (not cumulative) and above the last one, sum of the values]
+        state = self.values.get(label_values)
+        if state is None:
+            state = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def merge(self, values):
+        for label_values, (counts, total) in values:
+            state = self.values.setdefault(tuple(label_values), [[0] * (len(self.buckets) + 1), 0])
+            state[0] = [a + b for a, b in zip(state[0], counts)]
+            state[1] += total
+
+    def samples(self):
+        for label_values, (counts, total) in sorted(self.values.items()):
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", {**labels, "le": "+Inf" if bound == float("inf") else str(bound)}, cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, cumulative
+
+
+class Registry:
+    """
+    Metrics of this process. All updates take one lock, so a request pays for a few dictionary updates only.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.last_flush = 0
+        self.metrics = self.create_metrics()
+
+    @staticmethod
+    def create_metrics():
+        return {metric.name: metric for metric in (
+            Counter("http_requests_total", "Number of handled requests", ("view", "status")),
+            Histogram("http_request_duration_seconds", "Total time of handling the request",
+                      ("view",), DURATION_BUCKETS),
+            Histogram("db_queries_per_request", "Number of SQL queries executed by the request",
+                      ("view",), QUERY_COUNT_BUCKETS),
+            Histogram("db_query_duration_seconds", "Total time of the SQL queries of the request",
+                      ("view",), DURATION_BUCKETS),
+            Histogram("template_render_duration_seconds", "Total template render time of the request "
+                                                          "(including queries of lazy querysets)",
+                      ("view",), DURATION_BUCKETS),
+        )}
+
+    def record(self, view, status, metrics):
+        with self.lock:
+            if os.getpid() != self.pid:
+                # a forked worker must not report the counts it inherited from its parent as its own
+                self.pid = os.getpid()
+                self.metrics = self.create_metrics()
+            self.metrics["http_requests_total"].inc((view, str(status)))
+            self.metrics["http_request_duration_seconds"].observe((view,), metrics.duration)
+            self.metrics["db_queries_per_request"].observe((view,), metrics.queries)
+            self.metrics["db_query_duration_seconds"].observe((view,), metrics.query_duration)
+            self.metrics["template_render_duration_seconds"].observe((view,), metrics.render_duration)
+
+    def snapshot(self):
+        with self.lock:
+            return {name: [[list(label_values), copy.deepcopy(value)] for label_values, value in metric.values.items()]
+                    for name, metric in self.metrics.items()}
+
+    def flush(self, directory, force=False):
+        """
+        Write the totals of this process to its file in 'directory' (at most every METRICS_FLUSH_INTERVAL seconds).
+        """
+        now = time.monotonic()
+        if not force and now - self.last_flush < settings.METRICS_FLUSH_INTERVAL:
+            return
+        self.last_flush = now
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"metrics-{os.getpid()}.json")
+        # write to a temporary file and swap it in, so that readers never see a half-written file
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(self.snapshot(), file)
+        os.replace(temporary_path, path)
+
+
+REGISTRY = Registry()
+
+
+def collect():
+    """
+    :return: metrics of all processes (or just this one if METRICS_DIR is not set)
+    """
+    snapshots = []
+    if settings.METRICS_DIR:
+        REGISTRY.flush(settings.METRICS_DIR, force=True)
+        for filename in os.listdir(settings.METRICS_DIR):
+            if filename.startswith("metrics-") and filename.endswith(".json"):
+                try:
+                    with open(os.path.join(settings.METRICS_DIR, filename)) as file:
+                        snapshots.append(json.load(file))
+                except (OSError, ValueError):
+                    # the file of a process that is being replaced
+                    continue
+    else:
+        snapshots.append(REGISTRY.snapshot())
+
+    metrics = Registry.create_metrics()
+    for snapshot in snapshots:
+        for name, values in snapshot.items():
+            if name in metrics:
+                metrics[name].merge(values)
+    return metrics.values()
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def render_metrics():
+    """
+    :return: metrics of all processes in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in collect():
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.samples():
+            label_string = ",".join(f'{name}="{escape_label_value(label)}"' for name, label in labels.items())
+            lines.append(f"{metric.name}{suffix}{{{label_string}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.duration = 0
+        self.queries = 0
+        self.query_duration = 0
+        self.render_duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        """
+        Database execute_wrapper counting the queries and their time.
+        """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_duration += time.perf_counter() - start
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Execute wrapper of all connections adding the query to the metrics of the current request - the metrics
+    are found through a context variable, so queries count in whichever thread the request's view runs
+    (with ASGI: the threads of sync_to_async()).
+    """
+    metrics = _request_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+
+def instrument_connections():
+    """
+    Install record_query() on the connections of the current thread (once).
+    """
+    if not settings.METRICS_ENABLED:
+        return
+    for alias in connections:
+        wrappers = connections[alias].execute_wrappers
+        if record_query not in wrappers:
+            # first, so that leaving an execute_wrapper() block entered earlier (it pops the last wrapper)
+            # does not remove it
+            wrappers.insert(0, record_query)
+
+
+@receiver(connection_created)
+def instrument_new_connection(sender, connection, **kwargs):
+    if settings.METRICS_ENABLED and record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # tells Django to call (and await) the middleware as a coroutine function under ASGI
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        instrument_connections()
+        metrics = RequestMetrics()
+        token = _request_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_metrics.reset(token)
+        metrics.duration = time.perf_counter() - start
+        return self.record(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _request_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_metrics.reset(token)
+        metrics.duration = time.perf_counter() - start
+        return self.record(request, response, metrics)
+
+    def record(self, request, response, metrics):
+        match = getattr(request, "resolver_match", None)
+        REGISTRY.record(match.view_name if match is not None else UNRESOLVED, response.status_code, metrics)
+        if settings.METRICS_DIR:
+            REGISTRY.flush(settings.METRICS_DIR)
+        if settings.METRICS_QUERY_COUNT_HEADER:
+            # read by the 'bench' command to report queries per request
+            response[QUERY_COUNT_HEADER] = str(metrics.queries)
+        return response
+
+
+class TimedTemplate:
+    """
+    Template of TimedDjangoTemplates adding its render time to the metrics of the current request.
+    """
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        metrics = _request_metrics.get()
+        if metrics is None:
+            return self.template.render(context, request)
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics.render_duration += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    Django template backend timing the rendering of the templates it loads (included templates are rendered
+    by the engine itself, so they are counted as part of the including template).
+    """
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
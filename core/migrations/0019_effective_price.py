@@ -0,0 +1,64 @@
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_effective_price(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    ItemSubCategory = apps.get_model('core', 'ItemSubCategory')
+    Item.objects.update(effective_price=Coalesce('price_sale', 'price'))
+    ItemSubCategory.objects.update(effective_price=Subquery(
+        Item.objects.filter(pk=OuterRef('item_id')).values('effective_price')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_alter_order_delivery_method'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='effective_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, help_text='The price the product is actually sold for', max_digits=6),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['effective_price', 'id'], name='core_item_eff_price_idx'),
+        ),
+        # the auto-created core_item_subcategories table becomes an explicit through model - no schema changes needed
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='ItemSubCategory',
+                    fields=[
+                        ('id', models.AutoField(primary_key=True, serialize=False)),
+                        ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.item')),
+                        ('subcategory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.subcategory')),
+                    ],
+                    options={
+                        'db_table': 'core_item_subcategories',
+                        'unique_together': {('item', 'subcategory')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='item',
+                    name='subcategories',
+                    field=models.ManyToManyField(help_text='Subcategories to which the product belongs', through='core.ItemSubCategory', to='core.SubCategory'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='itemsubcategory',
+            name='effective_price',
+            field=models.DecimalField(decimal_places=2, default=0, help_text="Copy of the item's effective price", max_digits=6),
+        ),
+        migrations.RunPython(populate_effective_price, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='itemsubcategory',
+            index=models.Index(fields=['subcategory', 'effective_price', 'item'], name='core_itemsub_price_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations
+
+from core import search
+
+
+def create_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(search.CREATE_SEARCH_TABLE_SQL)
+    schema_editor.execute(search.CONFIGURE_RANK_SQL)
+    search.rebuild_index(item_model=apps.get_model('core', 'Item'))
+
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(search.DROP_SEARCH_TABLE_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_effective_price'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
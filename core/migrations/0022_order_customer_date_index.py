@@ -0,0 +1,17 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_item_image_dimensions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', '-date'], name='core_order_customer_date_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_order_customer_date_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='sku',
+            field=models.CharField(blank=True, help_text="Stock keeping unit - the supplier's product code", max_length=64, null=True, unique=True),
+        ),
+    ]
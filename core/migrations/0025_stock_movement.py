@@ -0,0 +1,42 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def record_opening_stock(apps, schema_editor):
+    """
+    The current stock of every item becomes its opening movement.
+    """
+    Item = apps.get_model('core', 'Item')
+    StockMovement = apps.get_model('core', 'StockMovement')
+    batch = []
+    for item_pk, in_stock in Item.objects.exclude(in_stock=0).values_list('pk', 'in_stock').iterator(chunk_size=2000):
+        batch.append(StockMovement(item_id=item_pk, quantity=in_stock, reason='opening'))
+        if len(batch) == 2000:
+            StockMovement.objects.bulk_create(batch)
+            batch = []
+    StockMovement.objects.bulk_create(batch)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_item_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.BigIntegerField(help_text='Number of pieces added to the stock (negative for pieces taken)')),
+                ('reason', models.CharField(choices=[('opening', 'Stan początkowy'), ('sale', 'Sprzedaż'), ('restock', 'Dostawa'), ('adjustment', 'Korekta'), ('cancellation', 'Anulowanie zamówienia')], max_length=12)),
+                ('note', models.CharField(blank=True, max_length=200)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.item')),
+                ('order', models.ForeignKey(blank=True, help_text='The order the pieces were sold in or returned from', null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.order')),
+            ],
+        ),
+        migrations.RunPython(record_opening_stock, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:42
+
+from django.db import migrations
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    """
+    Lines of the same item in a cart (possible before the constraint) are merged into the first one.
+    """
+    CartItem = apps.get_model('core', 'CartItem')
+    duplicates = (CartItem.objects.values('cart', 'item').order_by()
+                  .annotate(n_lines=Count('pk'), first_pk=Min('pk'), n_pieces=Sum('n_pieces')).filter(n_lines__gt=1))
+    for duplicate in list(duplicates):
+        CartItem.objects.filter(pk=duplicate['first_pk']).update(n_pieces=duplicate['n_pieces'])
+        CartItem.objects.filter(cart=duplicate['cart'], item=duplicate['item']).exclude(
+            pk=duplicate['first_pk']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_job'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='cartitem',
+            unique_together={('cart', 'item')},
+        ),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery
+
+
+def fill_unit_prices(apps, schema_editor):
+    """
+    Prices of the lines ordered before they were recorded are unknown - the current effective price is the best guess.
+    """
+    Item = apps.get_model('core', 'Item')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    OrderItem.objects.filter(unit_price__isnull=True).update(
+        unit_price=Subquery(Item.objects.filter(pk=OuterRef('item')).values('effective_price')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_cart_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyItemSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('n_orders', models.IntegerField(default=0)),
+                ('n_pieces', models.BigIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+            ],
+            options={
+                'verbose_name_plural': 'Daily item sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyOrderSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('delivery_method', models.CharField(choices=[('dhl', 'Kurier DHL'), ('inpost', 'Paczkomaty inPost'), ('poczta_polska', 'Poczta Polska')], max_length=13)),
+                ('payment_method', models.CharField(choices=[('dp', 'Przelew'), ('card', 'Karta płatnicza'), ('blik', 'BLIK')], max_length=4)),
+                ('n_orders', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+            ],
+            options={
+                'verbose_name_plural': 'Daily order sales',
+            },
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, help_text='Price of a piece when ordered (the effective price of the item)', max_digits=6, null=True),
+        ),
+        migrations.RunPython(fill_unit_prices, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, help_text='Price of a piece when ordered (the effective price of the item)', max_digits=6),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['date'], name='core_order_date_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyordersales',
+            unique_together={('date', 'delivery_method', 'payment_method')},
+        ),
+        migrations.AddField(
+            model_name='dailyitemsales',
+            name='item',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.item'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyitemsales',
+            unique_together={('date', 'item')},
+        ),
+    ]
@@ -1,11 +1,16 @@
 import re
+from decimal import Decimal
 
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import F, Q, Sum, Value, DecimalField, ExpressionWrapper, OuterRef, Subquery, Prefetch
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from datetime import timedelta
 from django.core.validators import ValidationError
 from django.conf import settings
 
+from .catalog_cache import catalog_changed
+
 
 class Category(models.Model):
     name = models.CharField(max_length=30)
@@ -35,6 +40,144 @@ class Manufacturer(models.Model):
         return self.name
 
 
+def as_price_expression(value):
+    """
+    Wrap a plain price value (Decimal or None) in an expression, leave expressions (e.g. F objects) untouched.
+    """
+    if hasattr(value, 'resolve_expression'):
+        return value
+    return Value(value, output_field=DecimalField(max_digits=6, decimal_places=2))
+
+
+class ItemQuerySet(models.QuerySet):
+    """
+    Besides Item.save(), bulk writes keep the persisted 'effective_price' in sync with 'price' and 'price_sale'.
+    All of them (e.g. stock updates) invalidate the cached catalog fragments and set 'updated_at'.
+    """
+
+    def update(self, **kwargs):
+        catalog_changed(self.db)
+        kwargs.setdefault('updated_at', timezone.now())
+        if 'price' not in kwargs and 'price_sale' not in kwargs:
+            return super().update(**kwargs)
+
+        # the right-hand side of an UPDATE sees the old column values, so the new ones are coalesced explicitly
+        kwargs['effective_price'] = Coalesce(as_price_expression(kwargs.get('price_sale', F('price_sale'))),
+                                             as_price_expression(kwargs.get('price', F('price'))),
+                                             output_field=DecimalField(max_digits=6, decimal_places=2))
+        with transaction.atomic(using=self.db):
+            # the filter may depend on the updated prices - resolve the affected items before the UPDATE
+            item_pks = list(self.values_list('pk', flat=True))
+            n_updated = super().update(**kwargs)
+            ItemSubCategory.objects.using(self.db).sync_items(item_pks)
+        return n_updated
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """
+        Besides the items, record the opening stock movements of those with primary keys (set explicitly,
+        SQLite does not return them from bulk inserts) - the stock of the others is not in the ledger.
+        """
+        catalog_changed(self.db)
+        objs = list(objs)
+        for obj in objs:
+            obj.set_effective_price()
+        with transaction.atomic(using=self.db):
+            created = super().bulk_create(objs, *args, **kwargs)
+            StockMovement.objects.using(self.db).bulk_create(
+                [StockMovement(item_id=obj.pk, quantity=obj.in_stock, reason=StockMovement.OPENING)
+                 for obj in created if obj.pk is not None and obj.in_stock],
+                batch_size=kwargs.get('batch_size'))
+        return created
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        catalog_changed(self.db)
+        fields = list(fields)
+        objs = list(objs)
+        if 'updated_at' not in fields:
+            now = timezone.now()
+            for obj in objs:
+                obj.updated_at = now
+            fields.append('updated_at')
+        if 'price' in fields or 'price_sale' in fields:
+            for obj in objs:
+                obj.set_effective_price()
+            if 'effective_price' not in fields:
+                fields.append('effective_price')
+            with transaction.atomic(using=self.db):
+                n_updated = super().bulk_update(objs, fields, *args, **kwargs)
+                ItemSubCategory.objects.using(self.db).sync_items([obj.pk for obj in objs])
+            return n_updated
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def bulk_upsert(self, objs, unique_field, update_fields):
+        """
+        Insert the items, updating 'update_fields' of the existing ones with the same 'unique_field' instead
+        (INSERT ... ON CONFLICT DO UPDATE - what bulk_create(update_conflicts=True) does since Django 4.1).
+        Primary keys of the objects are not set, and subcategory links are not synced - see sync_items().
+        """
+        objs = list(objs)
+        if not objs:
+            return
+        catalog_changed(self.db)
+        connection = connections[self.db]
+        fields = [field for field in self.model._meta.concrete_fields if not field.primary_key]
+        update_fields = [name for name in update_fields if name != 'effective_price']
+        if 'updated_at' not in update_fields:
+            update_fields.append('updated_at')
+        quote_name = connection.ops.quote_name
+        table = quote_name(self.model._meta.db_table)
+
+        def column(name):
+            return quote_name(self.model._meta.get_field(name).column)
+
+        columns = ", ".join(quote_name(field.column) for field in fields)
+        row_placeholder = f"({', '.join(['%s'] * len(fields))})"
+        conflict_column = quote_name(self.model._meta.get_field(unique_field).column)
+        updates = [f"{column(name)} = excluded.{column(name)}" for name in update_fields]
+        if 'price' in update_fields or 'price_sale' in update_fields:
+            # from the new or the kept price and sale price - only one of them may be updated
+            price, price_sale = (f"{'excluded' if name in update_fields else table}.{column(name)}"
+                                 for name in ('price', 'price_sale'))
+            updates.append(f"{column('effective_price')} = COALESCE({price_sale}, {price})")
+        updates = ", ".join(updates)
+
+        batch_size = connection.ops.bulk_batch_size(fields, objs)
+        with transaction.atomic(using=self.db, savepoint=False), connection.cursor() as cursor:
+            for i in range(0, len(objs), batch_size):
+                batch = objs[i:i + batch_size]
+                params = []
+                for obj in batch:
+                    obj.set_effective_price()
+                    params.extend(field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields)
+                cursor.execute(f"INSERT INTO {table} ({columns}) "
+                               f"VALUES {', '.join([row_placeholder] * len(batch))} "
+                               f"ON CONFLICT ({conflict_column}) DO UPDATE SET {updates}", params)
+
+    def move_stock(self, item_pk, quantity, reason, order=None, note=""):
+        """
+        Record a stock movement and apply it to the materialized 'in_stock' of the item in the same transaction.
+        Pieces are taken with a single conditional UPDATE (in_stock = in_stock - n WHERE in_stock >= n),
+        so that concurrent writers can never take more pieces than there are in stock.
+        :param quantity: number of pieces added to the stock (negative for pieces taken from it)
+        :return: the recorded StockMovement or None if there were not enough pieces (nothing is written then)
+        """
+        items = self.filter(pk=item_pk)
+        if quantity < 0:
+            items = items.filter(in_stock__gte=-quantity)
+        with transaction.atomic(using=self.db):
+            if items.update(in_stock=F('in_stock') + quantity) != 1:
+                return None
+            return StockMovement.objects.using(self.db).create(item_id=item_pk, quantity=quantity, reason=reason,
+                                                               order=order, note=note)
+
+    def take_from_stock(self, item_pk, n_pieces, order=None):
+        """
+        Take the ordered pieces of the item from the stock (see move_stock()).
+        :return: True if the pieces were taken from the stock, False if there were not enough pieces
+        """
+        return self.move_stock(item_pk, -n_pieces, StockMovement.SALE, order=order) is not None
+
+
 class Item(models.Model):
     TABLETS = 'TAB'
     SYRUP = 'SYR'
@@ -51,7 +194,11 @@ class Item(models.Model):
     )
 
     name = models.CharField(max_length=60, help_text="Name of the product")
-    subcategories = models.ManyToManyField(to='SubCategory', help_text="Subcategories to which the product belongs")
+    # identifier of the product in the supplier's catalog (see the 'import_catalog' command)
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True,
+                           help_text="Stock keeping unit - the supplier's product code")
+    subcategories = models.ManyToManyField(to='SubCategory', through='ItemSubCategory',
+                                           help_text="Subcategories to which the product belongs")
     form = models.CharField(max_length=3, choices=FORM_CHOICES,
                             help_text="The form of the product, eg. tablets, syrup etc.")
 
@@ -64,27 +211,238 @@ class Item(models.Model):
     # if 'price_sale' not null it overrides the regular 'price'
     price_sale = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True,
                                      help_text="The sale price of the product")
+    # denormalized 'price_sale' if not null else 'price' - lets price range filters use a single indexed column
+    effective_price = models.DecimalField(max_digits=6, decimal_places=2, editable=False,
+                                          help_text="The price the product is actually sold for")
 
     manufacturer = models.ForeignKey(to='Manufacturer', on_delete=models.CASCADE,
                                      help_text="The manufacturer of the product")
+    # materialized sum of the item's stock movements - changed only together with a movement (see move_stock())
     in_stock = models.PositiveBigIntegerField(help_text="Number of product pieces in stock")
     image = models.ImageField(upload_to='core/images/items', null=True, blank=True)
+    # dimensions of the original image - set once its resized variants are generated (see core.images)
+    image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    # time of the last change of the item or of its subcategories (see core.feeds)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ItemQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # serves price range filters and price ordering; rows are joined with the subcategory through-table by id
+            models.Index(fields=['effective_price', 'id'], name='core_item_eff_price_idx'),
+        ]
+
+    def set_effective_price(self):
+        self.effective_price = self.price_sale if self.price_sale is not None else self.price
+
+    def save(self, *args, **kwargs):
+        self.set_effective_price()
+        if self._state.adding:
+            with transaction.atomic(using=kwargs.get('using')):
+                super().save(*args, **kwargs)
+                if self.in_stock:
+                    StockMovement.objects.using(self._state.db).create(item=self, quantity=self.in_stock,
+                                                                       reason=StockMovement.OPENING)
+            return
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            # the stock changes only with stock movements - saving an item read before a sale must not bring
+            # the sold pieces back
+            deferred_fields = self.get_deferred_fields()
+            update_fields = [field.name for field in self._meta.concrete_fields
+                             if not field.primary_key and field.name != 'in_stock'
+                             and field.attname not in deferred_fields]
+        if 'price' not in update_fields and 'price_sale' not in update_fields:
+            super().save(*args, **{**kwargs, 'update_fields': update_fields})
+            return
+        kwargs['update_fields'] = set(update_fields) | {'effective_price'}
+        super().save(*args, **kwargs)
+        # keep the price denormalized in the subcategory links up to date
+        self.itemsubcategory_set.exclude(effective_price=self.effective_price).update(
+            effective_price=self.effective_price)
 
     def __str__(self):
         return self.name
 
 
+class ItemSubCategoryQuerySet(models.QuerySet):
+    # keeps the number of bound parameters of 'item__in' lookups below SQLite's limit
+    SYNC_BATCH_SIZE = 500
+
+    def sync_effective_price(self):
+        """
+        Copy the current 'effective_price' of the linked items to the selected links.
+        """
+        return self.update(effective_price=Subquery(
+            Item.objects.filter(pk=OuterRef('item_id')).values('effective_price')[:1]))
+
+    def sync_items(self, item_pks):
+        """
+        Copy the current 'effective_price' of the given items to all of their subcategory links.
+        """
+        item_pks = list(item_pks)
+        for i in range(0, len(item_pks), self.SYNC_BATCH_SIZE):
+            self.filter(item__in=item_pks[i:i + self.SYNC_BATCH_SIZE]).sync_effective_price()
+
+
+class ItemSubCategory(models.Model):
+    """
+    Intermediary table between Item and SubCategory tables.
+    Item's 'effective_price' is denormalized here, so that a subcategory listing filtered and ordered by price
+    is served by a single (subcategory, effective_price, item) index range scan.
+    """
+    id = models.AutoField(primary_key=True)
+    item = models.ForeignKey(to='Item', on_delete=models.CASCADE)
+    subcategory = models.ForeignKey(to='SubCategory', on_delete=models.CASCADE)
+    effective_price = models.DecimalField(max_digits=6, decimal_places=2, default=0,
+                                          help_text="Copy of the item's effective price")
+
+    objects = ItemSubCategoryQuerySet.as_manager()
+
+    class Meta:
+        db_table = 'core_item_subcategories'
+        unique_together = [('item', 'subcategory')]
+        indexes = [
+            models.Index(fields=['subcategory', 'effective_price', 'item'], name='core_itemsub_price_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.effective_price = self.item.effective_price
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.item} in {self.subcategory}"
+
+
+class StockMovement(models.Model):
+    """
+    Append-only ledger of the stock: every change of Item.in_stock is recorded as a movement (in the same
+    transaction, see ItemQuerySet.move_stock()), so 'in_stock' always equals the sum of the item's movements.
+    The 'reconcile_stock' command verifies that.
+    """
+    OPENING = 'opening'  # stock of a new item (or the balance of compacted movements)
+    SALE = 'sale'
+    RESTOCK = 'restock'
+    ADJUSTMENT = 'adjustment'  # e.g. stocktaking, damaged pieces
+    CANCELLATION = 'cancellation'  # pieces of a cancelled order returned to the stock
+
+    REASON_CHOICES = (
+        (OPENING, 'Stan początkowy'),
+        (SALE, 'Sprzedaż'),
+        (RESTOCK, 'Dostawa'),
+        (ADJUSTMENT, 'Korekta'),
+        (CANCELLATION, 'Anulowanie zamówienia'),
+    )
+
+    item = models.ForeignKey(to='Item', on_delete=models.CASCADE)
+    quantity = models.BigIntegerField(help_text="Number of pieces added to the stock (negative for pieces taken)")
+    reason = models.CharField(max_length=max(len(s[0]) for s in REASON_CHOICES), choices=REASON_CHOICES)
+    order = models.ForeignKey(to='Order', on_delete=models.SET_NULL, null=True, blank=True,
+                              help_text="The order the pieces were sold in or returned from")
+    note = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Stock movements cannot be changed")
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.quantity:+} of {self.item} ({self.get_reason_display()})"
+
+
+def not_enough_pieces_error(item):
+    return ValidationError({'n_pieces': f"Niewystarczająca liczba sztuk {item.name} na stanie!"})
+
+
 class Cart(models.Model):
     user = models.OneToOneField(to=settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True,
                                 help_text="User account associated with this cart (null if user is not logged in)")
     session = models.CharField(max_length=32, null=True,
                                help_text="Session ID used to maintain cart if the user is not logged in")
     items = models.ManyToManyField(to='Item', through='CartItem', help_text="Items that are in the cart")
+    # bumped whenever the lines of the cart change - anonymous carts untouched for long are pruned (see prune_carts)
+    updated_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at'], name='core_cart_updated_at_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user if self.user is not None else 'Anonymous user'}'s cart"
 
 
+PRICE_QUANTUM = Decimal("0.01")
+
+
+class CartItemQuerySet(models.QuerySet):
+    # the sale price (if set) overrides the regular price
+    EFFECTIVE_PRICE = F('item__effective_price')
+    LINE_TOTAL = ExpressionWrapper(EFFECTIVE_PRICE * F('n_pieces'),
+                                   output_field=DecimalField(max_digits=9, decimal_places=2))
+
+    def for_cart(self, cart):
+        """
+        Cart lines of the given cart with their items and prices fetched in a single query.
+        """
+        return self.filter(cart=cart).with_prices().order_by('item__name')
+
+    def with_prices(self):
+        """
+        Join the items and annotate each line with 'effective_price' and 'line_total' computed by the database.
+        """
+        return self.select_related('item').annotate(effective_price=self.EFFECTIVE_PRICE, line_total=self.LINE_TOTAL)
+
+    def total_price(self):
+        """
+        Total price of the lines computed with a single aggregate query.
+        """
+        total_price = self.order_by().aggregate(total_price=Sum(self.LINE_TOTAL))['total_price']
+        if total_price is None:
+            return Decimal("0.00")
+        # SQLite computes decimal arithmetic in floating point - round back to grosze
+        return Decimal(total_price).quantize(PRICE_QUANTUM)
+
+    def summary(self):
+        """
+        Number of pieces and total price of the lines computed with a single aggregate query.
+        :return: dict(n_pieces: int, total_price: Decimal)
+        """
+        summary = self.order_by().aggregate(n_pieces=Sum('n_pieces'), total_price=Sum(self.LINE_TOTAL))
+        total_price = Decimal(summary['total_price'] or 0).quantize(PRICE_QUANTUM)
+        return {'n_pieces': summary['n_pieces'] or 0, 'total_price': total_price}
+
+    def merge_carts(self, source_cart_pk, target_cart_pk):
+        """
+        Add the lines of the source cart to the target cart with a single INSERT ... SELECT ... ON CONFLICT DO UPDATE:
+        pieces of items already in the target cart are added up, and every line is capped by the stock of its item.
+        Lines of items out of stock are skipped. The source cart is left as it is.
+        """
+        connection = connections[self.db]
+        quote_name = connection.ops.quote_name
+        table = quote_name(self.model._meta.db_table)
+        item_table = quote_name(Item._meta.db_table)
+        cart, item, n_pieces = (quote_name(self.model._meta.get_field(name).column)
+                                for name in ('cart', 'item', 'n_pieces'))
+        item_pk, in_stock = quote_name(Item._meta.pk.column), quote_name(Item._meta.get_field('in_stock').column)
+        stock = f"(SELECT {in_stock} FROM {item_table} WHERE {item_table}.{item_pk} = excluded.{item})"
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({cart}, {item}, {n_pieces}) "
+                f"SELECT %s, line.{item}, CASE WHEN line.{n_pieces} < stock_item.{in_stock} "
+                f"THEN line.{n_pieces} ELSE stock_item.{in_stock} END "
+                f"FROM {table} line INNER JOIN {item_table} stock_item ON stock_item.{item_pk} = line.{item} "
+                f"WHERE line.{cart} = %s AND stock_item.{in_stock} > 0 "
+                f"ON CONFLICT ({cart}, {item}) DO UPDATE SET {n_pieces} = "
+                f"CASE WHEN {table}.{n_pieces} + excluded.{n_pieces} < {stock} "
+                f"THEN {table}.{n_pieces} + excluded.{n_pieces} ELSE {stock} END",
+                [target_cart_pk, source_cart_pk])
+
+
 class CartItem(models.Model):
     """
     Intermediary table between Cart and Item tables.
@@ -93,16 +451,32 @@ class CartItem(models.Model):
     item = models.ForeignKey(to='Item', on_delete=models.CASCADE)
     n_pieces = models.PositiveIntegerField(help_text="Number of ordered item pieces")
 
+    objects = CartItemQuerySet.as_manager()
+
+    class Meta:
+        # an item has a single line in a cart (see CartItemQuerySet.merge_carts())
+        unique_together = [('cart', 'item')]
+
     def validate_enough_pieces(self):
         if self.n_pieces > self.item.in_stock:
-            raise ValidationError({'n_pieces': f"Niewystarczająca liczba sztuk {self.item.name} na stanie!"})
+            raise not_enough_pieces_error(self.item)
 
     def clean(self, *args, **kwargs):
         self.validate_enough_pieces()
 
     def save(self, *args, **kwargs):
-        self.full_clean()
+        # the foreign keys and the (cart, item) uniqueness are enforced by the database constraints
+        self.full_clean(exclude=['cart', 'item'], validate_unique=False)
         super().save(*args, **kwargs)
+        self.touch_cart()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.touch_cart()
+        return result
+
+    def touch_cart(self):
+        Cart.objects.filter(pk=self.cart_id).update(updated_at=timezone.now())
 
     def __str__(self):
         return f"{self.n_pieces}szt. {self.item}"
@@ -165,6 +539,27 @@ class Customer(models.Model):
             return f"{self.first_name} {self.last_name}"
 
 
+class OrderQuerySet(models.QuerySet):
+
+    def for_customer(self, customer):
+        """
+        Orders of the customer, newest first - served by the (customer, -date) index.
+        """
+        return self.filter(customer=customer).order_by('-date')
+
+    def active(self):
+        """
+        Orders still on their way to the customer (neither completed nor cancelled).
+        """
+        return self.filter(status__in=Order.ACTIVE_STATUSES)
+
+    def with_lines(self):
+        """
+        Prefetch the order lines with their items (two queries for all the orders).
+        """
+        return self.prefetch_related(Prefetch('orderitem_set', queryset=OrderItem.objects.select_related('item')))
+
+
 class Order(models.Model):
     AWAITING_PAYMENT = 'pre_payment'  # Customer has completed the checkout process, but payment has yet to be confirmed.
     PROCESSING = 'processing'  # Customer has completed the checkout process and payment has been confirmed.
@@ -179,6 +574,9 @@ class Order(models.Model):
         (COMPLETED, 'Zrealizowano'),
         (CANCELLED, 'Anulowano')
     )
+    ACTIVE_STATUSES = (AWAITING_PAYMENT, PROCESSING, SHIPPED)
+    # the pieces of shipped and completed orders have left the pharmacy - such orders cannot be cancelled
+    CANCELLABLE_STATUSES = (AWAITING_PAYMENT, PROCESSING)
 
     DHL = 'dhl'
     INPOST = 'inpost'
@@ -223,6 +621,53 @@ class Order(models.Model):
 
     address = models.ForeignKey(to="Address", on_delete=models.CASCADE)
 
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # order history of a customer, newest first
+            models.Index(fields=['customer', '-date'], name='core_order_customer_date_idx'),
+            # orders of a day (see the 'rebuild_sales_rollups' command)
+            models.Index(fields=['date'], name='core_order_date_idx'),
+        ]
+
+    def counts_as_sale(self):
+        return self.status != Order.CANCELLED
+
+    def record_sales(self, sign=1):
+        """
+        Add the order to the daily sales rollups of the day it was placed (or remove it with sign=-1, e.g. when
+        it is cancelled) - two upserts adding to the existing rows.
+        """
+        day = timezone.localdate(self.date)
+        lines = self.orderitem_set.order_by().values_list('item', 'n_pieces', 'unit_price')
+        DailyItemSales.objects.increment([
+            DailyItemSales(date=day, item_id=item_pk, n_orders=sign, n_pieces=sign * n_pieces,
+                           revenue=sign * n_pieces * unit_price)
+            for item_pk, n_pieces, unit_price in lines
+        ])
+        DailyOrderSales.objects.increment([
+            DailyOrderSales(date=day, delivery_method=self.delivery_method, payment_method=self.payment_method,
+                            n_orders=sign, revenue=sign * self.total_price)
+        ])
+
+    def cancel(self):
+        """
+        Cancel the order, returning its pieces to the stock.
+        :return: False if the order has already been cancelled, shipped or completed (nothing is changed then)
+        """
+        with transaction.atomic():
+            # the conditional UPDATE lets only one of concurrent cancellations return the pieces
+            if not Order.objects.filter(pk=self.pk, status__in=Order.CANCELLABLE_STATUSES).update(
+                    status=Order.CANCELLED):
+                return False
+            self.status = Order.CANCELLED
+            self.record_sales(sign=-1)
+            for order_item in self.orderitem_set.order_by('item'):
+                Item.objects.move_stock(order_item.item_id, order_item.n_pieces, StockMovement.CANCELLATION,
+                                        order=self)
+        return True
+
     def __str__(self):
         return f"Order #{self.id}"
 
@@ -234,15 +679,20 @@ class OrderItem(models.Model):
     item = models.ForeignKey(to='Item', on_delete=models.CASCADE)
     order = models.ForeignKey(to='Order', on_delete=models.CASCADE)
     n_pieces = models.PositiveIntegerField(help_text="Number of ordered item pieces")
+    unit_price = models.DecimalField(max_digits=6, decimal_places=2,
+                                     help_text="Price of a piece when ordered (the effective price of the item)")
 
     def validate_enough_pieces(self):
         if self.n_pieces > self.item.in_stock:
-            raise ValidationError({'n_pieces': f"Niewystarczająca liczba sztuk {self.item.name} na stanie!"})
+            raise not_enough_pieces_error(self.item)
 
     def clean(self, *args, **kwargs):
         self.validate_enough_pieces()
 
     def save(self, *args, **kwargs):
+        if self.unit_price is None:
+            # lines created one by one are priced like in place_order()
+            self.unit_price = self.item.effective_price
         self.full_clean()
         super().save(*args, **kwargs)
 
@@ -279,3 +729,128 @@ class Address(models.Model):
 
     def __str__(self):
         return f"{self.street} {self.street_number}{'/' + self.local_number if self.local_number else ''} {self.postal_code} {self.city} {self.country}"
+
+
+class JobQuerySet(models.QuerySet):
+
+    def runnable(self, now=None):
+        """
+        Jobs due to run - queued ones and those whose worker has not finished them within JOB_LOCK_TIMEOUT
+        (e.g. it was killed).
+        """
+        now = now or timezone.now()
+        return self.filter(Q(status=Job.QUEUED, run_at__lte=now) |
+                           Q(status=Job.RUNNING, locked_at__lt=now - timedelta(seconds=settings.JOB_LOCK_TIMEOUT)))
+
+
+class Job(models.Model):
+    """
+    Background job run by the 'run_workers' command (see core.jobs). Finished jobs are deleted.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DEAD = 'dead'  # failed max_attempts times - kept for inspection (and requeuing in the admin)
+
+    STATUS_CHOICES = (
+        (QUEUED, 'W kolejce'),
+        (RUNNING, 'W trakcie'),
+        (DEAD, 'Nieudane'),
+    )
+
+    name = models.CharField(max_length=100, help_text="Registered name of the job function")
+    payload = models.JSONField(default=dict, blank=True, help_text="Keyword arguments of the job function")
+    status = models.CharField(max_length=max(len(s[0]) for s in STATUS_CHOICES), choices=STATUS_CHOICES,
+                              default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now, help_text="The job is not run before this time")
+    locked_by = models.CharField(max_length=100, blank=True, help_text="Worker running the job")
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = JobQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # workers look for the earliest runnable job
+            models.Index(fields=['status', 'run_at'], name='core_job_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.get_status_display()})"
+
+
+class RollupQuerySet(models.QuerySet):
+
+    def increment(self, objs):
+        """
+        Add the counters of the objects to the rows with the same key (the unique_together fields of the model),
+        inserting the missing rows - INSERT ... ON CONFLICT DO UPDATE SET counter = counter + excluded.counter.
+        """
+        objs = list(objs)
+        if not objs:
+            return
+        connection = connections[self.db]
+        quote_name = connection.ops.quote_name
+        table = quote_name(self.model._meta.db_table)
+        key_fields = [self.model._meta.get_field(name) for name in self.model._meta.unique_together[0]]
+        fields = [field for field in self.model._meta.concrete_fields if not field.primary_key]
+        counter_columns = [quote_name(field.column) for field in fields if field not in key_fields]
+
+        columns = ", ".join(quote_name(field.column) for field in fields)
+        row_placeholder = f"({', '.join(['%s'] * len(fields))})"
+        conflict_columns = ", ".join(quote_name(field.column) for field in key_fields)
+        updates = ", ".join(f"{column} = {table}.{column} + excluded.{column}" for column in counter_columns)
+
+        batch_size = connection.ops.bulk_batch_size(fields, objs)
+        with transaction.atomic(using=self.db, savepoint=False), connection.cursor() as cursor:
+            for i in range(0, len(objs), batch_size):
+                batch = objs[i:i + batch_size]
+                params = [field.get_db_prep_save(getattr(obj, field.attname), connection)
+                          for obj in batch for field in fields]
+                cursor.execute(f"INSERT INTO {table} ({columns}) VALUES {', '.join([row_placeholder] * len(batch))} "
+                               f"ON CONFLICT ({conflict_columns}) DO UPDATE SET {updates}", params)
+
+
+class DailyItemSales(models.Model):
+    """
+    Sales of an item on a day (rollup of the lines of the not cancelled orders placed that day) - maintained
+    incrementally by Order.record_sales() and rebuilt by the 'rebuild_sales_rollups' command.
+    """
+    date = models.DateField()
+    item = models.ForeignKey(to='Item', on_delete=models.CASCADE)
+    n_orders = models.IntegerField(default=0)
+    n_pieces = models.BigIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    objects = RollupQuerySet.as_manager()
+
+    class Meta:
+        unique_together = [('date', 'item')]
+        verbose_name_plural = "Daily item sales"
+
+    def __str__(self):
+        return f"{self.date} {self.item}: {self.n_pieces} szt."
+
+
+class DailyOrderSales(models.Model):
+    """
+    Orders and revenue of a day per delivery and payment method (rollup of the not cancelled orders placed that day).
+    """
+    date = models.DateField()
+    delivery_method = models.CharField(max_length=max(len(s[0]) for s in Order.DELIVERY_METHOD_CHOICES),
+                                       choices=Order.DELIVERY_METHOD_CHOICES)
+    payment_method = models.CharField(max_length=max(len(s[0]) for s in Order.PAYMENT_METHOD_CHOICES),
+                                      choices=Order.PAYMENT_METHOD_CHOICES)
+    n_orders = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    objects = RollupQuerySet.as_manager()
+
+    class Meta:
+        unique_together = [('date', 'delivery_method', 'payment_method')]
+        verbose_name_plural = "Daily order sales"
+
+    def __str__(self):
+        return f"{self.date} {self.get_delivery_method_display()} / {self.get_payment_method_display()}"
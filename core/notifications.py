@@ -0,0 +1,48 @@
+"""
+E-mails of the shop, sent by background jobs (see core.jobs) rather than in the requests.
+"""
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, mail_managers, send_mail
+from django.template.loader import render_to_string
+
+from .jobs import enqueue, job
+from .models import Item, Order
+
+
+@job
+def send_email(subject, body, to, from_email=None, alternatives=(), content_subtype="plain"):
+    message = EmailMultiAlternatives(subject, body, from_email, to,
+                                     alternatives=[tuple(alternative) for alternative in alternatives])
+    message.content_subtype = content_subtype
+    message.send()
+
+
+def enqueue_email(message):
+    """
+    Send the rendered e-mail message (e.g. EmailMultiAlternatives) by a background job.
+    """
+    return enqueue(send_email, subject=message.subject, body=message.body, to=list(message.to),
+                   from_email=message.from_email, alternatives=list(getattr(message, "alternatives", [])),
+                   content_subtype=message.content_subtype)
+
+
+@job
+def send_order_confirmation(order_pk):
+    order = Order.objects.select_related('customer__user', 'address').filter(pk=order_pk).first()
+    # guests leave no e-mail address
+    if order is None or order.customer.user is None or not order.customer.user.email:
+        return
+    order_items = order.orderitem_set.select_related('item').order_by('pk')
+    body = render_to_string("core/emails/order_confirmation.txt", {"order": order, "order_items": order_items})
+    send_mail(f"Potwierdzenie zamówienia #{order.pk}", body, None, [order.customer.user.email])
+
+
+@job
+def check_stock_levels(item_pks):
+    """
+    Let the managers know about the items running out of stock (below STOCK_ALERT_THRESHOLD pieces).
+    """
+    items = Item.objects.filter(pk__in=item_pks, in_stock__lt=settings.STOCK_ALERT_THRESHOLD).order_by('in_stock')
+    lines = [f"{item.name} (#{item.pk}): {item.in_stock} szt." for item in items]
+    if lines:
+        mail_managers("Kończące się produkty", "Produkty, których zostało niewiele na stanie:\n" + "\n".join(lines))
@@ -0,0 +1,103 @@
+from django.core import signing
+from django.db.models import Q
+
+CURSOR_SALT = "core.pagination.cursor"
+
+NEXT = "n"
+PREVIOUS = "p"
+
+
+class KeysetPage:
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    Cursor-based paginator ordering by (key, pk).
+    Every page is fetched with a "WHERE (key, pk) > (last key, last pk) ORDER BY key, pk LIMIT n" query,
+    so a deep page costs the same as the first one (unlike OFFSET pagination).
+
+    Cursors are signed tokens holding the ordering and the (key, pk) position only, so they stay valid
+    when the filters (e.g. the price range) change.
+    """
+
+    def __init__(self, queryset, key_field, per_page, filters=None, key_attr=None, name=None):
+        """
+        :param queryset: base queryset
+        :param key_field: ordering field (may span relations)
+        :param per_page: number of objects per page
+        :param filters: Q object with the filters - the keyset condition is added in the same filter() call,
+                        so that conditions on multi-valued relations share one join
+        :param key_attr: attribute of the objects holding the key value (defaults to key_field)
+        :param name: name of the ordering stored in the cursors (defaults to key_field)
+        """
+        self.queryset = queryset
+        self.key_field = key_field
+        self.key_attr = key_attr or key_field
+        self.per_page = per_page
+        self.filters = filters if filters is not None else Q()
+        self.name = name or key_field
+
+    def encode_cursor(self, obj, direction):
+        return signing.dumps([self.name, direction, str(getattr(obj, self.key_attr)), obj.pk], salt=CURSOR_SALT)
+
+    def decode_cursor(self, cursor):
+        """
+        :return: tuple(direction, key value, pk) or None if the cursor is missing, invalid or for another ordering
+        """
+        if not cursor:
+            return None
+        try:
+            name, direction, key, pk = signing.loads(cursor, salt=CURSOR_SALT)
+        except (signing.BadSignature, TypeError, ValueError):
+            return None
+        if name != self.name or direction not in (NEXT, PREVIOUS):
+            return None
+        return direction, key, pk
+
+    def page(self, cursor=None):
+        position = self.decode_cursor(cursor)
+        if position is None:
+            direction, position_q = NEXT, Q()
+        else:
+            direction, key, pk = position
+            lookup = "gt" if direction == NEXT else "lt"
+            position_q = (Q(**{f"{self.key_field}__{lookup}": key}) |
+                          Q(**{self.key_field: key, f"pk__{lookup}": pk}))
+
+        ordering = (self.key_field, "pk") if direction == NEXT else (f"-{self.key_field}", "-pk")
+        # one extra row tells whether there is a page further in the fetch direction
+        object_list = list(self.queryset.filter(self.filters & position_q).order_by(*ordering)[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+
+        if direction == PREVIOUS:
+            object_list.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, position is not None
+
+        if not object_list:
+            return KeysetPage(object_list)
+        return KeysetPage(object_list,
+                          next_cursor=self.encode_cursor(object_list[-1], NEXT) if has_next else None,
+                          previous_cursor=self.encode_cursor(object_list[0], PREVIOUS) if has_previous else None)
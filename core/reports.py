@@ -0,0 +1,107 @@
+"""
+Sales reports read from the daily rollup tables (DailyItemSales, DailyOrderSales) only, so their cost depends on
+the number of reported days rather than on the size of the order history.
+
+The rollups hold the not cancelled orders of every day: place_order() adds an order once its lines exist,
+Order.cancel() and deleting the order (see core.signals) remove it again. rebuild_day() recomputes the rollups
+of a day from the orders - the 'rebuild_sales_rollups' command backfills them.
+"""
+import datetime
+from decimal import Decimal
+
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum
+from django.utils import timezone
+
+from .models import DailyItemSales, DailyOrderSales, Item, Order, OrderItem, PRICE_QUANTUM
+from .transactions import immediate_atomic
+
+LINE_REVENUE = ExpressionWrapper(F('n_pieces') * F('unit_price'), output_field=DecimalField(max_digits=12,
+                                                                                            decimal_places=2))
+
+
+def day_range(day):
+    """
+    :return: tuple(start, end) of the day in the current time zone (as aware datetimes)
+    """
+    start = timezone.make_aware(datetime.datetime.combine(day, datetime.time()))
+    return start, timezone.make_aware(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()))
+
+
+def rebuild_day(day):
+    """
+    Replace the rollups of the day with the ones computed from its orders, in a transaction holding the write lock,
+    so that no order placed meanwhile is lost or counted twice.
+    :return: number of the orders of the day counted as sales
+    """
+    start, end = day_range(day)
+    with immediate_atomic():
+        DailyItemSales.objects.filter(date=day).delete()
+        DailyOrderSales.objects.filter(date=day).delete()
+        orders = Order.objects.filter(date__gte=start, date__lt=end).exclude(status=Order.CANCELLED)
+        lines = OrderItem.objects.filter(order__in=orders)
+        DailyItemSales.objects.bulk_create([
+            DailyItemSales(date=day, item_id=row['item'], n_orders=row['total_orders'], n_pieces=row['total_pieces'],
+                           revenue=row['total_revenue'])
+            # the annotations must not shadow the line columns used in LINE_REVENUE
+            for row in lines.values('item').order_by('item').annotate(
+                total_orders=Count('order', distinct=True), total_pieces=Sum('n_pieces'),
+                total_revenue=Sum(LINE_REVENUE))
+        ])
+        method_rows = list(orders.values('delivery_method', 'payment_method').order_by().annotate(
+            n_orders=Count('pk'), revenue=Sum('total_price')))
+        DailyOrderSales.objects.bulk_create([DailyOrderSales(date=day, **row) for row in method_rows])
+    return sum(row['n_orders'] for row in method_rows)
+
+
+def order_days(since=None):
+    """
+    :return: the days (in the current time zone) with any orders, from 'since' on
+    """
+    orders = Order.objects.all()
+    if since is not None:
+        orders = orders.filter(date__gte=day_range(since)[0])
+    return list(orders.dates('date', 'day'))
+
+
+def quantize(amount):
+    # SQLite sums decimals in floating point - round back to grosze
+    return Decimal(amount or 0).quantize(PRICE_QUANTUM)
+
+
+def sales_report(start, end, n_top_items=20):
+    """
+    Sales of the days from 'start' to 'end' (inclusive) read from the rollups.
+    :return: dict with the totals, the per day rows, the per delivery and per payment method rows and the top items
+    (rows with 'total_orders' or 'total_pieces' and 'total_revenue')
+    """
+    order_sales = DailyOrderSales.objects.filter(date__gte=start, date__lte=end).order_by()
+    totals = order_sales.aggregate(total_orders=Sum('n_orders'), total_revenue=Sum('revenue'))
+
+    def grouped(field, labels=None):
+        # rows of cancelled orders stay in the rollups with zeros
+        rows = list(order_sales.values(field).order_by(field)
+                    .annotate(total_orders=Sum('n_orders'), total_revenue=Sum('revenue'))
+                    .filter(total_orders__gt=0))
+        for row in rows:
+            row['total_revenue'] = quantize(row['total_revenue'])
+            if labels is not None:
+                row['label'] = labels.get(row[field], row[field])
+        return rows
+
+    top_items = list(DailyItemSales.objects.filter(date__gte=start, date__lte=end)
+                     .values('item').order_by().annotate(total_pieces=Sum('n_pieces'), total_revenue=Sum('revenue'))
+                     .filter(total_pieces__gt=0).order_by('-total_revenue', 'item')[:n_top_items])
+    # names of the listed items only
+    names = dict(Item.objects.filter(pk__in=[row['item'] for row in top_items]).values_list('pk', 'name'))
+    for row in top_items:
+        row['name'] = names.get(row['item'], "")
+        row['total_revenue'] = quantize(row['total_revenue'])
+
+    return {
+        'total_orders': totals['total_orders'] or 0,
+        'total_revenue': quantize(totals['total_revenue']),
+        'days': grouped('date'),
+        'delivery_methods': grouped('delivery_method', dict(Order.DELIVERY_METHOD_CHOICES)),
+        'payment_methods': grouped('payment_method', dict(Order.PAYMENT_METHOD_CHOICES)),
+        'top_items': top_items,
+    }
@@ -0,0 +1,157 @@
+"""
+Read replicas of the 'default' database for the catalog.
+
+settings.DATABASE_REPLICAS lists the aliases of DATABASES entries kept in sync with 'default' by replication
+outside of Django (e.g. Litestream/LiteFS for SQLite). Reads go to the primary ('default'), except for those made
+inside replica_reads() - the catalog views decorated with read_from_replicas. Carts, checkout, accounts and the admin
+always use the primary. So does the navbar category tree: it is cached until a signal invalidates it, and rebuilding
+it from a replica that has not caught up yet would cache the stale tree.
+
+Replicas lag behind the primary, so ReplicaRoutingMiddleware pins a session to the primary for
+DATABASE_REPLICA_STICKY_SECONDS after each of its writing (e.g. POST) requests - visitors always see their own writes.
+"""
+import asyncio
+import functools
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS
+
+# the session is read from the primary until this timestamp
+PRIMARY_UNTIL_SESSION_KEY = "db_primary_until"
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# replica alias the reads of the current request go to (None - the primary)
+_replica = ContextVar("replica", default=None)
+
+
+def replicas_allowed(request):
+    """
+    :return: True if reads of the request may go to a replica (the request does not write and its session
+             has not written recently)
+    """
+    if not settings.DATABASE_REPLICAS or request.method not in SAFE_METHODS:
+        return False
+    session = getattr(request, "session", None)
+    return session is None or session.get(PRIMARY_UNTIL_SESSION_KEY, 0) <= time.time()
+
+
+def reading_from_replica():
+    """
+    :return: True inside replica_reads() of a request allowed to read from a replica
+    """
+    return _replica.get() is not None
+
+
+@contextmanager
+def replica_reads(request):
+    """
+    Route the reads made in the block to one replica (picked at random, the same one for the whole block,
+    so that a page is not built from replicas lagging by different amounts) if the request allows it.
+    """
+    alias = random.choice(settings.DATABASE_REPLICAS) if replicas_allowed(request) else None
+    if alias is not None and hasattr(request, "user"):
+        # the (lazy) user belongs to the account flows - load it from the primary before switching
+        request.user.is_authenticated
+    token = _replica.set(alias)
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Route the reads made in the block to the primary, also inside replica_reads().
+    """
+    token = _replica.set(None)
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+def read_from_replicas(view):
+    """
+    Decorator for catalog views (use method_decorator() for class-based views).
+    """
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with replica_reads(request):
+            response = view(request, *args, **kwargs)
+            # a TemplateResponse (e.g. of ListView) queries while rendering - render it inside the block
+            if hasattr(response, "render") and not getattr(response, "is_rendered", True):
+                response.render()
+            return response
+
+    return wrapper
+
+
+class PrimaryReplicaRouter:
+    """
+    All writes and migrations go to the primary, reads to the primary or - inside replica_reads() - a replica.
+    """
+
+    def db_for_read(self, model, **hints):
+        # the primary also for related objects of instances read from a replica outside of replica_reads()
+        return _replica.get() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema through replication
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Pin the session to the primary after it writes (must come after SessionMiddleware).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # tells Django to call (and await) the middleware as a coroutine function under ASGI
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        response = self.get_response(request)
+        self.pin_to_primary(request)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if request.method not in SAFE_METHODS:
+            # the session may have to be loaded from the database
+            await sync_to_async(self.pin_to_primary)(request)
+        return response
+
+    @staticmethod
+    def pin_to_primary(request):
+        if request.method not in SAFE_METHODS and hasattr(request, "session"):
+            request.session[PRIMARY_UNTIL_SESSION_KEY] = time.time() + settings.DATABASE_REPLICA_STICKY_SECONDS
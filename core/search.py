@@ -0,0 +1,159 @@
+"""
+Full-text product search backed by an SQLite FTS5 virtual table.
+
+The table 'core_item_fts' holds one row per item (rowid = Item.pk) with the item's name, composition, description
+and manufacturer name. Indexed texts and queries are folded the same way (lowercase, Polish diacritics removed),
+so "łagodzi" matches "lagodzi" and the other way round. Results are ranked with BM25.
+"""
+import re
+
+from django.db import connection, transaction
+
+from .models import Item
+
+SEARCH_TABLE = "core_item_fts"
+
+# name matches weigh the most, then manufacturer, composition and description
+BM25_WEIGHTS = {"name": 10.0, "composition": 2.0, "description": 1.0, "manufacturer": 4.0}
+
+CREATE_SEARCH_TABLE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+    f"{', '.join(BM25_WEIGHTS)}, "
+    # unicode61 strips most diacritics, but not 'ł' which has no decomposition - see fold()
+    f"tokenize = 'unicode61 remove_diacritics 2', "
+    # prefix indexes make 'as-you-type' prefix queries cheap
+    f"prefix = '2 3')"
+)
+CONFIGURE_RANK_SQL = (
+    f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rank) "
+    f"VALUES ('rank', 'bm25({', '.join(str(weight) for weight in BM25_WEIGHTS.values())})')"
+)
+DROP_SEARCH_TABLE_SQL = f"DROP TABLE IF EXISTS {SEARCH_TABLE}"
+
+POLISH_TRANSLATION = str.maketrans("ąćęłńóśźżĄĆĘŁŃÓŚŹŻ", "acelnoszzACELNOSZZ")
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# keeps the number of bound parameters below SQLite's limit
+BATCH_SIZE = 500
+
+# counting stops here - nobody pages through more results and it bounds the cost of very common words
+MAX_RESULTS = 1000
+
+
+def fold(text):
+    return (text or "").translate(POLISH_TRANSLATION).lower()
+
+
+def item_row(item):
+    """
+    Row of the search table for the item (the item must have its manufacturer loaded to avoid extra queries).
+    """
+    return (item.pk, fold(item.name), fold(item.composition), fold(item.description), fold(item.manufacturer.name))
+
+
+def write_rows(cursor, rows):
+    rows = list(rows)
+    for i in range(0, len(rows), BATCH_SIZE):
+        batch = rows[i:i + BATCH_SIZE]
+        delete_rows(cursor, [row[0] for row in batch])
+        cursor.executemany(f"INSERT INTO {SEARCH_TABLE}(rowid, {', '.join(BM25_WEIGHTS)}) VALUES (%s, %s, %s, %s, %s)",
+                           batch)
+
+
+def delete_rows(cursor, item_pks):
+    item_pks = list(item_pks)
+    for i in range(0, len(item_pks), BATCH_SIZE):
+        batch = item_pks[i:i + BATCH_SIZE]
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({', '.join(['%s'] * len(batch))})", batch)
+
+
+def index_items(items):
+    """
+    Add or refresh the search rows of the given items (an iterable of Item instances or a queryset).
+    """
+    if hasattr(items, "select_related"):
+        items = items.select_related("manufacturer").iterator(chunk_size=BATCH_SIZE)
+    with connection.cursor() as cursor:
+        write_rows(cursor, (item_row(item) for item in items))
+
+
+def remove_items(item_pks):
+    with connection.cursor() as cursor:
+        delete_rows(cursor, item_pks)
+
+
+def rebuild_index(item_model=Item, batch_size=5000, progress=None):
+    """
+    Recreate the search rows of all items in batches.
+    :param item_model: Item model (a historical model when called from a migration)
+    :param progress: optional callable receiving the number of items indexed so far
+    :return: number of indexed items
+    """
+    n_indexed = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+        batch = []
+        for item in item_model.objects.select_related("manufacturer").order_by("pk").iterator(chunk_size=batch_size):
+            batch.append(item_row(item))
+            if len(batch) == batch_size:
+                write_rows(cursor, batch)
+                n_indexed += len(batch)
+                batch = []
+                if progress is not None:
+                    progress(n_indexed)
+        write_rows(cursor, batch)
+        n_indexed += len(batch)
+        # merge the b-tree segments created by the batches
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('optimize')")
+    return n_indexed
+
+
+def build_match_query(text):
+    """
+    Translate user input into an FTS5 MATCH expression: every word must match (as a prefix) in any column.
+    User input is never passed to MATCH verbatim, so FTS5 query syntax characters cannot break the query.
+    :return: MATCH expression or None if the input contains no words
+    """
+    tokens = TOKEN_PATTERN.findall(fold(text))
+    if not tokens:
+        return None
+    return " ".join(f'"{token}"*' for token in tokens)
+
+
+class SearchResults:
+    """
+    Lazy, sliceable sequence of items matching the query, ordered by relevance.
+    Works with django.core.paginator.Paginator: count() and every page cost one indexed FTS query each.
+    """
+
+    def __init__(self, text):
+        self.match_query = build_match_query(text)
+
+    def count(self):
+        """
+        Number of matching items, capped at MAX_RESULTS.
+        """
+        if self.match_query is None:
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM (SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s "
+                           f"LIMIT %s)", [self.match_query, MAX_RESULTS])
+            return cursor.fetchone()[0]
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        if self.match_query is None:
+            return []
+        offset = key.start or 0
+        limit = -1 if key.stop is None else max(key.stop - offset, 0)
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s "
+                           f"ORDER BY rank LIMIT %s OFFSET %s", [self.match_query, limit, offset])
+            item_pks = [row[0] for row in cursor.fetchall()]
+        items = Item.objects.in_bulk(item_pks)
+        # rows of items deleted behind the index's back (e.g. by a raw query) are skipped
+        return [items[item_pk] for item_pk in item_pks if item_pk in items]
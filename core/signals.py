@@ -0,0 +1,137 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import *
+from .context_processors import invalidate_category_tree
+from .catalog_cache import catalog_changed
+from .cart import merge_session_cart
+from . import images, search
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=SubCategory)
+@receiver(post_delete, sender=SubCategory)
+def category_tree_changed(sender, **kwargs):
+    """
+    Drop the cached navbar category tree whenever a category or a subcategory changes.
+    """
+    invalidate_category_tree()
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=SubCategory)
+@receiver(post_delete, sender=SubCategory)
+@receiver(post_save, sender=Manufacturer)
+@receiver(post_delete, sender=Manufacturer)
+@receiver(post_save, sender=ItemSubCategory)
+@receiver(post_delete, sender=ItemSubCategory)
+@receiver(m2m_changed, sender=ItemSubCategory)
+def catalog_fragments_changed(sender, using, **kwargs):
+    """
+    Invalidate the cached catalog fragments (item grids and details) whenever the catalog changes.
+    """
+    catalog_changed(using)
+
+
+@receiver(m2m_changed, sender=ItemSubCategory)
+def item_subcategories_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Copy the item's effective price to subcategory links created through Item.subcategories (e.g. in the admin).
+    """
+    if action != "post_add" or not pk_set:
+        return
+    if reverse:
+        links = ItemSubCategory.objects.filter(subcategory=instance, item__in=pk_set)
+    else:
+        links = ItemSubCategory.objects.filter(item=instance, subcategory__in=pk_set)
+    links.sync_effective_price()
+
+
+@receiver(post_save, sender=ItemSubCategory)
+@receiver(post_delete, sender=ItemSubCategory)
+@receiver(m2m_changed, sender=ItemSubCategory)
+def touch_linked_items(sender, instance, action=None, reverse=False, pk_set=None, raw=False, **kwargs):
+    """
+    Product feeds list the category of an item - a change of its subcategories counts as a change of the item.
+    """
+    if raw or action not in (None, "post_add", "post_remove", "pre_clear"):
+        return
+    if action is None:
+        items = Item.objects.filter(pk=instance.item_id)
+    elif reverse:
+        # all items of the subcategory when it is cleared
+        items = Item.objects.filter(pk__in=pk_set) if pk_set is not None else instance.item_set.all()
+    else:
+        items = Item.objects.filter(pk=instance.pk)
+    items.update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Item)
+def index_item(sender, instance, raw=False, **kwargs):
+    """
+    Keep the full-text search row of the item in sync with its texts.
+    """
+    if not raw:
+        search.index_items([instance])
+
+
+@receiver(post_delete, sender=Item)
+def unindex_item(sender, instance, **kwargs):
+    search.remove_items([instance.pk])
+
+
+@receiver(post_save, sender=Manufacturer)
+def index_manufacturer_items(sender, instance, created, raw=False, **kwargs):
+    """
+    The manufacturer name is searchable, so renaming a manufacturer refreshes the rows of its items.
+    """
+    if not created and not raw:
+        search.index_items(instance.item_set.all())
+        # product feeds list the manufacturer name as well
+        instance.item_set.update(updated_at=timezone.now())
+
+
+@receiver(pre_save, sender=Item)
+def reset_image_dimensions(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    A newly uploaded (or cleared) image has no variants yet - templates fall back to the original until they exist.
+    """
+    if raw or (update_fields is not None and 'image' not in update_fields):
+        return
+    instance._image_uploaded = bool(instance.image) and not instance.image._committed
+    if instance._image_uploaded or not instance.image:
+        instance.image_width = instance.image_height = None
+
+
+@receiver(post_save, sender=Item)
+def generate_image_variants(sender, instance, raw=False, **kwargs):
+    if not raw and getattr(instance, "_image_uploaded", False):
+        instance._image_uploaded = False
+        images.schedule_variants(Item, instance.image.name)
+
+
+@receiver(user_logged_in)
+def merge_cart_on_login(sender, request, user, **kwargs):
+    """
+    The anonymous cart of the visitor becomes part of the user's cart once, when the user logs in.
+    """
+    if request is not None and hasattr(request, "session"):
+        merge_session_cart(request, user)
+
+
+@receiver(pre_delete, sender=Order)
+def remove_deleted_order_sales(sender, instance, **kwargs):
+    """
+    Remove a deleted order from the daily sales rollups (a cancelled one has been removed by Order.cancel()).
+    The status of an order is not changed by saving it - cancelling goes through Order.cancel(), which returns
+    the pieces to the stock as well.
+    """
+    # the lines still exist before the order is deleted
+    if instance.counts_as_sale():
+        instance.record_sales(sign=-1)
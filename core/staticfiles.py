@@ -0,0 +1,141 @@
+"""
+Static files served straight from the application, cached by browsers and compressed ahead of time.
+
+collectstatic (with CompressedManifestStaticFilesStorage) writes content-hashed copies of the files
+(e.g. 'css/base.3f2a1c9e.css') and gzip/brotli compressed siblings of the text ones ('.gz'/'.br').
+PrecompressedStaticMiddleware serves them from STATIC_ROOT: the smallest variant the client accepts, with far-future
+'Cache-Control' for the hashed names - their content never changes, a new version gets a new name.
+
+Brotli compression needs the optional 'brotli' package; without it only '.gz' files are written.
+"""
+import asyncio
+import gzip
+import mimetypes
+import os
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.core.exceptions import MiddlewareNotUsed, SuspiciousFileOperation
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".svg", ".txt", ".json", ".xml", ".map", ".ico")
+# compressed siblings saving less than this are not worth serving
+MIN_COMPRESSION_RATIO = 0.95
+
+# hashed names never change their content
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# unhashed names (e.g. files referenced without {% static %}) may change on the next deployment
+DEFAULT_CACHE_CONTROL = "public, max-age=3600"
+
+# (Accept-Encoding token, file suffix) in the order of preference
+ENCODINGS = [("gzip", ".gz")] if brotli is None else [("br", ".br"), ("gzip", ".gz")]
+
+
+def compress_file(path):
+    """
+    Write the precompressed siblings of the file at 'path' (only the ones noticeably smaller than the file).
+    :return: list of the written paths
+    """
+    with open(path, "rb") as file:
+        content = file.read()
+    compressed = {".gz": gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressed[".br"] = brotli.compress(content)
+
+    written = []
+    for suffix, data in compressed.items():
+        if len(data) < len(content) * MIN_COMPRESSION_RATIO:
+            with open(path + suffix, "wb") as file:
+                file.write(data)
+            written.append(path + suffix)
+    return written
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Manifest storage that also writes '.gz'/'.br' siblings of the collected text files.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in set(self.hashed_files.values()):
+            if name.endswith(COMPRESSIBLE_EXTENSIONS) and self.exists(name):
+                compress_file(self.path(name))
+
+
+class PrecompressedStaticMiddleware:
+    """
+    Serve files collected to STATIC_ROOT without a separate web server, picking the '.br'/'.gz' sibling when
+    the client accepts it. In development (DEBUG) the staticfiles app serves the source files instead.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if settings.DEBUG or not settings.STATIC_ROOT:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.prefix = settings.STATIC_URL
+        self.root = settings.STATIC_ROOT
+        self.immutable_names = set(getattr(staticfiles_storage, "hashed_files", {}).values())
+        if asyncio.iscoroutinefunction(get_response):
+            # tells Django to call (and await) the middleware as a coroutine function under ASGI
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        return self.serve_static(request) or self.get_response(request)
+
+    async def __acall__(self, request):
+        # serving a file takes a stat() and an open() - not worth a hop to a thread
+        return self.serve_static(request) or await self.get_response(request)
+
+    def serve_static(self, request):
+        if request.method in ("GET", "HEAD") and request.path.startswith(self.prefix):
+            return self.serve(request, request.path[len(self.prefix):])
+        return None
+
+    def serve(self, request, name):
+        """
+        :return: response with the file or None if there is no such file (the request falls through to a 404)
+        """
+        try:
+            path = safe_join(self.root, name)
+        except SuspiciousFileOperation:
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        stat = os.stat(path)
+        if not was_modified_since(request.META.get("HTTP_IF_MODIFIED_SINCE"), stat.st_mtime, stat.st_size):
+            response = HttpResponseNotModified()
+        else:
+            accepted = {token.split(";")[0].strip() for token in request.META.get("HTTP_ACCEPT_ENCODING", "").split(",")}
+            encoding, served_path = None, path
+            for token, suffix in ENCODINGS:
+                if token in accepted and os.path.isfile(path + suffix):
+                    encoding, served_path = token, path + suffix
+                    break
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            response = FileResponse(open(served_path, "rb"), content_type=content_type)
+            del response["Content-Disposition"]
+            if encoding is not None:
+                response["Content-Encoding"] = encoding
+
+        response["Last-Modified"] = http_date(stat.st_mtime)
+        response["Cache-Control"] = IMMUTABLE_CACHE_CONTROL if name in self.immutable_names else DEFAULT_CACHE_CONTROL
+        patch_vary_headers(response, ("Accept-Encoding",))
+        return response
@@ -0,0 +1,50 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from core.catalog_cache import get_or_render_fragment
+
+register = template.Library()
+
+# set in the context while a fragment renders - fragments nested in it are cached as part of it
+IN_FRAGMENT = "_in_catalog_fragment"
+
+
+class CatalogCacheNode(template.Node):
+
+    def __init__(self, nodelist, fragment_name, vary_on):
+        self.nodelist = nodelist
+        self.fragment_name = fragment_name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        if context.get(IN_FRAGMENT):
+            return self.nodelist.render(context)
+
+        def render_fragment():
+            with context.push({IN_FRAGMENT: True}):
+                return self.nodelist.render(context)
+
+        vary_on = [variable.resolve(context, ignore_failures=True) for variable in self.vary_on]
+        if None in vary_on:
+            # a missing value would give the fragments of different objects the same key
+            raise template.TemplateSyntaxError(f"'catalog_cache' fragment '{self.fragment_name}' got a missing or "
+                                               f"None value to vary on.")
+        return mark_safe(get_or_render_fragment(self.fragment_name, vary_on, render_fragment))
+
+
+@register.tag
+def catalog_cache(parser, token):
+    """
+    Cache the enclosed catalog content until the catalog changes, e.g.:
+        {% catalog_cache "item_detail" item_pk %} ... {% endcatalog_cache %}
+    The arguments after the fragment name are the values the content depends on besides the catalog. The content
+    must not depend on the visitor (login state, cart, messages, {% csrf_token %}) - it is served to everyone.
+    Querysets and lazy objects used only inside the block are not evaluated when it comes from the cache.
+    """
+    nodelist = parser.parse(("endcatalog_cache",))
+    parser.delete_first_token()
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' tag requires at least the fragment name.")
+    fragment_name = parser.compile_filter(bits[1]).resolve({})
+    return CatalogCacheNode(nodelist, fragment_name, [parser.compile_filter(bit) for bit in bits[2:]])
@@ -0,0 +1,48 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.forms.utils import flatatt
+from django.utils.html import format_html
+
+from core.images import variant_name, variant_widths
+
+register = template.Library()
+
+# presentation: (width of the 'src' fallback variant, 'sizes' attribute, lazy loading)
+PRESENTATIONS = {
+    # grid tiles are at most 250px wide
+    "tile": (250, "250px", True),
+    # the product picture takes 65% of a half-width column - it is above the fold, so it is not lazy loaded
+    "detail": (400, "(min-width: 1200px) 370px, 33vw", False),
+}
+
+
+def srcset(name, widths, extension):
+    return ", ".join(f"{default_storage.url(variant_name(name, width, extension))} {width}w" for width in widths)
+
+
+@register.simple_tag
+def item_image(item, presentation="tile", **attrs):
+    """
+    Render the item's image as a <picture> with WebP and JPEG 'srcset's of its resized variants, so the browser
+    downloads the smallest variant that is sharp enough. Width/height attributes reserve the space for the image
+    before it loads. Extra keyword arguments become attributes of the <img> tag, e.g.:
+        {% item_image item "tile" id="foto" alt=item.name %}
+    Images whose variants are not generated yet (no stored dimensions) are rendered as a plain <img> of the original.
+    :return: HTML of the image
+    """
+    if not item.image:
+        return ""
+    if item.image_width is None or item.image_height is None:
+        return format_html('<img src="{}"{}>', item.image.url, flatatt(attrs))
+
+    base_width, sizes, lazy = PRESENTATIONS[presentation]
+    widths = variant_widths(item.image_width)
+    width = min(base_width, item.image_width)
+    attrs = {"width": width, "height": max(round(item.image_height * width / item.image_width), 1),
+             "loading": "lazy" if lazy else None, "decoding": "async", **attrs}
+    name = item.image.name
+    return format_html('<picture><source type="image/webp" srcset="{}" sizes="{}">'
+                       '<img src="{}" srcset="{}" sizes="{}"{}></picture>',
+                       srcset(name, widths, "webp"), sizes,
+                       default_storage.url(variant_name(name, width, "jpg")), srcset(name, widths, "jpg"), sizes,
+                       flatatt(attrs))
@@ -1,6 +1,81 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import sqlite3
+import threading
+import time
+import multiprocessing
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections, transaction, OperationalError, DEFAULT_DB_ALIAS
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db.models import F, Sum
+from django.http import Http404, HttpResponseNotFound
+from django.template import Context, Template, TemplateSyntaxError
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from PIL import Image
+from asgiref.sync import async_to_sync
 from .models import *
 from .forms import *
+from .context_processors import get_category_tree
+from .views import place_order
+from .search import SearchResults, rebuild_index
+from .cart import get_cart
+from .images import variant_name
+from .staticfiles import PrecompressedStaticMiddleware
+from . import metrics
+from .management.commands.bench import percentile, summarize
+from .backends.sqlite3.base import configure_connection
+from .transactions import retry_on_lock
+from .routers import PrimaryReplicaRouter, PRIMARY_UNTIL_SESSION_KEY
+from .catalog_cache import get_catalog_version
+from .async_views import async_catalog_view
+from .views import ItemDetailView
+from . import feeds
+from .jobs import job, enqueue, claim_job, run_job
+from unittest import skipUnless
+
+
+def create_item(name="Apap", price="10.00", price_sale=None, in_stock=10, manufacturer=None, subcategories=()):
+    """
+    Helper function creating an Item instance with sensible defaults for the required fields.
+    """
+    if manufacturer is None:
+        manufacturer, created = Manufacturer.objects.get_or_create(name="US Pharmacia")
+    item = Item.objects.create(name=name, form=Item.TABLETS, net_weight=10, price=Decimal(price),
+                               price_sale=Decimal(price_sale) if price_sale is not None else None,
+                               manufacturer=manufacturer, in_stock=in_stock, image="core/images/items/paracetamol.png")
+    item.subcategories.set(subcategories)
+    return item
+
+
+def create_customer_with_address():
+    address = Address.objects.create(city="Warszawa", postal_code="12-345", street="Piastowa", street_number="5")
+    customer = Customer.objects.create(first_name="Foo", last_name="Bar", phone_number="111222333", address=address)
+    return customer, address
+
+
+CHECKOUT_FORM_DATA = dict(first_name="Foo", last_name="Bar", phone_number="111222333",
+                          country="Poland", city="Warszawa", postal_code="12-345", street="Piastowa",
+                          street_number="5", delivery_method=Order.DHL, payment_method=Order.BLIK)
 
 
 class CustomerFormTests(TestCase):
@@ -153,3 +228,1901 @@ class AddressFormTests(TestCase):
         )
 
         self.assertTrue(form.is_valid())
+
+
+@override_settings(NAVBAR_CATEGORIES=["Zdrowie", "Higiena"])
+class CategoryTreeCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.health = Category.objects.create(name="Zdrowie")
+        self.hygiene = Category.objects.create(name="Higiena")
+        Category.objects.create(name="Pielęgnacja")
+        self.pain = SubCategory.objects.create(category=self.health, name="Ból")
+        SubCategory.objects.create(category=self.hygiene, name="Szampony")
+
+    def test_category_tree_follows_configured_categories(self):
+        """
+        The category tree contains only the categories listed in NAVBAR_CATEGORIES, in the configured order,
+        together with their subcategories.
+        """
+        tree = get_category_tree()
+
+        self.assertEqual([category["name"] for category in tree], ["Zdrowie", "Higiena"])
+        self.assertEqual(tree[0]["subcategories"], [{"pk": self.pain.pk, "name": "Ból"}])
+
+    def test_category_tree_is_served_from_cache(self):
+        """
+        Once the category tree is built, rendering it again does not hit the database.
+        """
+        get_category_tree()
+
+        with self.assertNumQueries(0):
+            get_category_tree()
+
+    def test_category_tree_is_invalidated_on_subcategory_change(self):
+        """
+        Saving or deleting a subcategory drops the cached tree, so the next render reflects the change.
+        """
+        get_category_tree()
+        cold = SubCategory.objects.create(category=self.health, name="Przeziębienie")
+
+        self.assertIn("Przeziębienie", [sub["name"] for sub in get_category_tree()[0]["subcategories"]])
+
+        cold.delete()
+
+        self.assertNotIn("Przeziębienie", [sub["name"] for sub in get_category_tree()[0]["subcategories"]])
+
+    def test_category_tree_is_invalidated_on_category_rename(self):
+        """
+        Renaming a configured category removes it from the navbar after the cached tree is invalidated.
+        """
+        get_category_tree()
+        self.hygiene.name = "Kosmetyki"
+        self.hygiene.save()
+
+        self.assertEqual([category["name"] for category in get_category_tree()], ["Zdrowie"])
+
+    def test_navbar_renders_cached_subcategories(self):
+        """
+        The navbar links to the subcategories of the configured categories.
+        """
+        response = self.client.get(reverse("core:cart"))
+
+        self.assertContains(response, reverse("core:category-filtered", kwargs={"pk": self.pain.pk}))
+
+
+class CheckoutViewTests(TestCase):
+
+    def setUp(self):
+        self.item = create_item(in_stock=5)
+        self.client.post(reverse("core:detail", kwargs={"pk": self.item.pk}), data={"n_pieces": 3})
+
+    def test_checkout_creates_order_and_takes_pieces_from_stock(self):
+        """
+        Checking out the cart creates the order with its lines, decreases the stock and empties the cart.
+        """
+        response = self.client.post(reverse("core:checkout"), data=CHECKOUT_FORM_DATA)
+
+        self.assertRedirects(response, reverse("core:summary"))
+        order = Order.objects.get()
+        self.assertEqual(order.total_price, Decimal("30.00"))
+        self.assertEqual(list(order.orderitem_set.values_list("item", "n_pieces")), [(self.item.pk, 3)])
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.in_stock, 2)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_checkout_with_not_enough_pieces_in_stock_writes_nothing(self):
+        """
+        If an item runs out of stock before the checkout, no order is created,
+        the stock is left untouched and the cart is kept.
+        """
+        Item.objects.filter(pk=self.item.pk).update(in_stock=2)
+
+        response = self.client.post(reverse("core:checkout"), data=CHECKOUT_FORM_DATA)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Niewystarczająca liczba sztuk")
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.in_stock, 2)
+        self.assertEqual(CartItem.objects.get().n_pieces, 3)
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    n_buyers = 8
+    n_pieces_in_stock = 3
+
+    def test_concurrent_checkouts_do_not_oversell(self):
+        """
+        Many buyers checking out the last pieces of an item at the same time never take more pieces
+        than there are in stock: exactly n_pieces_in_stock orders succeed and the stock ends at 0.
+        """
+        item = create_item(in_stock=self.n_pieces_in_stock)
+        customer, address = create_customer_with_address()
+        carts = []
+        for i in range(self.n_buyers):
+            cart = Cart.objects.create(session=f"session{i}")
+            CartItem.objects.create(cart=cart, item=item, n_pieces=1)
+            carts.append(cart)
+
+        results = []
+        barrier = threading.Barrier(self.n_buyers)
+
+        def buy(cart):
+            barrier.wait()
+            try:
+                while True:
+                    try:
+                        place_order(cart, customer=customer, address=address,
+                                    delivery_method=Order.DHL, payment_method=Order.BLIK)
+                        results.append(True)
+                        return
+                    except ValidationError:
+                        results.append(False)
+                        return
+                    except OperationalError:
+                        # the write lock is held by another buyer - try again
+                        continue
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy, args=(cart,)) for cart in carts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        item.refresh_from_db()
+        self.assertEqual(results.count(True), self.n_pieces_in_stock)
+        self.assertEqual(item.in_stock, 0)
+        self.assertEqual(Order.objects.count(), self.n_pieces_in_stock)
+        self.assertEqual(OrderItem.objects.count(), self.n_pieces_in_stock)
+
+
+class CartPriceTests(TestCase):
+
+    def setUp(self):
+        self.cart = Cart.objects.create(session="session")
+
+    def fill_cart(self, n_items):
+        for i in range(n_items):
+            item = create_item(name=f"Item {i}", price="10.00", price_sale="7.50" if i % 2 else None)
+            CartItem.objects.create(cart=self.cart, item=item, n_pieces=2)
+
+    def test_cart_lines_are_annotated_with_effective_price_and_line_total(self):
+        """
+        The sale price overrides the regular price in 'effective_price' and 'line_total' of the cart lines.
+        """
+        self.fill_cart(2)
+
+        lines = list(CartItem.objects.for_cart(self.cart))
+
+        self.assertEqual([line.effective_price for line in lines], [Decimal("10.00"), Decimal("7.50")])
+        self.assertEqual([line.line_total for line in lines], [Decimal("20.00"), Decimal("15.00")])
+
+    def test_cart_total_price_is_aggregated(self):
+        """
+        The total price of the cart is the sum of the line totals.
+        """
+        self.fill_cart(3)
+
+        with self.assertNumQueries(1):
+            total_price = CartItem.objects.for_cart(self.cart).total_price()
+
+        self.assertEqual(total_price, Decimal("55.00"))
+
+    def test_empty_cart_total_price_is_zero(self):
+        self.assertEqual(CartItem.objects.for_cart(self.cart).total_price(), Decimal("0.00"))
+
+    def test_cart_page_query_count_does_not_depend_on_cart_size(self):
+        """
+        Rendering the cart page costs the same number of queries for a cart with one line and with thirty lines.
+        """
+        session = self.client.session
+        session.save()
+        self.cart.session = session.session_key
+        self.cart.save()
+        self.fill_cart(1)
+        self.client.get(reverse("core:cart"))
+
+        with CaptureQueriesContext(connection) as small_cart_queries:
+            self.client.get(reverse("core:cart"))
+
+        self.fill_cart(29)
+        with CaptureQueriesContext(connection) as big_cart_queries:
+            response = self.client.get(reverse("core:cart"))
+
+        self.assertEqual(response.context["total_price"], Decimal("530.00"))
+        self.assertEqual(len(small_cart_queries), len(big_cart_queries))
+
+
+class EffectivePriceTests(TestCase):
+
+    def setUp(self):
+        self.category = Category.objects.create(name="Zdrowie")
+        self.subcategory = SubCategory.objects.create(category=self.category, name="Ból")
+
+    def assertEffectivePrice(self, item, price):
+        item.refresh_from_db()
+        self.assertEqual(item.effective_price, Decimal(price))
+        self.assertEqual(item.itemsubcategory_set.get().effective_price, Decimal(price))
+
+    def test_effective_price_is_maintained_on_save(self):
+        """
+        Saving an item stores its sale price (or its regular price if there is no sale)
+        in the item and in its subcategory links.
+        """
+        item = create_item(price="10.00", price_sale="8.00", subcategories=[self.subcategory])
+        self.assertEffectivePrice(item, "8.00")
+
+        item.price_sale = None
+        item.save()
+        self.assertEffectivePrice(item, "10.00")
+
+        item.price = Decimal("12.00")
+        item.save(update_fields=["price"])
+        self.assertEffectivePrice(item, "12.00")
+
+    def test_effective_price_is_maintained_on_queryset_update(self):
+        """
+        Bulk price updates recompute the effective price from the new prices, also when the filter
+        of the updated queryset depends on the updated price.
+        """
+        item = create_item(price="10.00", subcategories=[self.subcategory])
+
+        Item.objects.filter(price_sale__isnull=True).update(price_sale=Decimal("7.00"))
+        self.assertEffectivePrice(item, "7.00")
+
+        Item.objects.filter(pk=item.pk).update(price=F("price") * 2, price_sale=None)
+        self.assertEffectivePrice(item, "20.00")
+
+    def test_effective_price_is_maintained_on_bulk_update(self):
+        item = create_item(price="10.00", subcategories=[self.subcategory])
+        item.price_sale = Decimal("5.00")
+
+        Item.objects.bulk_update([item], ["price_sale"])
+
+        self.assertEffectivePrice(item, "5.00")
+
+    def test_category_view_filters_by_effective_price(self):
+        """
+        The price range filter of the category view compares the range with the sale price if the item is on sale.
+        """
+        on_sale = create_item(name="On sale", price="50.00", price_sale="15.00", subcategories=[self.subcategory])
+        regular = create_item(name="Regular", price="15.00", subcategories=[self.subcategory])
+        create_item(name="Expensive", price="60.00", subcategories=[self.subcategory])
+
+        response = self.client.get(reverse("core:category-filtered", kwargs={"pk": self.subcategory.pk}),
+                                   data={"min-price": 10, "max-price": 20})
+
+        self.assertEqual(set(response.context["listing"]["item_list"]), {on_sale, regular})
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.manufacturer = Manufacturer.objects.create(name="Herbapol")
+        self.syrup = create_item(name="Herbapect syrop", manufacturer=self.manufacturer)
+        self.syrup.description = "Łagodzi kaszel"
+        self.syrup.save()
+        self.tablets = create_item(name="Apap", manufacturer=Manufacturer.objects.create(name="US Pharmacia"))
+        self.tablets.composition = "paracetamol"
+        self.tablets.description = "Na ból głowy, zawiera paracetamol i herbatę"
+        self.tablets.save()
+
+    def search(self, text):
+        return list(SearchResults(text)[:10])
+
+    def test_search_matches_name_composition_description_and_manufacturer(self):
+        self.assertEqual(self.search("herbapect"), [self.syrup])
+        self.assertEqual(self.search("paracetamol"), [self.tablets])
+        self.assertEqual(self.search("kaszel"), [self.syrup])
+        self.assertEqual(self.search("pharmacia"), [self.tablets])
+
+    def test_search_folds_polish_diacritics(self):
+        """
+        Queries with and without Polish diacritics (including 'ł') match the same items.
+        """
+        self.assertEqual(self.search("lagodzi"), [self.syrup])
+        self.assertEqual(self.search("ŁAGODZI"), [self.syrup])
+        self.assertEqual(self.search("bol glowy"), [self.tablets])
+
+    def test_search_matches_word_prefixes_and_ranks_name_matches_first(self):
+        """
+        'herba' matches the name and manufacturer of the syrup and the description of the tablets;
+        the syrup is ranked first.
+        """
+        self.assertEqual(self.search("herba"), [self.syrup, self.tablets])
+
+    def test_search_ignores_fts_query_syntax(self):
+        self.assertEqual(self.search('"apap"(*:'), [self.tablets])
+        self.assertEqual(self.search("***"), [])
+        self.assertEqual(SearchResults("").count(), 0)
+
+    def test_search_index_follows_item_and_manufacturer_changes(self):
+        self.tablets.name = "Paracetamol Extra"
+        self.tablets.save()
+        self.manufacturer.name = "Polfa"
+        self.manufacturer.save()
+
+        self.assertEqual(self.search("apap"), [])
+        self.assertEqual(self.search("extra"), [self.tablets])
+        self.assertEqual(self.search("polfa"), [self.syrup])
+
+        self.syrup.delete()
+        self.assertEqual(self.search("polfa"), [])
+
+    def test_rebuild_index_picks_up_bulk_changes(self):
+        """
+        Bulk updates bypass signals - rebuilding the index brings the search rows up to date.
+        """
+        Item.objects.filter(pk=self.tablets.pk).update(name="Ibuprom")
+        self.assertEqual(self.search("ibuprom"), [])
+
+        self.assertEqual(rebuild_index(), 2)
+
+        self.assertEqual(self.search("ibuprom"), [self.tablets])
+
+    def test_search_view_paginates_results(self):
+        for i in range(30):
+            create_item(name=f"Witamina C {i}")
+
+        response = self.client.get(reverse("core:search"), data={"q": "witamina", "page": 2})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["page"].paginator.count, 30)
+        self.assertEqual(len(response.context["item_list"]), 6)
+
+
+class CategoryPaginationTests(TestCase):
+
+    def setUp(self):
+        self.subcategory = SubCategory.objects.create(category=Category.objects.create(name="Zdrowie"), name="Ból")
+        # prices repeat, so the pk tie-breaker matters
+        self.items = [create_item(name=f"Item {i:02d}", price=f"{10 + i % 5}.00", subcategories=[self.subcategory])
+                      for i in range(30)]
+        self.url = reverse("core:category-filtered", kwargs={"pk": self.subcategory.pk})
+
+    def walk_pages(self, data, url=None, per_page=None):
+        """
+        Follow 'next' cursors from the first page to the last one.
+        :return: list of pages (lists of items)
+        """
+        pages = []
+        cursor = None
+        while True:
+            response = self.client.get(url or self.url, data=dict(data, **({"cursor": cursor} if cursor else {})))
+            page = response.context["listing"]["page"]
+            pages.append(list(page.object_list))
+            if not page.has_next():
+                return pages
+            cursor = page.next_cursor
+
+    def test_name_ordering_pages_cover_all_items_once(self):
+        pages = self.walk_pages({"order": "name"})
+
+        self.assertEqual([len(page) for page in pages], [24, 6])
+        self.assertEqual(sum(pages, []), sorted(self.items, key=lambda item: item.name))
+
+    def test_price_ordering_pages_are_ordered_by_price_and_pk(self):
+        pages = self.walk_pages({"order": "price", "min-price": 11, "max-price": 13})
+
+        items = sum(pages, [])
+        expected = sorted((item for item in self.items if 11 <= item.effective_price <= 13),
+                          key=lambda item: (item.effective_price, item.pk))
+        self.assertEqual(items, expected)
+
+    def test_cursor_survives_price_range_change(self):
+        """
+        A cursor marks a position in the ordering, so it can be reused with a different price range.
+        """
+        first_page = self.client.get(self.url, data={"order": "price"}).context["listing"]["page"]
+        last_item = first_page.object_list[-1]
+
+        response = self.client.get(self.url, data={"order": "price", "min-price": 0, "max-price": 12,
+                                                   "cursor": first_page.next_cursor})
+
+        for item in response.context["listing"]["item_list"]:
+            self.assertLessEqual(item.effective_price, 12)
+            self.assertGreater((item.effective_price, item.pk), (last_item.effective_price, last_item.pk))
+
+    def test_previous_cursor_returns_previous_page(self):
+        first_page = self.client.get(self.url).context["listing"]["page"]
+        second_page = self.client.get(self.url, data={"cursor": first_page.next_cursor}).context["listing"]["page"]
+
+        response = self.client.get(self.url, data={"cursor": second_page.previous_cursor})
+        previous_page = response.context["listing"]["page"]
+
+        self.assertEqual(previous_page.object_list, first_page.object_list)
+        self.assertFalse(previous_page.has_previous())
+
+    def test_invalid_cursor_falls_back_to_first_page(self):
+        response = self.client.get(self.url, data={"cursor": "forged"})
+
+        self.assertEqual(len(response.context["listing"]["item_list"]), 24)
+        self.assertFalse(response.context["listing"]["page"].has_previous())
+
+    def test_load_more_endpoint_renders_only_item_tiles(self):
+        first_page = self.client.get(self.url).context["listing"]["page"]
+
+        response = self.client.get(reverse("core:category-items", kwargs={"pk": self.subcategory.pk}),
+                                   data={"cursor": first_page.next_cursor})
+
+        self.assertEqual(len(response.context["listing"]["item_list"]), 6)
+        self.assertNotContains(response, "<html")
+        self.assertNotContains(response, 'id="load-more"')
+
+    def test_price_filter_and_keyset_condition_share_one_join(self):
+        """
+        All conditions on the subcategory links (subcategory, price range, cursor) apply to the same link row.
+        """
+        first_page = self.client.get(self.url, data={"order": "price"}).context["listing"]["page"]
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url, data={"order": "price", "min-price": 0, "max-price": 100,
+                                            "cursor": first_page.next_cursor})
+
+        item_query = next(query["sql"] for query in queries if 'FROM "core_item" ' in query["sql"])
+        self.assertEqual(item_query.count('JOIN "core_item_subcategories"'), 1)
+
+
+def write_queries(queries):
+    return [query["sql"] for query in queries if query["sql"].split(" ", 1)[0] in ("INSERT", "UPDATE", "DELETE")]
+
+
+class CartResolutionTests(TestCase):
+
+    def setUp(self):
+        self.item = create_item(in_stock=10)
+        self.user = get_user_model().objects.create_user(username="foo", password="bar")
+
+    def add_to_cart(self, n_pieces=1):
+        return self.client.post(reverse("core:detail", kwargs={"pk": self.item.pk}), data={"n_pieces": n_pieces})
+
+    def test_viewing_empty_cart_writes_nothing(self):
+        """
+        An anonymous visitor (e.g. a crawler) viewing the cart creates neither a session nor a cart.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("core:cart"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(write_queries(queries), [])
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(Session.objects.exists())
+
+    def test_cart_is_created_once_and_then_resolved_by_cached_id(self):
+        """
+        Adding to the cart creates the cart once; afterwards the cart id cached in the session resolves the cart
+        with a session load and one primary key lookup, and viewing the cart writes nothing.
+        """
+        self.add_to_cart()
+        self.add_to_cart()
+        cart = Cart.objects.get()
+        self.assertEqual(self.client.session["cart_id"], cart.pk)
+        self.assertEqual(CartItem.objects.get().n_pieces, 2)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("core:cart"))
+        self.assertEqual(write_queries(queries), [])
+
+        request = RequestFactory().get("/")
+        request.user = AnonymousUser()
+        request.session = SessionStore(session_key=self.client.session.session_key)
+        with self.assertNumQueries(2):
+            self.assertEqual(get_cart(request), cart)
+        with self.assertNumQueries(0):
+            # memoized on the request
+            get_cart(request)
+
+    def test_logged_in_cart_reads_write_nothing(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, item=self.item, n_pieces=1)
+        self.client.force_login(self.user)
+        self.client.get(reverse("core:cart"))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("core:cart"))
+
+        self.assertEqual(list(response.context["cart_item_list"]), [CartItem.objects.get()])
+        self.assertEqual(write_queries(queries), [])
+
+    def test_anonymous_cart_is_bound_to_user_on_login(self):
+        """
+        A user without a cart takes over the anonymous cart on login; later cart modifications do not rewrite the cart.
+        """
+        self.add_to_cart()
+        cart = Cart.objects.get()
+        self.client.force_login(self.user)
+        cart.refresh_from_db()
+        self.assertEqual(cart.user, self.user)
+        self.assertEqual(self.client.session["cart_id"], cart.pk)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.add_to_cart()
+        self.assertEqual([sql for sql in write_queries(queries) if '"user_id"' in sql], [])
+        self.assertEqual(CartItem.objects.get().n_pieces, 2)
+
+    def test_anonymous_cart_is_merged_into_user_cart_on_login(self):
+        """
+        Lines of the anonymous cart are added to the user's cart (capped by the stock) and the anonymous cart is deleted.
+        """
+        other_item, sold_out_item = create_item(in_stock=3), create_item(in_stock=1)
+        user_cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=user_cart, item=self.item, n_pieces=6)
+        CartItem.objects.create(cart=user_cart, item=other_item, n_pieces=2)
+        self.add_to_cart(n_pieces=7)
+        self.client.post(reverse("core:detail", kwargs={"pk": other_item.pk}), data={"n_pieces": 1})
+        self.client.post(reverse("core:detail", kwargs={"pk": sold_out_item.pk}), data={"n_pieces": 1})
+        Item.objects.filter(pk=sold_out_item.pk).update(in_stock=0)
+
+        self.client.force_login(self.user)
+
+        self.assertEqual(list(Cart.objects.all()), [user_cart])
+        self.assertEqual(dict(CartItem.objects.values_list('item', 'n_pieces')), {self.item.pk: 10, other_item.pk: 3})
+        self.assertEqual(self.client.session["cart_id"], user_cart.pk)
+
+        # logging in again merges nothing
+        self.client.logout()
+        self.client.force_login(self.user)
+        self.assertEqual(CartItem.objects.get(item=other_item).n_pieces, 3)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("core:cart"))
+        self.assertEqual(len(response.context["cart_item_list"]), 2)
+        self.assertEqual(write_queries(queries), [])
+
+
+class CartApiTests(TestCase):
+
+    def setUp(self):
+        self.item = create_item(price="10.00", price_sale="8.50", in_stock=5)
+        self.other_item = create_item(name="Ibuprom", price="20.00", in_stock=5)
+
+    def post(self, name, pk, **data):
+        return self.client.post(reverse(name, kwargs={"pk": pk}), data=data, HTTP_ACCEPT="application/json")
+
+    def test_add_returns_line_and_cart_summary(self):
+        self.post("core:cart-api-add", self.other_item.pk, n_pieces=1)
+        response = self.post("core:cart-api-add", self.item.pk, n_pieces=2)
+        response = self.post("core:cart-api-add", self.item.pk, n_pieces=1)
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["line"], {"n_pieces": 3, "line_total": "25.50"})
+        self.assertEqual((data["item"], data["n_pieces"], data["total_price"]), (self.item.pk, 4, "45.50"))
+        self.assertEqual(CartItem.objects.get(item=self.item).n_pieces, 3)
+
+    def test_add_errors(self):
+        response = self.post("core:cart-api-add", self.item.pk, n_pieces=6)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("error", response.json())
+        self.assertFalse(CartItem.objects.exists())
+
+        self.assertEqual(self.post("core:cart-api-add", self.item.pk, n_pieces=0).status_code, 400)
+        self.assertEqual(self.post("core:cart-api-add", 0, n_pieces=1).status_code, 404)
+
+    def test_set_quantity_and_remove(self):
+        self.post("core:cart-api-add", self.item.pk, n_pieces=1)
+        self.post("core:cart-api-add", self.other_item.pk, n_pieces=1)
+
+        data = self.post("core:cart-api-quantity", self.item.pk, n_pieces=4).json()
+        self.assertEqual((data["line"]["n_pieces"], data["total_price"]), (4, "54.00"))
+        self.assertEqual(self.post("core:cart-api-quantity", self.item.pk, n_pieces=6).status_code, 400)
+        self.assertEqual(CartItem.objects.get(item=self.item).n_pieces, 4)
+
+        data = self.post("core:cart-api-quantity", self.item.pk, n_pieces=0).json()
+        self.assertEqual((data["line"], data["n_pieces"], data["total_price"]), (None, 1, "20.00"))
+
+        data = self.post("core:cart-api-remove", self.other_item.pk).json()
+        self.assertEqual((data["line"], data["n_pieces"], data["total_price"]), (None, 0, "0.00"))
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(self.post("core:cart-api-remove", self.other_item.pk).status_code, 404)
+
+    def test_endpoints_require_csrf_token(self):
+        client = self.client_class(enforce_csrf_checks=True)
+        response = client.post(reverse("core:cart-api-add", kwargs={"pk": self.item.pk}), data={"n_pieces": 1})
+        self.assertEqual(response.status_code, 403)
+
+    def test_failed_form_post_renders_the_detail_page(self):
+        url = reverse("core:detail", kwargs={"pk": self.item.pk})
+        cart_api_url = reverse("core:cart-api-add", kwargs={"pk": self.item.pk})
+
+        response = self.client.post(url, data={"n_pieces": 6})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Niewystarczająca liczba sztuk")
+        self.assertContains(response, cart_api_url)
+
+        response = self.client.post(url, data={"n_pieces": "abc"})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, cart_api_url)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_json_add_is_cheaper_than_page_reload(self):
+        """
+        Adding to the cart through the JSON endpoint costs fewer queries and bytes than the form post
+        followed by the redirect to the re-rendered detail page.
+        """
+        self.post("core:cart-api-add", self.other_item.pk, n_pieces=1)
+        cache.clear()
+
+        with CaptureQueriesContext(connection) as page_queries:
+            page_response = self.client.post(reverse("core:detail", kwargs={"pk": self.item.pk}),
+                                             data={"n_pieces": 1}, follow=True)
+        cache.clear()
+        with CaptureQueriesContext(connection) as json_queries:
+            json_response = self.post("core:cart-api-add", self.item.pk, n_pieces=1)
+
+        self.assertEqual(CartItem.objects.get(item=self.item).n_pieces, 2)
+        self.assertLess(len(json_queries), len(page_queries))
+        self.assertLess(len(json_response.content) * 20, len(page_response.content))
+
+
+def png_upload(name, size, mode="RGBA"):
+    content = io.BytesIO()
+    Image.new(mode, size, (200, 30, 30, 128) if mode == "RGBA" else (200, 30, 30)).save(content, "PNG")
+    return SimpleUploadedFile(name, content.getvalue(), content_type="image/png")
+
+
+class ImageVariantTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        media_settings = override_settings(MEDIA_ROOT=self.media_root, IMAGE_VARIANTS_ASYNC=False)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.addCleanup(shutil.rmtree, self.media_root)
+
+    def variant_path(self, item, width, extension):
+        return os.path.join(self.media_root, variant_name(item.image.name, width, extension))
+
+    def render_image(self, item, presentation="tile"):
+        return Template('{% load item_images %}{% item_image item presentation id="foto" %}').render(
+            Context({"item": item, "presentation": presentation}))
+
+    def test_uploaded_image_gets_variants(self):
+        """
+        Uploading an image generates its WebP and JPEG variants and stores its dimensions.
+        """
+        item = create_item()
+        with self.captureOnCommitCallbacks(execute=True):
+            item.image = png_upload("apap.png", (1000, 500))
+            item.save()
+
+        item.refresh_from_db()
+        self.assertEqual((item.image_width, item.image_height), (1000, 500))
+        for width in (250, 400, 500, 800):
+            with Image.open(self.variant_path(item, width, "webp")) as variant:
+                self.assertEqual(variant.size, (width, width // 2))
+            with Image.open(self.variant_path(item, width, "jpg")) as variant:
+                self.assertEqual(variant.mode, "RGB")
+
+        html = self.render_image(item)
+        self.assertIn('<source type="image/webp"', html)
+        self.assertIn("/variants/apap_png-800.webp 800w", html)
+        self.assertIn('src="/media/core/images/items/variants/apap_png-250.jpg"', html)
+        self.assertIn('width="250"', html)
+        self.assertIn('height="125"', html)
+        self.assertIn('loading="lazy"', html)
+        self.assertIn('id="foto"', html)
+        self.assertNotIn('loading="lazy"', self.render_image(item, "detail"))
+
+    def test_small_image_is_not_upscaled(self):
+        item = create_item()
+        with self.captureOnCommitCallbacks(execute=True):
+            item.image = png_upload("small.png", (100, 80), mode="RGB")
+            item.save()
+
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.variant_path(item, 100, "jpg")))),
+                         ["small_png-100.jpg", "small_png-100.webp"])
+        item.refresh_from_db()
+        self.assertIn('srcset="/media/core/images/items/variants/small_png-100.jpg 100w"', self.render_image(item))
+
+    def test_images_with_the_same_stem_keep_their_own_variants(self):
+        png_item = create_item(name="Apap")
+        jpg_item = create_item(name="Apap Extra")
+        with self.captureOnCommitCallbacks(execute=True):
+            png_item.image = png_upload("apap.png", (400, 400))
+            png_item.save()
+        content = io.BytesIO()
+        Image.new("RGB", (400, 200)).save(content, "JPEG")
+        with self.captureOnCommitCallbacks(execute=True):
+            jpg_item.image = SimpleUploadedFile("apap.jpg", content.getvalue(), content_type="image/jpeg")
+            jpg_item.save()
+
+        self.assertNotEqual(self.variant_path(png_item, 400, "webp"), self.variant_path(jpg_item, 400, "webp"))
+        with Image.open(self.variant_path(png_item, 400, "webp")) as variant:
+            self.assertEqual(variant.size, (400, 400))
+        with Image.open(self.variant_path(jpg_item, 400, "webp")) as variant:
+            self.assertEqual(variant.size, (400, 200))
+
+    def test_image_without_variants_falls_back_to_original(self):
+        item = create_item()
+        self.assertEqual(self.render_image(item), '<img src="/media/core/images/items/paracetamol.png" id="foto">')
+
+    def test_command_generates_missing_variants(self):
+        """
+        The command generates variants of the images already in the media tree and skips up-to-date ones.
+        """
+        os.makedirs(os.path.join(self.media_root, "core/images/items"))
+        with open(os.path.join(self.media_root, "core/images/items/paracetamol.png"), "wb") as image_file:
+            image_file.write(png_upload("paracetamol.png", (300, 600)).read())
+        item = create_item()
+
+        call_command("generate_image_variants", workers=1, stdout=io.StringIO())
+        item.refresh_from_db()
+        self.assertEqual((item.image_width, item.image_height), (300, 600))
+        variant_mtime = os.path.getmtime(self.variant_path(item, 300, "webp"))
+
+        call_command("generate_image_variants", workers=1, stdout=io.StringIO())
+        self.assertEqual(os.path.getmtime(self.variant_path(item, 300, "webp")), variant_mtime)
+
+
+class PrecompressedStaticFilesTests(TestCase):
+    css = "#nav1 a {\n  font-size: 18px;\n  color: white;\n}\n" * 50
+
+    def setUp(self):
+        source_dir = tempfile.mkdtemp()
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_dir)
+        self.addCleanup(shutil.rmtree, static_root)
+        os.makedirs(os.path.join(source_dir, "css"))
+        with open(os.path.join(source_dir, "css", "base.css"), "w") as css_file:
+            css_file.write(self.css)
+
+        static_settings = override_settings(
+            STATICFILES_DIRS=[source_dir], STATIC_ROOT=static_root,
+            STATICFILES_STORAGE="core.staticfiles.CompressedManifestStaticFilesStorage")
+        static_settings.enable()
+        self.addCleanup(static_settings.disable)
+        call_command("collectstatic", interactive=False, verbosity=0)
+        self.url = staticfiles_storage.url("css/base.css")
+
+    def test_collectstatic_writes_hashed_and_compressed_files(self):
+        self.assertRegex(self.url, r"^/static/css/base\.[0-9a-f]{12}\.css$")
+        with gzip.open(staticfiles_storage.path(self.url[len("/static/"):]) + ".gz", "rt") as gz_file:
+            self.assertEqual(gz_file.read(), self.css)
+
+    def test_hashed_file_is_served_compressed_and_cached_forever(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Content-Type"], "text/css")
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)).decode(), self.css)
+
+    def test_file_is_served_uncompressed_to_clients_without_gzip(self):
+        response = self.client.get(self.url)
+
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(b"".join(response.streaming_content).decode(), self.css)
+
+    def test_conditional_get(self):
+        last_modified = self.client.get(self.url)["Last-Modified"]
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+    def test_unhashed_name_gets_short_cache(self):
+        self.assertNotIn("immutable", self.client.get("/static/css/base.css")["Cache-Control"])
+
+    def test_missing_files_fall_through(self):
+        """
+        Requests for files missing from STATIC_ROOT (or outside of it) are passed on to the views.
+        """
+        not_found = HttpResponseNotFound()
+        middleware = PrecompressedStaticMiddleware(lambda request: not_found)
+        for path in ("/static/css/missing.css", "/static/../manage.py"):
+            self.assertIs(middleware(RequestFactory().get(path)), not_found)
+
+
+class RequestMetricsTests(TestCase):
+
+    def setUp(self):
+        metrics.REGISTRY.metrics = metrics.Registry.create_metrics()
+        self.item = create_item()
+
+    def test_request_metrics_are_recorded_per_view(self):
+        self.client.get(reverse("core:detail", kwargs={"pk": self.item.pk}))
+        self.client.get(reverse("core:detail", kwargs={"pk": self.item.pk}))
+
+        registry_metrics = metrics.REGISTRY.metrics
+        self.assertEqual(registry_metrics["http_requests_total"].values[("core:detail", "200")], 2)
+        counts, total = registry_metrics["db_queries_per_request"].values[("core:detail",)]
+        self.assertEqual(sum(counts), 2)
+        self.assertGreater(total, 0)
+        counts, render_time = registry_metrics["template_render_duration_seconds"].values[("core:detail",)]
+        self.assertGreater(render_time, 0)
+
+    @override_settings(METRICS_ALLOWED_IPS=[])
+    def test_metrics_view_is_for_staff_only(self):
+        self.assertEqual(self.client.get(reverse("core:metrics")).status_code, 403)
+
+        staff = get_user_model().objects.create_user(username="admin", password="bar", is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(reverse("core:metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        self.assertIn('http_requests_total{view="core:metrics",status="403"} 1', response.content.decode())
+
+    def test_metrics_of_all_processes_are_summed(self):
+        """
+        With METRICS_DIR set the metrics view reports the sums of the files written by every process.
+        """
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        other_process = metrics.Registry.create_metrics()
+        other_process["http_requests_total"].inc(("core:cart", "200"), 3)
+        other_process["http_request_duration_seconds"].observe(("core:cart",), 0.2)
+        with open(os.path.join(metrics_dir, "metrics-999999.json"), "w") as metrics_file:
+            json.dump({name: [[list(labels), value] for labels, value in metric.values.items()]
+                       for name, metric in other_process.items()}, metrics_file)
+
+        with override_settings(METRICS_DIR=metrics_dir):
+            self.client.get(reverse("core:cart"))
+            text = self.client.get(reverse("core:metrics")).content.decode()
+
+        self.assertIn('http_requests_total{view="core:cart",status="200"} 4', text)
+        self.assertIn('http_request_duration_seconds_bucket{view="core:cart",le="0.25"} 2', text)
+        self.assertIn('http_request_duration_seconds_count{view="core:cart"} 2', text)
+        self.assertTrue(os.path.exists(os.path.join(metrics_dir, f"metrics-{os.getpid()}.json")))
+
+
+class SeedShopTests(TestCase):
+    seed_options = dict(categories=2, subcategories=3, items=50, customers=10, orders=20, carts=5, stdout=io.StringIO())
+
+    def snapshot(self):
+        return (list(Item.objects.order_by("name").values_list("name", "price", "price_sale", "in_stock")),
+                list(Customer.objects.order_by("user__username").values_list("user__username", "last_name")),
+                list(OrderItem.objects.order_by("order__customer__user__username", "item__name", "n_pieces")
+                     .values_list("order__customer__user__username", "item__name", "n_pieces")))
+
+    def test_seed_shop_is_deterministic(self):
+        with transaction.atomic():
+            call_command("seed_shop", **self.seed_options)
+            first_snapshot = self.snapshot()
+            transaction.set_rollback(True)
+
+        call_command("seed_shop", **self.seed_options)
+        self.assertEqual(self.snapshot(), first_snapshot)
+        with self.assertRaises(CommandError):
+            call_command("seed_shop", **self.seed_options)
+
+    def test_seeded_data_is_consistent(self):
+        call_command("seed_shop", **self.seed_options)
+
+        self.assertEqual(Item.objects.count(), 50)
+        self.assertEqual(Order.objects.count(), 20)
+        self.assertEqual(Cart.objects.filter(user__isnull=False).count(), 5)
+        self.assertFalse(ItemSubCategory.objects.exclude(effective_price=F("item__effective_price")).exists())
+        for order in Order.objects.prefetch_related("orderitem_set__item"):
+            self.assertEqual(order.total_price, sum(line.item.effective_price * line.n_pieces
+                                                    for line in order.orderitem_set.all()))
+        self.assertGreater(SearchResults(Item.objects.first().name).count(), 0)
+
+
+class BenchSummaryTests(TestCase):
+
+    def test_percentiles(self):
+        values = list(range(1, 101))
+        self.assertEqual([percentile(values, p) for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_summary(self):
+        samples = [("index", 0, 0.010, 200, 2), ("index", 0, 0.030, 200, 4), ("index", 0, 0.020, 500, None)]
+        summary = summarize(samples, duration=2)
+        self.assertEqual(summary["requests"], 3)
+        self.assertEqual(summary["errors"], 1)
+        self.assertEqual(summary["throughput"], 1.5)
+        self.assertEqual(summary["p50_ms"], 20.0)
+        self.assertEqual(summary["queries_per_request"], 3.0)
+
+
+def take_from_stock_repeatedly(path, tuned, n_transactions, barrier, results):
+    """
+    Decrease the stock in read-then-write transactions (like checkouts) from a separate process
+    and put the number of transactions that failed with "database is locked" to the 'results' queue.
+    """
+    connection = sqlite3.connect(path, timeout=5, isolation_level=None)
+    if tuned:
+        # as deployed with SQLITE_WAL
+        configure_connection(connection, {"journal_mode": "WAL"})
+    barrier.wait()
+    n_failed = 0
+    for i in range(n_transactions):
+        try:
+            connection.execute("BEGIN IMMEDIATE" if tuned else "BEGIN")
+            in_stock = connection.execute("SELECT in_stock FROM stock").fetchone()[0]
+            # keep the read lock for a moment, like a view doing some work between the read and the write
+            time.sleep(0.001)
+            connection.execute("UPDATE stock SET in_stock = ?", (in_stock - 1,))
+            connection.execute("COMMIT")
+        except sqlite3.OperationalError:
+            connection.execute("ROLLBACK")
+            n_failed += 1
+    connection.close()
+    results.put(n_failed)
+
+
+@skipUnless(hasattr(os, "fork"), "needs fork() to start the writer processes")
+class SQLiteWriteContentionTests(SimpleTestCase):
+    n_processes = 4
+    n_transactions = 50
+
+    def run_writers(self, tuned):
+        """
+        :return: tuple(number of failed transactions, stock decrease)
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "contention.sqlite3")
+        with sqlite3.connect(path) as connection:
+            connection.execute("CREATE TABLE stock (in_stock INTEGER)")
+            connection.execute("INSERT INTO stock VALUES (100000)")
+        connection.close()
+
+        context = multiprocessing.get_context("fork")
+        barrier = context.Barrier(self.n_processes)
+        results = context.Queue()
+        processes = [context.Process(target=take_from_stock_repeatedly,
+                                     args=(path, tuned, self.n_transactions, barrier, results))
+                     for i in range(self.n_processes)]
+        for process in processes:
+            process.start()
+        n_failed = sum(results.get(timeout=60) for process in processes)
+        for process in processes:
+            process.join()
+        with sqlite3.connect(path) as connection:
+            in_stock = connection.execute("SELECT in_stock FROM stock").fetchone()[0]
+        connection.close()
+        return n_failed, 100000 - in_stock
+
+    def test_tuned_connections_do_not_fail_on_lock(self):
+        """
+        Concurrent read-then-write transactions in deferred mode fail with "database is locked" (the busy timeout
+        does not help a transaction which has already read), while the configured connections with BEGIN IMMEDIATE
+        wait for each other and every transaction succeeds.
+        """
+        n_failed, decrease = self.run_writers(tuned=False)
+        self.assertGreater(n_failed, 0)
+        self.assertEqual(decrease, self.n_processes * self.n_transactions - n_failed)
+
+        n_failed, decrease = self.run_writers(tuned=True)
+        self.assertEqual(n_failed, 0)
+        self.assertEqual(decrease, self.n_processes * self.n_transactions)
+
+
+class RetryOnLockTests(SimpleTestCase):
+
+    def test_view_is_retried_on_lock_errors_only(self):
+        calls = []
+
+        @retry_on_lock
+        def view(request):
+            calls.append(request)
+            if len(calls) < 3:
+                raise OperationalError("database is locked")
+            return "response"
+
+        self.assertEqual(view("request"), "response")
+        self.assertEqual(len(calls), 3)
+
+        @retry_on_lock
+        def broken_view(request):
+            calls.append(request)
+            raise OperationalError("no such table: core_item")
+
+        calls.clear()
+        with self.assertRaises(OperationalError):
+            broken_view("request")
+        self.assertEqual(len(calls), 1)
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    The test database of the primary is copied to an SQLite file standing in for a replica, then the primary gets
+    an item the replica does not have yet - as if the replication lagged behind.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.replicated_item = create_item(name="Apap")
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        replica_path = os.path.join(directory, "replica.sqlite3")
+        connection.ensure_connection()
+        replica_file = sqlite3.connect(replica_path)
+        connection.connection.backup(replica_file)
+        replica_file.close()
+
+        connections.settings["replica"] = {"ENGINE": "core.backends.sqlite3", "NAME": replica_path}
+        self.addCleanup(self.remove_replica_alias)
+
+        self.new_item = create_item(name="Ibuprom")
+
+    @staticmethod
+    def remove_replica_alias():
+        connections["replica"].close()
+        del connections.settings["replica"]
+        delattr(connections._connections, "replica")
+
+    def test_catalog_reads_go_to_the_replica(self):
+        response = self.client.get(reverse("core:index"))
+        self.assertEqual(list(response.context["item_list"]), [self.replicated_item])
+        self.assertNotContains(response, "Ibuprom")
+        self.assertEqual(self.client.get(reverse("core:detail", kwargs={"pk": self.replicated_item.pk})).status_code,
+                         200)
+        # not replicated yet
+        self.assertEqual(self.client.get(reverse("core:detail", kwargs={"pk": self.new_item.pk})).status_code, 404)
+
+    def test_session_reads_from_the_primary_after_writing(self):
+        detail_url = reverse("core:detail", kwargs={"pk": self.new_item.pk})
+        # adding to the cart reads and writes the primary
+        response = self.client.post(detail_url, {"n_pieces": 1})
+        self.assertRedirects(response, detail_url)
+        self.assertEqual(CartItem.objects.get().item, self.new_item)
+
+        self.assertEqual(self.client.get(detail_url).status_code, 200)
+
+        session = self.client.session
+        session[PRIMARY_UNTIL_SESSION_KEY] = time.time() - 1
+        session.save()
+        # the fragments rendered from the primary would be served from the cache
+        cache.clear()
+        self.assertEqual(self.client.get(detail_url).status_code, 404)
+
+    def test_router_keeps_writes_and_migrations_on_the_primary(self):
+        router = PrimaryReplicaRouter()
+        self.assertEqual(router.db_for_read(Item), DEFAULT_DB_ALIAS)
+        self.assertEqual(router.db_for_write(Item), DEFAULT_DB_ALIAS)
+        self.assertIs(router.allow_migrate("replica", "core"), False)
+        self.assertIsNone(router.allow_migrate(DEFAULT_DB_ALIAS, "core"))
+
+
+class CatalogFragmentCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item = create_item(name="Apap", in_stock=5)
+        self.url = reverse("core:detail", kwargs={"pk": self.item.pk})
+
+    def item_queries(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return [query["sql"] for query in queries if '"core_item"' in query["sql"]], response
+
+    def test_cached_pages_do_not_query_the_catalog(self):
+        for path in (self.url, reverse("core:index")):
+            self.item_queries(path)
+            queries, response = self.item_queries(path)
+            self.assertEqual(queries, [])
+            self.assertContains(response, "Apap")
+
+    def test_category_fragments_ignore_unknown_query_parameters(self):
+        subcategory = SubCategory.objects.create(category=Category.objects.create(name="Zdrowie"), name="Ból")
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(30):
+                create_item(name=f"Item {i:02d}", subcategories=[subcategory])
+        url = reverse("core:category-filtered", kwargs={"pk": subcategory.pk})
+        self.item_queries(f"{url}?min-price=1&max-price=50&order=price")
+
+        for query in ("max-price=50&min-price=1&order=price", "min-price=01&max-price=50&order=price&utm_source=x",
+                      "min-price=1&max-price=50&order=price&x=2"):
+            queries, response = self.item_queries(f"{url}?{query}")
+            self.assertEqual(queries, [])
+            self.assertContains(response, "?min-price=1&amp;max-price=50&amp;order=price&amp;cursor=")
+            self.assertNotContains(response, "utm_source")
+
+    def test_failed_adds_render_the_fragments_of_their_own_item(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            other_item = create_item(name="Ibuprom", in_stock=5)
+        self.client.post(self.url, data={"n_pieces": 6})
+
+        response = self.client.post(reverse("core:detail", kwargs={"pk": other_item.pk}), data={"n_pieces": 6})
+
+        self.assertContains(response, "Ibuprom")
+        self.assertNotContains(response, "Apap")
+
+    def test_fragments_refuse_a_missing_key(self):
+        template = Template('{% load catalog_fragments %}{% catalog_cache "item_detail_top" item_pk %}x'
+                            '{% endcatalog_cache %}')
+        self.assertEqual(template.render(Context({"item_pk": self.item.pk})), "x")
+        with self.assertRaises(TemplateSyntaxError):
+            template.render(Context({}))
+
+    def test_user_specific_parts_are_not_cached(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, "csrfmiddlewaretoken")
+
+        user = get_user_model().objects.create_user(username="user", password="password")
+        client = self.client_class()
+        client.force_login(user)
+        response = client.get(self.url)
+
+        self.assertContains(response, "Wyloguj")
+        self.assertNotEqual(response.cookies["csrftoken"].value, self.client.cookies["csrftoken"].value)
+        self.assertContains(response, response.context["csrf_token"])
+
+    def test_catalog_changes_bump_the_version(self):
+        self.client.get(self.url)
+
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            Item.objects.take_from_stock(self.item.pk, 5)
+        self.assertNotEqual(get_catalog_version(), version)
+        self.assertContains(self.client.get(self.url), "PRODUKT NIEDOSTĘPNY")
+
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.manufacturer.name = "Polpharma"
+            self.item.manufacturer.save()
+        self.assertNotEqual(get_catalog_version(), version)
+        self.assertContains(self.client.get(self.url), "Polpharma")
+
+    def test_version_is_bumped_only_when_the_change_commits(self):
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.item.name = "Apap Extra"
+            self.item.save()
+        self.assertEqual(get_catalog_version(), version)
+        self.assertTrue(callbacks)
+
+    def test_missing_item_is_not_found(self):
+        self.assertEqual(self.client.get(reverse("core:detail", kwargs={"pk": self.item.pk + 1})).status_code, 404)
+
+
+class OrderHistoryTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="user", password="password")
+        self.customer, address = create_customer_with_address()
+        self.customer.user = self.user
+        self.customer.save()
+        items = [create_item(name=f"Item {i}") for i in range(3)]
+        statuses = [Order.COMPLETED] * 22 + [Order.AWAITING_PAYMENT, Order.PROCESSING, Order.SHIPPED]
+        self.orders = []
+        for i, status in enumerate(statuses):
+            order = Order.objects.create(customer=self.customer, address=address, status=status)
+            OrderItem.objects.bulk_create([OrderItem(order=order, item=item, n_pieces=1, unit_price=item.price)
+                                           for item in items])
+            self.orders.append(order)
+        # the shipped order is the newest one
+        for i, order in enumerate(self.orders):
+            Order.objects.filter(pk=order.pk).update(date=timezone.now() - timedelta(days=len(self.orders) - i))
+        self.client.force_login(self.user)
+
+    def test_history_is_paginated_newest_first(self):
+        response = self.client.get(reverse("core:user"))
+        self.assertEqual(list(response.context["orders"]), self.orders[::-1][:10])
+
+        response = self.client.get(reverse("core:user"), data={"page": 3})
+        self.assertEqual(list(response.context["orders"]), self.orders[::-1][20:])
+        self.assertContains(response, "Strona 3 z 3")
+
+    def test_number_of_queries_does_not_depend_on_the_number_of_orders(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("core:user"))
+
+        order_queries = [query["sql"] for query in queries if '"core_order' in query["sql"]]
+        # count, page, its lines with items, active orders
+        self.assertEqual(len(order_queries), 4)
+
+    def test_banners_show_active_orders_only(self):
+        response = self.client.get(reverse("core:user"))
+
+        self.assertEqual({order.status for order in response.context["active_orders"]}, set(Order.ACTIVE_STATUSES))
+        self.assertContains(response, f"Twoje zamówienie o numerze #{self.orders[-1].pk} jest już w drodze!")
+
+    def test_history_query_uses_customer_date_index(self):
+        with connection.cursor() as cursor:
+            sql, params = Order.objects.for_customer(self.customer)[:10].query.sql_with_params()
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            plan = " ".join(str(row) for row in cursor.fetchall())
+
+        self.assertIn("core_order_customer_date_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+
+@override_settings(METRICS_QUERY_COUNT_HEADER=True)
+class AsyncCatalogViewTests(TransactionTestCase):
+    """
+    The async views run in other threads, which do not see the data of an uncommitted TestCase transaction.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.item = create_item(name="Apap")
+
+    def test_view_runs_in_the_thread_pool_and_its_queries_are_counted(self):
+        threads = []
+
+        def view(request):
+            threads.append(threading.get_ident())
+            return ItemDetailView.as_view()(request, pk=self.item.pk)
+
+        middleware = metrics.MetricsMiddleware(async_catalog_view(view))
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        request = RequestFactory().get(reverse("core:detail", kwargs={"pk": self.item.pk}))
+        response = async_to_sync(middleware)(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Apap")
+        self.assertNotEqual(threads, [threading.get_ident()])
+        # the item, its subcategories and its manufacturer
+        self.assertGreaterEqual(int(response[metrics.QUERY_COUNT_HEADER]), 2)
+
+    def test_missing_item_is_not_found(self):
+        view = async_catalog_view(ItemDetailView.as_view())
+        request = RequestFactory().get(reverse("core:detail", kwargs={"pk": self.item.pk + 1}))
+
+        with self.assertRaises(Http404):
+            async_to_sync(view)(request, pk=self.item.pk + 1)
+
+
+class ImportCatalogTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.manufacturer = Manufacturer.objects.create(name="US Pharmacia")
+        self.subcategory = SubCategory.objects.create(category=Category.objects.create(name="Leki"),
+                                                      name="Przeciwbólowe")
+
+    def import_catalog(self, file_name, content, **options):
+        path = os.path.join(self.directory, file_name)
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(content)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command("import_catalog", path, stdout=stdout, stderr=stderr, **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_csv_rows_are_added_and_then_updated(self):
+        self.import_catalog("catalog.csv", (
+            "sku,name,form,net_weight,price,price_sale,in_stock,manufacturer,subcategories\n"
+            "A1,Apap,TAB,10,9.99,,100,US Pharmacia,Leki > Przeciwbólowe;Witaminy > Dla dzieci\n"
+            "A2,Syrop,Syrop,100,19.99,15.00,5,Nowy Producent,\n"
+        ))
+
+        apap, syrup = Item.objects.get(sku="A1"), Item.objects.get(sku="A2")
+        self.assertEqual(apap.manufacturer, self.manufacturer)
+        self.assertEqual(syrup.manufacturer.name, "Nowy Producent")
+        self.assertEqual(syrup.form, Item.SYRUP)
+        self.assertEqual(syrup.effective_price, Decimal("15.00"))
+        self.assertEqual(apap.composition, "brak składu")
+        self.assertEqual({str(subcategory) for subcategory in apap.subcategories.all()},
+                         {"Leki > Przeciwbólowe", "Witaminy > Dla dzieci"})
+        self.assertFalse(syrup.subcategories.exists())
+
+        stdout, stderr = self.import_catalog("update.csv", (
+            "sku,name,form,net_weight,price,price_sale,in_stock,manufacturer,subcategories\n"
+            "A1,Apap Extra,TAB,10,12.00,11.00,50,US Pharmacia,Leki > Przeciwbólowe\n"
+        ), batch_size=1)
+
+        self.assertIn("0 items added, 1 updated", stdout)
+        self.assertEqual(list(apap.stockmovement_set.order_by("pk").values_list("reason", "quantity")),
+                         [(StockMovement.OPENING, 100), (StockMovement.ADJUSTMENT, -50)])
+        apap = Item.objects.get(pk=apap.pk)
+        self.assertEqual((apap.sku, apap.name, apap.in_stock, apap.effective_price),
+                         ("A1", "Apap Extra", 50, Decimal("11.00")))
+        # the links are replaced and carry the new price
+        self.assertEqual(list(apap.itemsubcategory_set.values_list("subcategory", "effective_price")),
+                         [(self.subcategory.pk, Decimal("11.00"))])
+        self.assertEqual(Item.objects.count(), 2)
+        self.assertEqual(list(SearchResults("extra")[:10]), [apap])
+
+    def test_jsonl_rows_without_subcategories_keep_the_links(self):
+        item = create_item(name="Apap", subcategories=[self.subcategory])
+        Item.objects.filter(pk=item.pk).update(sku="A1")
+
+        self.import_catalog("catalog.jsonl", "\n".join(json.dumps(row) for row in [
+            {"sku": "A1", "name": "Apap", "form": "TAB", "net_weight": 10, "price": "8.00", "in_stock": 3,
+             "manufacturer": "US Pharmacia"},
+            {"sku": "B1", "name": "Witamina C", "form": "TAB", "net_weight": 20, "price": "5.00", "in_stock": 7,
+             "manufacturer": "US Pharmacia", "subcategories": ["Leki > Przeciwbólowe"]},
+        ]))
+
+        self.assertEqual(list(item.itemsubcategory_set.values_list("subcategory", "effective_price")),
+                         [(self.subcategory.pk, Decimal("8.00"))])
+        self.assertEqual(list(self.subcategory.item_set.order_by("name").values_list("sku", flat=True)),
+                         ["A1", "B1"])
+
+    def test_missing_optional_columns_keep_the_stored_values(self):
+        item = create_item(name="Apap", price="10.00", price_sale="7.00", subcategories=[self.subcategory])
+        Item.objects.filter(pk=item.pk).update(sku="A1", composition="Paracetamol 500 mg", description="Na ból")
+
+        self.import_catalog("catalog.jsonl", json.dumps(
+            {"sku": "A1", "name": "Apap", "form": "TAB", "net_weight": 10, "price": "12.00", "in_stock": 10,
+             "manufacturer": "US Pharmacia"}))
+
+        item = Item.objects.get(pk=item.pk)
+        self.assertEqual((item.composition, item.description, item.price, item.price_sale, item.effective_price),
+                         ("Paracetamol 500 mg", "Na ból", Decimal("12.00"), Decimal("7.00"), Decimal("7.00")))
+        self.assertEqual(list(item.itemsubcategory_set.values_list("effective_price", flat=True)), [Decimal("7.00")])
+        self.assertEqual(list(SearchResults("paracetamol")[:10]), [item])
+
+        # a given (empty) column is updated
+        self.import_catalog("update.csv", (
+            "sku,name,form,net_weight,price,price_sale,in_stock,manufacturer\n"
+            "A1,Apap,TAB,10,12.00,,10,US Pharmacia\n"
+        ))
+        item = Item.objects.get(pk=item.pk)
+        self.assertEqual((item.composition, item.price_sale, item.effective_price),
+                         ("Paracetamol 500 mg", None, Decimal("12.00")))
+
+    def test_invalid_rows_are_reported_and_skipped(self):
+        stdout, stderr = self.import_catalog("catalog.csv", (
+            "sku,name,form,net_weight,price,in_stock,manufacturer\n"
+            "A1,Apap,TAB,10,abc,100,US Pharmacia\n"
+            ",Bez SKU,TAB,10,1.00,100,US Pharmacia\n"
+            "A3,Apap,TAB,10,1.00,100,US Pharmacia\n"
+        ))
+
+        self.assertIn("Line 2: price", stderr)
+        self.assertIn("Line 3: sku", stderr)
+        self.assertIn("1 items added, 0 updated, 2 invalid rows skipped", stdout)
+        self.assertEqual(list(Item.objects.values_list("sku", flat=True)), ["A3"])
+
+
+class ProductFeedTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        settings_override = override_settings(FEED_ROOT=self.directory, FEED_CHUNK_SIZE=2)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        subcategory = SubCategory.objects.create(category=Category.objects.create(name="Leki"), name="Przeciwbólowe")
+        self.items = [create_item(name=f"Item {i}", subcategories=[subcategory]) for i in range(5)]
+        self.feed = feeds.get_feed("csv")
+
+    def read_feed(self):
+        with open(feeds.feed_path(self.feed), encoding="utf-8") as file:
+            return file.read()
+
+    def test_export_renders_only_the_changed_chunks(self):
+        n_chunks = len({item.pk // 2 for item in self.items})
+        self.assertEqual(feeds.export_feed(self.feed), (n_chunks, n_chunks))
+        self.assertIn("Item 4,US Pharmacia,Leki > Przeciwbólowe,10.00,10.00,in stock,10", self.read_feed())
+        self.assertEqual(feeds.export_feed(self.feed), (0, n_chunks))
+
+        Item.objects.filter(pk=self.items[1].pk).update(price_sale=Decimal("7.50"), in_stock=0)
+        deleted_pk = self.items[4].pk
+        self.items[4].delete()
+        remaining_chunks = {item.pk // 2 for item in self.items[:4]}
+        # a chunk left without items is dropped rather than rendered
+        changed_chunks = {self.items[1].pk // 2, deleted_pk // 2} & remaining_chunks
+
+        self.assertEqual(feeds.export_feed(self.feed), (len(changed_chunks), len(remaining_chunks)))
+        content = self.read_feed()
+        self.assertIn("Item 1,US Pharmacia,Leki > Przeciwbólowe,7.50,10.00,out of stock,0", content)
+        self.assertNotIn("Item 4", content)
+        self.assertEqual(content.count("\n"), 1 + 4)
+
+    def test_subcategory_change_updates_the_item(self):
+        feeds.export_feed(self.feed)
+        other = SubCategory.objects.create(category=Category.objects.get(name="Leki"), name="Witaminy")
+        self.items[0].subcategories.set([other])
+
+        self.assertEqual(feeds.export_feed(self.feed)[0], 1)
+        self.assertIn("Item 0,US Pharmacia,Leki > Witaminy", self.read_feed())
+
+    def test_view_serves_the_exported_file_with_conditional_get(self):
+        url = reverse("core:product-feed", kwargs={"feed_format": "xml"})
+        # streamed from the database before the first export
+        response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.has_header("ETag"))
+        self.assertIn('<offer id="%d">' % self.items[0].pk, b"".join(response.streaming_content).decode())
+
+        feeds.export_feed(feeds.get_feed("xml"))
+        response = self.client.get(url)
+        self.assertEqual(response["Content-Type"], "application/xml; charset=utf-8")
+        self.assertIn(b"<name>Item 3</name>", b"".join(response.streaming_content))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get(reverse("core:product-feed", kwargs={"feed_format": "pdf"})).status_code,
+                         404)
+
+
+class CatalogApiTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.subcategory = SubCategory.objects.create(category=Category.objects.create(name="Leki"),
+                                                      name="Przeciwbólowe")
+        self.items = [create_item(name=f"Item {i}", subcategories=[self.subcategory] if i % 2 else [])
+                      for i in range(5)]
+
+    def get(self, name, pk=None, **params):
+        url = reverse(name, kwargs={"pk": pk} if pk is not None else None)
+        return self.client.get(url, data=params)
+
+    def test_sparse_fields_and_bulk_fetch(self):
+        item = self.items[1]
+        data = self.get("core:api-item", item.pk).json()
+        self.assertEqual((data["name"], data["price"], data["subcategories"], data["manufacturer"]),
+                         ("Item 1", "10.00", [self.subcategory.pk], item.manufacturer_id))
+
+        with self.assertNumQueries(2):
+            response = self.get("core:api-items", ids=f"{self.items[3].pk},{self.items[0].pk},0", fields="id,name")
+        self.assertEqual(response.json(), {"results": [{"id": self.items[0].pk, "name": "Item 0"},
+                                                       {"id": self.items[3].pk, "name": "Item 3"}]})
+
+        self.assertEqual(self.get("core:api-items", fields="id,price,secret").status_code, 400)
+        self.assertEqual(self.get("core:api-items", ids="1,x").status_code, 400)
+        self.assertEqual(self.get("core:api-item", 0).status_code, 404)
+
+    def test_cursor_pagination_and_filters(self):
+        pks = []
+        response = self.get("core:api-items", limit=2, fields="id")
+        while True:
+            data = response.json()
+            pks += [item["id"] for item in data["results"]]
+            if data["next"] is None:
+                break
+            response = self.client.get(data["next"])
+        self.assertEqual(pks, [item.pk for item in self.items])
+
+        data = self.get("core:api-items", subcategory=self.subcategory.pk, fields="id").json()
+        self.assertEqual([item["id"] for item in data["results"]], [self.items[1].pk, self.items[3].pk])
+
+        data = self.get("core:api-subcategories").json()
+        self.assertEqual(data["results"], [{"id": self.subcategory.pk, "name": "Przeciwbólowe",
+                                            "category": self.subcategory.category_id, "category_name": "Leki"}])
+        self.assertEqual(self.get("core:api-manufacturer", self.items[0].manufacturer_id).json()["name"],
+                         "US Pharmacia")
+
+    def test_unchanged_resources_are_not_modified(self):
+        item = self.items[2]
+        response = self.get("core:api-item", item.pk)
+        etag, last_modified = response["ETag"], response["Last-Modified"]
+        self.assertEqual(last_modified, http_date(item.updated_at.timestamp()))
+
+        # one narrow query, nothing is serialized
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("core:api-item", kwargs={"pk": item.pk}), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.content), (304, b""))
+        response = self.client.get(reverse("core:api-item", kwargs={"pk": item.pk}),
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        # another representation of the item
+        response = self.client.get(reverse("core:api-item", kwargs={"pk": item.pk}), data={"fields": "id"},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        list_etag = self.get("core:api-items", fields="id,in_stock")["ETag"]
+        Item.objects.take_from_stock(item.pk, 1)
+        response = self.client.get(reverse("core:api-item", kwargs={"pk": item.pk}), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.json()["in_stock"]), (200, 9))
+        self.assertNotEqual(self.get("core:api-items", fields="id,in_stock")["ETag"], list_etag)
+
+        # removal of an item from a list
+        list_etag = self.get("core:api-items", fields="id")["ETag"]
+        self.items[4].delete()
+        response = self.client.get(reverse("core:api-items"), data={"fields": "id"}, HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class StockLedgerTests(TestCase):
+
+    def setUp(self):
+        self.item = create_item(in_stock=5)
+        self.customer, self.address = create_customer_with_address()
+
+    def ledger_total(self):
+        return self.item.stockmovement_set.aggregate(total=Sum("quantity"))["total"]
+
+    def test_every_stock_change_is_recorded(self):
+        order = Order.objects.create(customer=self.customer, address=self.address)
+        self.assertTrue(Item.objects.take_from_stock(self.item.pk, 3, order=order))
+        self.assertFalse(Item.objects.take_from_stock(self.item.pk, 3))
+        Item.objects.move_stock(self.item.pk, 10, StockMovement.RESTOCK, note="dostawa")
+
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.in_stock, 12)
+        self.assertEqual(self.ledger_total(), 12)
+        self.assertEqual(list(self.item.stockmovement_set.order_by("pk").values_list("reason", "quantity", "order")),
+                         [(StockMovement.OPENING, 5, None), (StockMovement.SALE, -3, order.pk),
+                          (StockMovement.RESTOCK, 10, None)])
+
+        movement = self.item.stockmovement_set.first()
+        movement.quantity = 100
+        with self.assertRaises(ValueError):
+            movement.save()
+
+    def test_saving_a_stale_item_keeps_the_stock(self):
+        stale_item = Item.objects.get(pk=self.item.pk)
+        Item.objects.take_from_stock(self.item.pk, 2)
+        stale_item.name = "Apap Forte"
+        stale_item.save()
+
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.name, self.item.in_stock), ("Apap Forte", 3))
+
+    def test_cancelled_order_returns_the_pieces_once(self):
+        order = Order.objects.create(customer=self.customer, address=self.address)
+        OrderItem.objects.create(order=order, item=self.item, n_pieces=2)
+        Item.objects.take_from_stock(self.item.pk, 2, order=order)
+
+        self.assertTrue(order.cancel())
+        self.assertFalse(Order.objects.get(pk=order.pk).cancel())
+
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.in_stock, self.ledger_total()), (5, 5))
+        self.assertEqual(order.status, Order.CANCELLED)
+
+    def test_admin_cancels_and_deletes_orders_through_the_ledger(self):
+        order = Order.objects.create(customer=self.customer, address=self.address)
+        OrderItem.objects.create(order=order, item=self.item, n_pieces=2)
+        Item.objects.take_from_stock(self.item.pk, 2, order=order)
+        self.client.force_login(get_user_model().objects.create_superuser(username="admin", password="bar"))
+
+        # the status cannot be changed in the form
+        response = self.client.post(reverse("admin:core_order_change", args=[order.pk]),
+                                    data=dict(customer=self.customer.pk, address=self.address.pk,
+                                              status=Order.CANCELLED, delivery_method=order.delivery_method,
+                                              payment_method=order.payment_method, total_price="20.00"))
+        self.assertEqual(response.status_code, 302)
+        order.refresh_from_db()
+        self.item.refresh_from_db()
+        self.assertEqual((order.status, self.item.in_stock), (Order.AWAITING_PAYMENT, 3))
+
+        self.client.post(reverse("admin:core_order_delete", args=[order.pk]), data={"post": "yes"})
+
+        self.assertFalse(Order.objects.exists())
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.in_stock, self.ledger_total()), (5, 5))
+        self.assertEqual(self.item.stockmovement_set.latest("pk").reason, StockMovement.CANCELLATION)
+
+    def test_shipped_and_completed_orders_are_not_cancelled(self):
+        orders = []
+        for status in (Order.PROCESSING, Order.SHIPPED, Order.COMPLETED):
+            order = Order.objects.create(customer=self.customer, address=self.address, status=status)
+            OrderItem.objects.create(order=order, item=self.item, n_pieces=1)
+            Item.objects.take_from_stock(self.item.pk, 1, order=order)
+            orders.append(order)
+        self.assertFalse(orders[1].cancel())
+        self.client.force_login(get_user_model().objects.create_superuser(username="admin", password="bar"))
+
+        response = self.client.post(reverse("admin:core_order_changelist"), follow=True,
+                                    data={"action": "cancel_orders", "_selected_action": [o.pk for o in orders]})
+
+        self.assertContains(response, "Anulowano zamówień: 1")
+        self.assertContains(response, f"Pominięto zamówienia anulowane, wysłane lub zrealizowane: "
+                                      f"#{orders[1].pk}, #{orders[2].pk}")
+        self.assertEqual(list(Order.objects.order_by("pk").values_list("status", flat=True)),
+                         [Order.CANCELLED, Order.SHIPPED, Order.COMPLETED])
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.in_stock, 3)
+
+        # deleting shipped orders does not return their pieces either
+        self.client.post(reverse("admin:core_order_delete", args=[orders[1].pk]), data={"post": "yes"})
+        self.client.post(reverse("admin:core_order_changelist"),
+                         data={"action": "delete_selected", "_selected_action": [orders[2].pk], "post": "yes"})
+        self.assertEqual(list(Order.objects.values_list("pk", flat=True)), [orders[0].pk])
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.in_stock, self.ledger_total()), (3, 3))
+
+    def test_reconcile_reports_and_fixes_direct_stock_writes(self):
+        Item.objects.filter(pk=self.item.pk).update(in_stock=7)
+        stdout = io.StringIO()
+        call_command("reconcile_stock", stdout=stdout)
+        self.assertIn(f"Item {self.item.pk}: 7 in stock, 5 in the ledger", stdout.getvalue())
+
+        call_command("reconcile_stock", fix=True, stdout=io.StringIO())
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.in_stock, 5)
+
+    def test_compaction_keeps_the_ledger_total(self):
+        for i in range(3):
+            Item.objects.move_stock(self.item.pk, 1, StockMovement.RESTOCK)
+        StockMovement.objects.update(created_at=timezone.now() - timedelta(days=40))
+        Item.objects.move_stock(self.item.pk, -1, StockMovement.ADJUSTMENT)
+
+        stdout = io.StringIO()
+        call_command("reconcile_stock", compact_before=30, stdout=stdout)
+
+        self.assertIn("4 movements compacted", stdout.getvalue())
+        self.assertIn("1 items checked, 0 mismatched", stdout.getvalue())
+        self.assertEqual(list(self.item.stockmovement_set.order_by("created_at").values_list("reason", "quantity")),
+                         [(StockMovement.OPENING, 8), (StockMovement.ADJUSTMENT, -1)])
+
+
+# calls of the test jobs
+job_calls = []
+
+
+@job
+def record_call(value):
+    job_calls.append(value)
+
+
+@job
+def fail():
+    raise RuntimeError("Serwer poczty nie odpowiada")
+
+
+def run_jobs():
+    """
+    Run the runnable jobs in the test's thread (workers use connections of their own).
+    """
+    while (claimed_job := claim_job("test")) is not None:
+        run_job(claimed_job)
+
+
+class JobQueueTests(TestCase):
+
+    def setUp(self):
+        job_calls.clear()
+
+    def test_jobs_of_a_rolled_back_transaction_are_not_queued(self):
+        with self.assertRaises(ValidationError):
+            with transaction.atomic():
+                enqueue(record_call, value=1)
+                raise ValidationError("checkout failed")
+        self.assertFalse(Job.objects.exists())
+
+        with self.assertRaises(ValueError):
+            enqueue(print)
+
+    def test_finished_job_is_deleted(self):
+        enqueue(record_call, value=1)
+        enqueue(record_call, delay=60, value=2)
+
+        run_jobs()
+
+        self.assertEqual(job_calls, [1])
+        self.assertEqual(Job.objects.get().payload, {"value": 2})
+
+    def test_failing_job_is_retried_with_backoff_and_then_dead(self):
+        enqueue(fail, max_attempts=2)
+        run_jobs()
+
+        failed_job = Job.objects.get()
+        self.assertEqual((failed_job.status, failed_job.attempts), (Job.QUEUED, 1))
+        self.assertGreater(failed_job.run_at, timezone.now() + timedelta(seconds=settings.JOB_RETRY_BASE_DELAY / 3))
+        self.assertIn("Serwer poczty nie odpowiada", failed_job.last_error)
+
+        Job.objects.update(run_at=timezone.now())
+        run_jobs()
+
+        failed_job.refresh_from_db()
+        self.assertEqual((failed_job.status, failed_job.attempts), (Job.DEAD, 2))
+        self.assertIsNone(claim_job("test"))
+
+    def test_abandoned_job_is_claimed_again(self):
+        enqueue(record_call, value=1)
+        abandoned = claim_job("killed worker")
+        self.assertIsNone(claim_job("test"))
+
+        Job.objects.update(locked_at=timezone.now() - timedelta(seconds=settings.JOB_LOCK_TIMEOUT + 1))
+        claimed = claim_job("test")
+        self.assertEqual((claimed.pk, claimed.attempts), (abandoned.pk, 2))
+
+        # the first worker finishing late does not affect the new claim
+        run_job(abandoned)
+        self.assertTrue(Job.objects.filter(pk=claimed.pk, locked_by="test").exists())
+        run_job(claimed)
+        self.assertFalse(Job.objects.exists())
+
+    @override_settings(MANAGERS=[("Kierownik", "kierownik@example.com")])
+    def test_checkout_emails_are_sent_by_jobs(self):
+        user = get_user_model().objects.create_user(username="user", email="user@example.com", password="password")
+        self.client.force_login(user)
+        item = create_item(in_stock=5)
+        self.client.post(reverse("core:detail", kwargs={"pk": item.pk}), data={"n_pieces": 3})
+
+        self.client.post(reverse("core:checkout"), data=CHECKOUT_FORM_DATA)
+        self.assertEqual(Job.objects.count(), 2)
+        self.assertEqual(mail.outbox, [])
+
+        run_jobs()
+
+        confirmation, alert = sorted(mail.outbox, key=lambda message: message.to != ["user@example.com"])
+        self.assertIn(f"#{Order.objects.get().pk}", confirmation.subject)
+        self.assertIn("3 x Apap", confirmation.body)
+        self.assertEqual(alert.to, ["kierownik@example.com"])
+        self.assertIn("Apap", alert.body)
+
+    def test_account_emails_are_sent_by_jobs(self):
+        get_user_model().objects.create_user(username="user", email="user@example.com", password="password")
+
+        self.client.post(reverse("account_reset_password"), data={"email": "user@example.com"})
+        self.assertEqual(mail.outbox, [])
+
+        run_jobs()
+        self.assertEqual([message.to for message in mail.outbox], [["user@example.com"]])
+
+
+class RunWorkersTests(TransactionTestCase):
+
+    def test_workers_run_every_job_once(self):
+        job_calls.clear()
+        for i in range(20):
+            enqueue(record_call, value=i)
+
+        stdout = io.StringIO()
+        call_command("run_workers", processes=1, threads=4, burst=True, stdout=stdout)
+
+        self.assertIn("20 jobs run", stdout.getvalue())
+        self.assertEqual(sorted(job_calls), list(range(20)))
+        self.assertFalse(Job.objects.exists())
+
+
+class PruneCartsTests(TestCase):
+
+    def setUp(self):
+        self.item = create_item(in_stock=10)
+        self.user = get_user_model().objects.create_user(username="foo", password="bar")
+
+    def create_anonymous_cart(self, days_ago=0, session_expired=False):
+        session = SessionStore()
+        session.create()
+        if session_expired:
+            Session.objects.filter(session_key=session.session_key).update(
+                expire_date=timezone.now() - timedelta(days=1))
+        cart = Cart.objects.create(session=session.session_key)
+        CartItem.objects.create(cart=cart, item=self.item, n_pieces=1)
+        # the line bumps updated_at
+        Cart.objects.filter(pk=cart.pk).update(updated_at=timezone.now() - timedelta(days=days_ago))
+        return cart
+
+    def test_prune_carts_deletes_expired_sessions_and_abandoned_carts(self):
+        fresh_cart = self.create_anonymous_cart()
+        self.create_anonymous_cart(days_ago=settings.CART_MAX_AGE_DAYS + 1)
+        self.create_anonymous_cart(session_expired=True)
+        user_cart = Cart.objects.create(user=self.user, updated_at=timezone.now() - timedelta(days=365))
+
+        out = io.StringIO()
+        call_command("prune_carts", batch_size=1, stdout=out)
+
+        self.assertIn("1 expired sessions and 2 abandoned carts deleted", out.getvalue())
+        self.assertEqual(set(Cart.objects.all()), {fresh_cart, user_cart})
+        self.assertEqual(list(CartItem.objects.values_list('cart', flat=True)), [fresh_cart.pk])
+        self.assertEqual(Session.objects.count(), 2)
+
+    def test_cart_changes_bump_updated_at(self):
+        cart = self.create_anonymous_cart(days_ago=settings.CART_MAX_AGE_DAYS + 1)
+        CartItem.objects.get(cart=cart).delete()
+        cart.refresh_from_db()
+        self.assertGreater(cart.updated_at, timezone.now() - timedelta(minutes=1))
+
+    def test_scheduled_pruning_job_reschedules_itself(self):
+        self.create_anonymous_cart(session_expired=True)
+        call_command("prune_carts", schedule=True, stdout=io.StringIO())
+        call_command("prune_carts", schedule=True, stdout=io.StringIO())
+        self.assertEqual(Job.objects.count(), 1)
+
+        run_jobs()
+
+        self.assertFalse(Cart.objects.exists())
+        next_run = Job.objects.get()
+        self.assertGreater(next_run.run_at, timezone.now() + timedelta(seconds=settings.CART_PRUNE_INTERVAL - 60))
+
+
+class SalesRollupTests(TestCase):
+
+    def setUp(self):
+        self.apap = create_item(name="Apap", price="10.00", in_stock=20)
+        self.ibuprom = create_item(name="Ibuprom", price="20.00", price_sale="15.00", in_stock=20)
+        self.customer, self.address = create_customer_with_address()
+
+    def place(self, *lines, payment_method=Order.BLIK):
+        cart = Cart.objects.create()
+        for item, n_pieces in lines:
+            CartItem.objects.create(cart=cart, item=item, n_pieces=n_pieces)
+        return place_order(cart, customer=self.customer, address=self.address, delivery_method=Order.DHL,
+                           payment_method=payment_method)
+
+    def rollups(self):
+        return (set(DailyItemSales.objects.values_list("item", "n_orders", "n_pieces", "revenue")),
+                set(DailyOrderSales.objects.values_list("payment_method", "n_orders", "revenue")))
+
+    def test_placed_orders_are_added_to_the_rollups(self):
+        order = self.place((self.apap, 2), (self.ibuprom, 1))
+        self.place((self.apap, 1), payment_method=Order.CARD)
+
+        self.assertEqual(list(order.orderitem_set.order_by("item").values_list("unit_price", flat=True)),
+                         [Decimal("10.00"), Decimal("15.00")])
+        self.assertEqual(self.rollups(), (
+            {(self.apap.pk, 2, 3, Decimal("30.00")), (self.ibuprom.pk, 1, 1, Decimal("15.00"))},
+            {(Order.BLIK, 1, Decimal("35.00")), (Order.CARD, 1, Decimal("10.00"))},
+        ))
+        self.assertEqual(set(DailyOrderSales.objects.values_list("date", flat=True)), {timezone.localdate()})
+
+    def test_cancelled_and_deleted_orders_are_removed_from_the_rollups(self):
+        order = self.place((self.apap, 2))
+        kept_order = self.place((self.ibuprom, 1))
+
+        order.cancel()
+        self.assertEqual(self.rollups(), (
+            {(self.apap.pk, 0, 0, Decimal("0.00")), (self.ibuprom.pk, 1, 1, Decimal("15.00"))},
+            {(Order.BLIK, 1, Decimal("15.00"))},
+        ))
+
+        kept_order.delete()
+        self.assertEqual(self.rollups()[1], {(Order.BLIK, 0, Decimal("0.00"))})
+
+    def test_admin_changes_the_rollups_and_the_stock_together(self):
+        order = self.place((self.apap, 2))
+        expected = self.rollups()
+        self.client.force_login(get_user_model().objects.create_superuser(username="admin", password="bar"))
+
+        # the status in the change form is read-only
+        response = self.client.post(reverse("admin:core_order_change", args=[order.pk]),
+                                    data=dict(customer=self.customer.pk, address=self.address.pk,
+                                              status=Order.CANCELLED, delivery_method=order.delivery_method,
+                                              payment_method=order.payment_method, total_price="20.00"))
+        self.assertEqual(response.status_code, 302)
+        self.apap.refresh_from_db()
+        self.assertEqual((self.rollups(), self.apap.in_stock), (expected, 18))
+
+        self.client.post(reverse("admin:core_order_changelist"),
+                         data={"action": "cancel_orders", "_selected_action": [order.pk]})
+        self.apap.refresh_from_db()
+        self.assertEqual(self.rollups()[1], {(Order.BLIK, 0, Decimal("0.00"))})
+        self.assertEqual(self.apap.in_stock, 20)
+
+        # a deleted order is removed from the rollups once, together with returning its pieces
+        other_order = self.place((self.apap, 3))
+        self.client.post(reverse("admin:core_order_delete", args=[other_order.pk]), data={"post": "yes"})
+        self.apap.refresh_from_db()
+        self.assertEqual(self.rollups()[1], {(Order.BLIK, 0, Decimal("0.00"))})
+        self.assertEqual(self.apap.in_stock, 20)
+
+    def test_rebuild_matches_the_incremental_rollups(self):
+        self.place((self.apap, 2), (self.ibuprom, 1))
+        self.place((self.ibuprom, 3), payment_method=Order.CARD)
+        self.place((self.apap, 1)).cancel()
+        old_order = self.place((self.apap, 4))
+        Order.objects.filter(pk=old_order.pk).update(date=timezone.now() - timedelta(days=3))
+        DailyItemSales.objects.all().delete()
+        DailyOrderSales.objects.all().delete()
+        expected_days = {timezone.localdate(), timezone.localdate() - timedelta(days=3)}
+
+        out = io.StringIO()
+        call_command("rebuild_sales_rollups", stdout=out)
+
+        self.assertIn("Rollups of 2 days (3 orders) rebuilt", out.getvalue())
+        self.assertEqual(set(DailyOrderSales.objects.values_list("date", flat=True)), expected_days)
+        rebuilt = self.rollups()
+        DailyItemSales.objects.all().delete()
+        DailyOrderSales.objects.all().delete()
+        for order in Order.objects.exclude(status=Order.CANCELLED):
+            order.record_sales()
+        self.assertEqual(self.rollups(), rebuilt)
+
+    def test_report_is_staff_only_and_reads_the_rollups(self):
+        self.place((self.apap, 2), (self.ibuprom, 1))
+        self.place((self.apap, 1)).cancel()
+        user = get_user_model().objects.create_user(username="foo", password="bar")
+        self.client.force_login(user)
+
+        response = self.client.get(reverse("core:sales-report"))
+        self.assertEqual(response.status_code, 302)
+
+        user.is_staff = True
+        user.save()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("core:sales-report"))
+
+        report = response.context["report"]
+        self.assertEqual((report["total_orders"], report["total_revenue"]), (1, Decimal("35.00")))
+        self.assertEqual([(row["name"], row["total_pieces"]) for row in report["top_items"]],
+                         [("Apap", 2), ("Ibuprom", 1)])
+        self.assertEqual([row["label"] for row in report["payment_methods"]],
+                         [dict(Order.PAYMENT_METHOD_CHOICES)[Order.BLIK]])
+        self.assertFalse([query["sql"] for query in queries if '"core_order' in query["sql"]])
+
+    def test_report_rejects_reversed_dates(self):
+        self.client.force_login(get_user_model().objects.create_user(username="foo", password="bar", is_staff=True))
+        response = self.client.get(reverse("core:sales-report"), data={"start": "2021-02-01", "end": "2021-01-01"})
+        self.assertIsNone(response.context["report"])
+        self.assertContains(response, "Data początkowa nie może być późniejsza niż końcowa.")
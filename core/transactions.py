@@ -0,0 +1,57 @@
+import functools
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+from django.db import OperationalError, transaction
+
+# bounded retry of requests failing on a database lock
+LOCK_RETRY_ATTEMPTS = 4
+LOCK_RETRY_BASE_DELAY = 0.05
+
+
+@contextmanager
+def immediate_atomic(using=None):
+    """
+    Atomic block for write paths: on SQLite (core.backends.sqlite3) the transaction takes the write lock
+    when it starts, so it waits for a concurrent writer (up to busy_timeout) instead of failing
+    with "database is locked" after it has read something.
+    Nested in another atomic block it is a plain savepoint - the transaction has already started.
+    Can be used as a decorator as well.
+    """
+    connection = transaction.get_connection(using)
+    connection.begin_immediate = not connection.in_atomic_block
+    try:
+        with transaction.atomic(using=using):
+            connection.begin_immediate = False
+            yield
+    finally:
+        connection.begin_immediate = False
+
+
+def is_lock_error(error):
+    # "database is locked" (another connection writes) or "database table is locked" (shared cache)
+    return "is locked" in str(error)
+
+
+def retry_on_lock(view):
+    """
+    Decorator for write views: rerun the view with exponential backoff (and jitter) when it fails
+    on a database lock, at most LOCK_RETRY_ATTEMPTS times. The view must write in atomic blocks only,
+    so that a failed attempt leaves nothing behind.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        for attempt in range(LOCK_RETRY_ATTEMPTS):
+            try:
+                return view(*args, **kwargs)
+            except OperationalError as error:
+                if not is_lock_error(error) or attempt == LOCK_RETRY_ATTEMPTS - 1:
+                    raise
+                delay = LOCK_RETRY_BASE_DELAY * 2 ** attempt
+                logging.debug(f"Database locked, retrying in {delay:.2f}s: {error}")
+                time.sleep(delay * random.uniform(0.5, 1.5))
+
+    return wrapper
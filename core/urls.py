@@ -1,20 +1,40 @@
 from django.urls import path
-from core import views
+from core import api, views
+from core.async_views import async_catalog_view
 from django.conf import settings
 from django.conf.urls.static import static
 from django.views.generic import TemplateView
 
 app_name = 'core'
 
+
+def catalog_view(view):
+    return async_catalog_view(view) if settings.ASYNC_CATALOG_VIEWS else view
+
+
 urlpatterns = [
-    path('', views.ItemListView.as_view(), name="index"),
-    path('<int:pk>/detail/', views.ItemDetailView.as_view(), name="detail"),
+    path('', catalog_view(views.ItemListView.as_view()), name="index"),
+    path('<int:pk>/detail/', catalog_view(views.ItemDetailView.as_view()), name="detail"),
     path('cart/', views.CartView.as_view(), name='cart'),
     path('cart/remove/<int:pk>/', views.RemoveFromCartView.as_view(), name='cart-remove'),
+    path('cart/api/add/<int:pk>/', views.CartAddApiView.as_view(), name='cart-api-add'),
+    path('cart/api/quantity/<int:pk>/', views.CartQuantityApiView.as_view(), name='cart-api-quantity'),
+    path('cart/api/remove/<int:pk>/', views.CartRemoveApiView.as_view(), name='cart-api-remove'),
     path('checkout/', views.CheckoutView.as_view(template_name='core/checkout.html'), name='checkout'),
-    path('category/<int:pk>/', views.CategoryFilteredView.as_view(), name='category-filtered'),
+    path('category/<int:pk>/', catalog_view(views.CategoryFilteredView.as_view()), name='category-filtered'),
+    path('category/<int:pk>/items/', catalog_view(views.CategoryItemsView.as_view()), name='category-items'),
+    path('search/', catalog_view(views.SearchView.as_view()), name='search'),
     path('user/', views.UserView.as_view(), name='user'),
-    path('checkout/summary/', TemplateView.as_view(template_name="core/summary.html"), name="summary")
+    path('checkout/summary/', TemplateView.as_view(template_name="core/summary.html"), name="summary"),
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
+    path('reports/sales/', views.SalesReportView.as_view(), name='sales-report'),
+    path('feeds/products.<str:feed_format>', views.ProductFeedView.as_view(), name='product-feed'),
+    path('api/items/', api.ItemApiView.as_view(), name='api-items'),
+    path('api/items/<int:pk>/', api.ItemApiView.as_view(), name='api-item'),
+    path('api/subcategories/', api.SubCategoryApiView.as_view(), name='api-subcategories'),
+    path('api/subcategories/<int:pk>/', api.SubCategoryApiView.as_view(), name='api-subcategory'),
+    path('api/manufacturers/', api.ManufacturerApiView.as_view(), name='api-manufacturers'),
+    path('api/manufacturers/<int:pk>/', api.ManufacturerApiView.as_view(), name='api-manufacturer'),
 ]
 
 if settings.DEBUG:
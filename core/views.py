@@ -6,65 +6,73 @@ from django.contrib import messages
 from django.urls import reverse
 from .forms import *
 from django.core.validators import ValidationError
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import Http404
-from django.utils.html import escape
+from django.http import Http404, HttpResponse, FileResponse, JsonResponse, StreamingHttpResponse
+from django.utils.http import urlencode
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.paginator import Paginator
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from django.utils.functional import SimpleLazyObject
+from django.utils import timezone
+from django.contrib.admin.views.decorators import staff_member_required
+from .search import SearchResults
+from .pagination import KeysetPaginator
+from .cart import get_cart, get_or_create_cart
+from .transactions import immediate_atomic, retry_on_lock
+from .routers import read_from_replicas
+from .jobs import enqueue
+from .notifications import send_order_confirmation, check_stock_levels
+from . import feeds, metrics, reports
+import datetime
 import logging
+import os
 
 
-def get_or_create_cart(request):
+def place_order(cart, customer, address, delivery_method, payment_method):
     """
-    Helper function for retrieving an existing Cart instance or creating a new one.
-    :return: tuple(cart: Cart instance, created: boolean flag - True if new cart was created else False)
+    Helper function turning the content of the cart into an order within a single transaction.
+    The stock of every ordered item is decreased with a conditional UPDATE (recorded as a sale in the stock ledger),
+    so concurrent checkouts cannot oversell, order lines are inserted with one bulk INSERT and the cart is emptied
+    with one DELETE.
+    :raise ValidationError: if any of the items has not enough pieces in stock (nothing is written in such case)
+    :return: created Order instance
     """
-    user = request.user
-    session_key = request.session.session_key
-    if session_key is None:
-        # if session_key is None then session is not in database -> create new session and retrieve new session_key
-        request.session.create()
-        session_key = request.session.session_key
-
-    if user.is_authenticated:
-        # if user is logged in -> try to retrieve current Cart instance based on current session_key
-        try:
-            cart = Cart.objects.get(session=session_key)
-            # cart assigned to session become associated with the logged-in user
-            cart.user = user
-            cart.save()
-            created = False
+    with immediate_atomic():
+        cart_items = CartItem.objects.filter(cart=cart)
+        # lock rows in a consistent order (by item primary key)
+        cart_item_list = list(cart_items.select_related('item').order_by('item__pk'))
 
-        except ObjectDoesNotExist:
-            # if the cart associated with session does not exist, try to get a Cart instance already associated with the user
-            # or create a new Cart instance and bind it to the user
-            cart, created = Cart.objects.get_or_create(user=user)
-            # associate the current session with the cart
-            cart.session = session_key
-            cart.save()
-
-    else:
-        cart, created = Cart.objects.get_or_create(session=session_key)
-
-        if settings.DEBUG:
-            if not created:
-                logging.debug("Cart fetched - session_id: " + session_key)
-            else:
-                logging.debug("Cart created - session_id: " + session_key)
+        order = Order.objects.create(address=address, customer=customer,
+                                     delivery_method=delivery_method, payment_method=payment_method,
+                                     total_price=cart_items.total_price())
+
+        for cart_item in cart_item_list:
+            if not Item.objects.take_from_stock(cart_item.item_id, cart_item.n_pieces, order=order):
+                # leaving the atomic block with an exception rolls back the order and the already taken pieces
+                raise not_enough_pieces_error(cart_item.item)
+
+        OrderItem.objects.bulk_create([OrderItem(order=order, item_id=cart_item.item_id, n_pieces=cart_item.n_pieces,
+                                                 unit_price=cart_item.item.effective_price)
+                                       for cart_item in cart_item_list])
+
+        cart_items.delete()
 
-    return cart, created
+        # the daily sales rollups are updated in the same transaction
+        order.record_sales()
 
+        # committed (and run by the workers) together with the order
+        enqueue(send_order_confirmation, order_pk=order.pk)
+        enqueue(check_stock_levels, item_pks=[cart_item.item_id for cart_item in cart_item_list])
 
-def calc_total_price(container_item_list):
-    total_price = sum(
-        container_item.item.price_sale * container_item.n_pieces if container_item.item.price_sale is not None
-        else container_item.item.price * container_item.n_pieces
-        for container_item in container_item_list)
-    return total_price
+    return order
 
 
+@method_decorator(read_from_replicas, name='dispatch')
 class ItemListView(ListView):
     model = Item
     template_name = 'core/index.html'
@@ -74,15 +82,38 @@ class ItemListView(ListView):
         return self.model.objects.all()[:4]
 
 
+def add_to_cart(request, item, n_pieces):
+    """
+    Helper function adding pieces of the item to the cart of the visitor (the cart is created if needed).
+    :raise ValidationError: if there are not enough pieces of the item in stock (the line is not changed in such case)
+    :return: the updated CartItem instance
+    """
+    # the cart is only created once there is something valid to put in it
+    cart, created = get_or_create_cart(request)
+    # the line is read and then written - take the write lock up front
+    with immediate_atomic():
+        # if cart was created then it's empty, and it's safe to create a new CartItem instance
+        cart_item = None if created else CartItem.objects.filter(cart=cart, item=item).first()
+        if cart_item is None:
+            cart_item = CartItem(n_pieces=0)
+        # already loaded - the stock validator and the response use them
+        cart_item.cart, cart_item.item = cart, item
+        cart_item.n_pieces += n_pieces
+        # the validator checks if CartItem.n_pieces <= Item.in_stock
+        cart_item.save()
+    return cart_item
+
+
 class ItemDetailView(View):
     template_name = 'core/item_detail.html'
 
+    @method_decorator(read_from_replicas)
     def get(self, request, pk):
-        item = get_object_or_404(Item, pk=pk)
-        form = AddItemToCartForm()
-        context = {'item': item, 'form': form}
-        return render(request, template_name=self.template_name, context=context)
+        # the item is loaded only if its cached fragments are gone (a missing item raises 404 while rendering)
+        item = SimpleLazyObject(lambda: get_object_or_404(Item, pk=pk))
+        return self.render_page(request, pk, item, AddItemToCartForm())
 
+    @retry_on_lock
     def post(self, request, pk):
         """
         POST method allows for adding item to the cart.
@@ -90,34 +121,14 @@ class ItemDetailView(View):
         item = get_object_or_404(Item, pk=pk)  # get item instance by primary key lookup
         form = AddItemToCartForm(request.POST)  # get user input from form
 
-        cart, created = get_or_create_cart(request)
         # create CartItem instance and use it to bind the cart with the item
         if form.is_valid():
             try:
-                if not created:
-                    # if cart already exists
-                    # increase CartItem n_pieces, else create a new CartItem instance
-                    try:
-                        # get CartItem instance if it's already in the cart
-                        cart_item = CartItem.objects.get(cart=cart, item=item)
-                    except ObjectDoesNotExist:
-                        # create CartItem instance with 0 n_pieces if it's not in the cart yet
-                        cart_item = CartItem(cart=cart, item=item, n_pieces=0)
-
-                    # increase n_pieces in the CartItem instance based on user input
-                    cart_item.n_pieces += form.cleaned_data.get('n_pieces')
-                    # try to save the CartItem in the database (validator checks if current CartItem.n_pieces <= Item.in_stock)
-                    cart_item.save()
-                else:
-                    # if cart was created then it's empty, and it's safe to also create CartItem instance
-                    cart_item = CartItem.objects.create(cart=cart, item=item,
-                                                        n_pieces=form.cleaned_data.get('n_pieces'))
-
+                cart_item = add_to_cart(request, item, form.cleaned_data.get('n_pieces'))
             except ValidationError as ex:
                 messages.add_message(request, level=messages.WARNING, message=ex.messages[0])
 
-                return render(request, template_name=self.template_name,
-                              context={'item': item, 'form': form})
+                return self.render_page(request, pk, item, form)
 
             messages.add_message(request, level=messages.SUCCESS,
                                  message=f"Dodano do koszyka: {cart_item}")
@@ -125,19 +136,23 @@ class ItemDetailView(View):
             return redirect(to=reverse('core:detail', kwargs={'pk': pk}))
 
         else:
-            return render(request, template_name=self.template_name,
-                          context={'item': item, 'form': form})
+            return self.render_page(request, pk, item, form)
+
+    def render_page(self, request, pk, item, form):
+        # the cached fragments and the cart API URL use 'item_pk' - every render of the page must pass it
+        context = {'item': item, 'item_pk': pk, 'form': form}
+        return render(request, template_name=self.template_name, context=context)
 
 
 class CartView(View):
     template_name = 'core/cart.html'
 
     def get(self, request):
-        cart = get_or_create_cart(request)[0]
+        cart = get_cart(request)
 
-        cart_item_list = CartItem.objects.filter(cart=cart).order_by('item__name')
+        cart_item_list = CartItem.objects.for_cart(cart) if cart is not None else CartItem.objects.none()
 
-        total_price = calc_total_price(cart_item_list)
+        total_price = cart_item_list.total_price()
 
         context = {'cart_item_list': cart_item_list, 'total_price': total_price}
         return render(request, template_name=self.template_name, context=context)
@@ -145,15 +160,17 @@ class CartView(View):
 
 class RemoveFromCartView(View):
 
+    @retry_on_lock
     def post(self, request, pk):
-        cart, created = get_or_create_cart(request)
+        cart = get_cart(request)
 
-        if created:
+        if cart is None:
             raise Http404("Item not in the cart")
 
         try:
-            cart_item = CartItem.objects.get(cart=cart, item__pk=pk)
-            cart_item.delete()
+            with immediate_atomic():
+                cart_item = CartItem.objects.get(cart=cart, item__pk=pk)
+                cart_item.delete()
             messages.add_message(request, level=messages.SUCCESS,
                                  message=f"Usunięto z koszyka: {cart_item}")
         except ObjectDoesNotExist:
@@ -163,12 +180,105 @@ class RemoveFromCartView(View):
         return redirect(to=reverse('core:cart'))
 
 
+def cart_json(cart, item_pk, cart_item=None, message="", status=200):
+    """
+    JSON response of the cart endpoints: the changed line (None if the item is not in the cart any more),
+    the number of pieces and the total price of the whole cart.
+    """
+    summary = CartItem.objects.filter(cart=cart).summary()
+    line = None
+    if cart_item is not None:
+        line = {
+            "n_pieces": cart_item.n_pieces,
+            "line_total": str((cart_item.item.effective_price * cart_item.n_pieces).quantize(PRICE_QUANTUM)),
+        }
+    return JsonResponse({"item": item_pk, "line": line, "n_pieces": summary['n_pieces'],
+                         "total_price": str(summary['total_price']), "message": message}, status=status)
+
+
+def cart_json_error(message, status=400):
+    return JsonResponse({"error": message}, status=status)
+
+
+class CartAddApiView(View):
+    """
+    JSON counterpart of ItemDetailView.post - adds pieces of the item to the cart without a page reload.
+    """
+
+    @retry_on_lock
+    def post(self, request, pk):
+        item = Item.objects.filter(pk=pk).first()
+        if item is None:
+            return cart_json_error("Nie ma takiego produktu.", status=404)
+        form = AddItemToCartForm(request.POST)
+        if not form.is_valid():
+            return cart_json_error(form.errors['n_pieces'][0])
+        try:
+            cart_item = add_to_cart(request, item, form.cleaned_data['n_pieces'])
+        except ValidationError as ex:
+            return cart_json_error(ex.messages[0])
+        return cart_json(cart_item.cart, pk, cart_item, message=f"Dodano do koszyka: {cart_item}")
+
+
+class CartQuantityApiView(View):
+    """
+    JSON endpoint setting the number of pieces of an item in the cart (0 removes the item from the cart).
+    """
+
+    @retry_on_lock
+    def post(self, request, pk):
+        form = CartItemQuantityForm(request.POST)
+        if not form.is_valid():
+            return cart_json_error(form.errors['n_pieces'][0])
+        return self.set_quantity(request, pk, form.cleaned_data['n_pieces'])
+
+    @staticmethod
+    def set_quantity(request, pk, n_pieces):
+        cart = get_cart(request)
+        if cart is None:
+            return cart_json_error("Produktu nie ma w koszyku.", status=404)
+        try:
+            with immediate_atomic():
+                cart_item = CartItem.objects.select_related('item').filter(cart=cart, item=pk).first()
+                if cart_item is None:
+                    return cart_json_error("Produktu nie ma w koszyku.", status=404)
+                if n_pieces == 0:
+                    cart_item.delete()
+                else:
+                    cart_item.n_pieces = n_pieces
+                    cart_item.save()
+        except ValidationError as ex:
+            return cart_json_error(ex.messages[0])
+        if n_pieces == 0:
+            return cart_json(cart, pk, message=f"Usunięto z koszyka: {cart_item}")
+        return cart_json(cart, pk, cart_item, message=f"Zmieniono ilość: {cart_item}")
+
+
+class CartRemoveApiView(View):
+    """
+    JSON counterpart of RemoveFromCartView.
+    """
+
+    @retry_on_lock
+    def post(self, request, pk):
+        return CartQuantityApiView.set_quantity(request, pk, 0)
+
+
 class CategoryFilteredView(View):
     template_name = "core/category.html"
-
+    paginate_by = 24
+    # ordering name -> KeysetPaginator arguments
+    # price ordering uses the price denormalized in the subcategory links, so pages come straight from its index
+    orderings = {
+        'name': {'key_field': 'name'},
+        'price': {'key_field': 'itemsubcategory__effective_price', 'key_attr': 'effective_price'},
+    }
+    default_ordering = 'name'
+
+    @method_decorator(read_from_replicas)
     def get(self, request, pk):
         """
-        Filter items on subcategory id and price range.
+        Filter items on subcategory id and price range, one keyset-paginated page at a time.
         """
         category_name = get_object_or_404(SubCategory, pk=pk).name
         context = {'category_name': category_name}
@@ -184,26 +294,82 @@ class CategoryFilteredView(View):
         logging.debug(min_price)
         logging.debug(max_price)
 
+        # the query parameters the listing depends on, normalized - other parameters (e.g. utm_source) are ignored
+        params = {}
+        filters = Q(itemsubcategory__subcategory=pk)
         if min_price and max_price:
             # if user selected the minimal and maximal product price -> filter product list by subcategory and price range
-            item_list = Item.objects.filter(
-                Q(subcategories=pk) & (
-                        Q(price_sale__isnull=False) & Q(price_sale__gte=min_price) & Q(price_sale__lte=max_price) |
-                        Q(price_sale__isnull=True) & Q(price__gte=min_price) & Q(price__lte=max_price)
-                )
-
-            )
-            # min_price and max_price are user inputs rendered directly in the page - html escaping will prevent XSS attack
-            context['min_price'] = escape(min_price)
-            context['max_price'] = escape(max_price)
+            params['min-price'], params['max-price'] = int(min_price), int(max_price)
+            # a single range predicate on the price denormalized in the subcategory links is served by one index
+            filters &= Q(itemsubcategory__effective_price__gte=params['min-price'],
+                         itemsubcategory__effective_price__lte=params['max-price'])
+            # the cleaned integers are rendered in the page rather than the user input
+            context['min_price'] = params['min-price']
+            context['max_price'] = params['max-price']
         else:
-            item_list = Item.objects.filter(subcategories=pk)
             # set default price range to render on price range sliders
             context['min_price'] = 0
             context['max_price'] = 100
 
-        context['item_list'] = item_list
+        ordering = request.GET.get('order')
+        if ordering not in self.orderings:
+            ordering = self.default_ordering
+        context['ordering'] = params['order'] = ordering
+
+        cursor = request.GET.get('cursor')
+        # the cached listing fragments are keyed on the normalized values only, so that arbitrary query strings
+        # neither fill the cache nor miss it for the same content
+        context['listing_key'] = (pk, params.get('min-price'), params.get('max-price'), ordering, cursor)
+        # the page is queried only if the cached listing fragment is gone
+        context['listing'] = SimpleLazyObject(lambda: self.get_listing(pk, filters, ordering, params, cursor))
+        return render(request, self.template_name, context=context)
+
+    def get_listing(self, pk, filters, ordering, params, cursor):
+        """
+        :return: dict with the page of items and the URLs of the neighbouring pages (None if there is no such page)
+        """
+        paginator = KeysetPaginator(Item.objects.all(), per_page=self.paginate_by, filters=filters, name=ordering,
+                                    **self.orderings[ordering])
+        page = paginator.page(cursor)
+        listing = {'page': page, 'item_list': page.object_list,
+                   'next_url': None, 'more_url': None, 'previous_url': None}
+
+        # pagination links keep the price range and the ordering
+        if page.has_next():
+            listing['next_url'] = self.get_page_url(params, page.next_cursor)
+            listing['more_url'] = reverse('core:category-items', kwargs={'pk': pk}) + \
+                self.get_page_url(params, page.next_cursor)
+        if page.has_previous():
+            listing['previous_url'] = self.get_page_url(params, page.previous_cursor)
+        return listing
+
+    @staticmethod
+    def get_page_url(params, cursor):
+        # built from the normalized parameters - the links are part of the cached fragments
+        return '?' + urlencode({**params, 'cursor': cursor})
+
+
+class CategoryItemsView(CategoryFilteredView):
+    """
+    'Load more' endpoint rendering only the item tiles of the next page of a category listing.
+    """
+    template_name = "core/category_items.html"
+
+
+class SearchView(View):
+    template_name = "core/search.html"
+    paginate_by = 24
+
+    def get(self, request):
+        """
+        Full-text search over item names, compositions, descriptions and manufacturers, ranked by relevance.
+        """
+        query = request.GET.get('q', '').strip()
 
+        paginator = Paginator(SearchResults(query), self.paginate_by)
+        page = paginator.get_page(request.GET.get('page'))
+
+        context = {'query': query, 'page': page, 'item_list': page.object_list}
         return render(request, self.template_name, context=context)
 
 
@@ -215,10 +381,10 @@ class CheckoutView(View):
     template_name = "core/checkout.html"
 
     def get(self, request):
-        cart = get_or_create_cart(request)[0]
-        cart_item_list = CartItem.objects.filter(cart=cart).order_by('item__name')
+        cart = get_cart(request)
+        cart_item_list = CartItem.objects.for_cart(cart) if cart is not None else CartItem.objects.none()
 
-        total_price = calc_total_price(cart_item_list)
+        total_price = cart_item_list.total_price()
 
         user = request.user
         # check if user is logged in and if user is a customer and if it has address bound to his account
@@ -241,12 +407,13 @@ class CheckoutView(View):
                    "customerForm": customerForm, "orderMethodsForm": orderMethodsForm}
         return render(request, template_name=self.template_name, context=context)
 
+    @retry_on_lock
     def post(self, request):
         user = request.user
-        cart, cart_created = get_or_create_cart(request)
-        cart_item_list = CartItem.objects.filter(cart=cart).order_by('item__name')
+        cart = get_cart(request)
+        cart_item_list = CartItem.objects.for_cart(cart) if cart is not None else CartItem.objects.none()
 
-        if cart_created or len(cart_item_list) < 1:
+        if len(cart_item_list) < 1:
             raise Http404("Koszyk jest pusty!")
 
         # assign None to necessary variables
@@ -267,47 +434,31 @@ class CheckoutView(View):
                 if customerForm_valid:
                     customer, customer_created = Customer.objects.get_or_create(**customerForm.cleaned_data)
                 else:
-                    total_price = calc_total_price(cart_item_list)
+                    total_price = cart_item_list.total_price()
                     return render(request, template_name=self.template_name,
                                   context={'cart_item_list': cart_item_list, 'total_price': total_price, 'form': form,
                                            'customerForm': customerForm, "orderMethodsForm": orderMethodsForm})
 
-            address, address_created = Address.objects.get_or_create(**form.cleaned_data)
-            customer.address = address
-            if user.is_authenticated:
-                customer.user = user
-            customer.save()
-
-            order = Order.objects.create(address=address, customer=customer,
-                                         delivery_method=orderMethodsForm.cleaned_data.get("delivery_method"),
-                                         payment_method=orderMethodsForm.cleaned_data.get("payment_method"))
-
-            ordered_items = [OrderItem(order=order, item=cart_item.item, n_pieces=cart_item.n_pieces)
-                             for cart_item in cart_item_list]
             try:
-                # Check if all items that are about to be checked out have enough pieces in stock, if not show error
-                for ordered_item in ordered_items:
-                    ordered_item.validate_enough_pieces()
+                with immediate_atomic():
+                    address, address_created = Address.objects.get_or_create(**form.cleaned_data)
+                    customer.address = address
+                    if user.is_authenticated:
+                        customer.user = user
+                    customer.save()
+
+                    order = place_order(cart, customer=customer, address=address,
+                                        delivery_method=orderMethodsForm.cleaned_data.get("delivery_method"),
+                                        payment_method=orderMethodsForm.cleaned_data.get("payment_method"))
 
             except ValidationError as ex:
                 # If the pharmacy is short on at least one of items that are about to be checked out
                 # (order_item.n_pieces > item.in_stock) -> show error message
                 messages.add_message(request, level=messages.WARNING, message=ex.messages[0])
-                return render(request, template_name=self.template_name, context={"form": form})
-
-            # bind ordered items to order and adjust the item stock
-            for ordered_item in ordered_items:
-                ordered_item.save()
-                item = Item.objects.get(pk=ordered_item.item.pk)
-                item.in_stock -= ordered_item.n_pieces
-                item.save()
-
-            order.total_price = calc_total_price(ordered_items)
-            order.save()
-
-            # remove items from cart
-            for cart_item in cart_item_list:
-                cart_item.delete()
+                total_price = cart_item_list.total_price()
+                return render(request, template_name=self.template_name,
+                              context={'cart_item_list': cart_item_list, 'total_price': total_price, 'form': form,
+                                       'customerForm': customerForm, "orderMethodsForm": orderMethodsForm})
 
             messages.add_message(request, level=messages.SUCCESS, message=f"Zamówienie #{order.pk} wykonane pomyślnie!")
             return redirect(to=reverse('core:summary'))
@@ -316,7 +467,7 @@ class CheckoutView(View):
         else:
             if customerForm is None:
                 customerForm = CustomerCheckoutForm()
-            total_price = calc_total_price(cart_item_list)
+            total_price = cart_item_list.total_price()
             messages.add_message(request, level=messages.WARNING, message=f"Proszę poprawić błędy w formularzu zamówienia")
             return render(request, template_name=self.template_name,
                           context={'cart_item_list': cart_item_list, 'total_price': total_price, 'form': form,
@@ -324,6 +475,22 @@ class CheckoutView(View):
 
 
 class UserView(LoginRequiredMixin ,View):
+    orders_paginate_by = 10
+
+    def get_orders_context(self, request, customer):
+        """
+        One page of the order history (with the lines and items of its orders prefetched)
+        and the active orders for the status banners.
+        """
+        if customer is None:
+            return {"orders": [], "orders_page": None, "active_orders": []}
+
+        orders = Order.objects.for_customer(customer)
+        paginator = Paginator(orders.with_lines(), self.orders_paginate_by)
+        orders_page = paginator.get_page(request.GET.get("page"))
+        # the banners need only the number and the status of the few orders in progress
+        active_orders = orders.active().only("pk", "status")
+        return {"orders": orders_page.object_list, "orders_page": orders_page, "active_orders": active_orders}
 
     def get(self, request):
         """
@@ -334,7 +501,8 @@ class UserView(LoginRequiredMixin ,View):
 
         if hasattr(user, "customer"):
             customer = user.customer
-            initial_date_of_birth = customer.date_of_birth.isoformat()
+            # customers created at checkout have no date of birth
+            initial_date_of_birth = customer.date_of_birth.isoformat() if customer.date_of_birth else None
             initial_data = {"date_of_birth": initial_date_of_birth}
             customer_form = CustomerForm(instance=customer, initial=initial_data)
             logging.debug(customer)
@@ -344,9 +512,8 @@ class UserView(LoginRequiredMixin ,View):
 
         email_form = EmailForm(instance=user)
 
-        orders = Order.objects.filter(customer__user=user).order_by("-date")
-        context = {"user": user, "customer": customer, "customer_form": customer_form, "orders": orders,
-                   "email_form": email_form}
+        context = {"user": user, "customer": customer, "customer_form": customer_form, "email_form": email_form,
+                   **self.get_orders_context(request, customer)}
 
         return render(request, template_name="core/user.html", context=context)
 
@@ -370,7 +537,77 @@ class UserView(LoginRequiredMixin ,View):
             messages.add_message(request, level=messages.SUCCESS, message="Dane klienta zaktualizowane")
             return redirect(to=request.path)
         else:
-            orders = Order.objects.filter(customer__user=user).order_by("-date")
-            context = {"user": user, "customer": customer, "customer_form": customer_form, "orders": orders}
+            context = {"user": user, "customer": customer, "customer_form": customer_form, "email_form": email_form,
+                       **self.get_orders_context(request, customer)}
             messages.add_message(request, level=messages.WARNING, message="Proszę poprawić oznaczone pola formularza")
             return render(request, template_name="core/user.html", context=context)
+
+
+class MetricsView(View):
+    """
+    Request metrics of all worker processes in the Prometheus text format.
+    Available to staff users and to the addresses listed in METRICS_ALLOWED_IPS (e.g. the Prometheus server;
+    behind a reverse proxy REMOTE_ADDR is the proxy's address, so block /metrics there).
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+            raise PermissionDenied
+        return HttpResponse(metrics.render_metrics(), content_type=metrics.CONTENT_TYPE)
+
+
+@method_decorator(staff_member_required, name='dispatch')
+class SalesReportView(View):
+    """
+    Sales report for the staff, read from the daily sales rollups only (see core.reports).
+    """
+    template_name = 'core/sales_report.html'
+    # reported days by default (ending today)
+    default_days = 30
+
+    def get(self, request):
+        today = timezone.localdate()
+        form = SalesReportForm(request.GET or {'start': today - datetime.timedelta(days=self.default_days - 1),
+                                               'end': today})
+        report = None
+        if form.is_valid():
+            report = reports.sales_report(form.cleaned_data['start'], form.cleaned_data['end'])
+        return render(request, template_name=self.template_name, context={'form': form, 'report': report})
+
+
+def exported_feed_path(request, feed_format):
+    feed = feeds.get_feed(feed_format)
+    if feed is None:
+        return None
+    path = feeds.feed_path(feed)
+    return path if os.path.exists(path) else None
+
+
+def feed_etag(request, feed_format):
+    path = exported_feed_path(request, feed_format)
+    return feeds.feed_etag(path) if path is not None else None
+
+
+def feed_last_modified(request, feed_format):
+    path = exported_feed_path(request, feed_format)
+    if path is None:
+        return None
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path), tz=datetime.timezone.utc)
+
+
+@method_decorator(condition(etag_func=feed_etag, last_modified_func=feed_last_modified), name='get')
+class ProductFeedView(View):
+    """
+    Product feed for price comparison sites - the file exported by the 'export_feeds' command (see core.feeds),
+    answered with 304 Not Modified when the aggregator already has it. Until the first export the feed is streamed
+    straight from the database.
+    """
+
+    def get(self, request, feed_format, *args, **kwargs):
+        feed = feeds.get_feed(feed_format)
+        if feed is None:
+            raise Http404
+        path = exported_feed_path(request, feed_format)
+        if path is not None:
+            return FileResponse(open(path, "rb"), content_type=feed.content_type)
+        return StreamingHttpResponse(feeds.stream_feed(feed), content_type=feed.content_type)
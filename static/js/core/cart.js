@@ -0,0 +1,114 @@
+/*
+ * Progressive enhancement of the cart forms: forms with a data-cart-api attribute are posted to the JSON cart
+ * endpoint it names instead of reloading the page. Without JavaScript the forms keep working as before.
+ */
+(function () {
+  "use strict";
+
+  const GENERIC_ERROR = "Nie udało się zaktualizować koszyka. Odśwież stronę i spróbuj ponownie.";
+
+  function showMessage(text, level) {
+    const container = document.getElementById("cart-messages");
+    if (!container) {
+      return;
+    }
+    const alert = document.createElement("div");
+    alert.className = "alert alert-" + level;
+    alert.setAttribute("role", "alert");
+    alert.textContent = text;
+    container.replaceChildren(alert);
+  }
+
+  function updateCart(data) {
+    document.querySelectorAll("[data-cart-total]").forEach((element) => {
+      element.textContent = data.total_price + " zł";
+    });
+    document.querySelectorAll("[data-cart-count]").forEach((element) => {
+      element.textContent = data.n_pieces;
+    });
+    const line = document.querySelector('[data-cart-line="' + data.item + '"]');
+    if (!line) {
+      return;
+    }
+    if (data.line === null) {
+      line.remove();
+      if (data.n_pieces === 0) {
+        // the empty cart page is rendered by the server
+        window.location.reload();
+      }
+      return;
+    }
+    line.querySelectorAll("[data-line-pieces]").forEach((element) => {
+      if ("value" in element) {
+        element.value = data.line.n_pieces;
+      } else {
+        element.textContent = data.line.n_pieces;
+      }
+    });
+    line.querySelectorAll("[data-line-total]").forEach((element) => {
+      element.textContent = data.line.line_total + " zł";
+    });
+  }
+
+  async function submit(form) {
+    let response;
+    try {
+      response = await fetch(form.dataset.cartApi, {
+        method: "POST",
+        // includes csrfmiddlewaretoken of the form
+        body: new FormData(form),
+        headers: {"Accept": "application/json"},
+        credentials: "same-origin",
+      });
+    } catch (error) {
+      // e.g. offline - fall back to the regular form submission
+      form.submit();
+      return;
+    }
+    // error pages (500, a failed CSRF check etc.) are HTML, not the JSON of the endpoint
+    const isJson = (response.headers.get("Content-Type") || "").startsWith("application/json");
+    let data = null;
+    if (isJson) {
+      try {
+        data = await response.json();
+      } catch (error) {
+        data = null;
+      }
+    }
+    if (data === null) {
+      showMessage(GENERIC_ERROR, "danger");
+      return;
+    }
+    if (!response.ok) {
+      showMessage(data.error || GENERIC_ERROR, "warning");
+      return;
+    }
+    showMessage(data.message, "success");
+    updateCart(data);
+  }
+
+  document.addEventListener("submit", (event) => {
+    const form = event.target;
+    if (form.dataset && form.dataset.cartApi) {
+      event.preventDefault();
+      submit(form);
+    }
+  });
+
+  document.addEventListener("change", (event) => {
+    const form = event.target.form;
+    if (form && form.dataset.cartApi && event.target.matches("[data-line-pieces]")) {
+      submit(form);
+    }
+  });
+
+  document.addEventListener("DOMContentLoaded", () => {
+    // controls which only work with JavaScript
+    document.querySelectorAll("[data-cart-enhanced]").forEach((element) => {
+      element.hidden = false;
+    });
+    document.querySelectorAll("[data-cart-fallback]").forEach((element) => {
+      element.hidden = true;
+    });
+  });
+})();